@@ -1,12 +1,213 @@
 import json
 import os
 import re
-from flask import Flask, request, abort, jsonify
+from datetime import datetime
+from flask import Flask, Response, g, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException
 from sqlalchemy.sql.type_api import INDEXABLE
-from database.models import setup_db, db_drop_and_create_all, Chemical, Inventory, association_table
-from auth.auth import AuthError, requires_auth
+from database.models import setup_db, db_drop_and_create_all, database_path, Chemical, Inventory, association_table
+from database import export
+from database.cache import chemical_cache
+from database import similarity, search
+from database.similarity import similarity_index
+from database.search import name_index, search_names
+from database import hazards
+from database.hazards import hazard_engine
+from database.snapshot import snapshot, begin_read, end_read
+from auth.auth import AuthError, requires_auth, check_permissions
+from database.models import db, Job
+from database.upsert import upsert_chemicals
+from database.deletes import delete_chemicals, delete_inventories
+from database import queries
+from server.singleflight import coalesce, flights
+from server.admission import admit, admission
+from server.green import patch_psycopg, pool_options
+from server.groupcommit import GroupCommitter
+from server.profiling import RequestProfiler
+from jobs.jobs import JOB_TYPES, ACTIVE_STATUSES, RESUMABLE_STATUSES, JobRunner, JobQueueFull
+
+# -----------------
+# HELPERS
+# ----------------
+
+
+def parse_fields(model, arg='fields', default=None):
+    """Returns the fields listed in a ?fields= style query argument"""
+    fields = request.args.get(arg)
+    if fields is None:
+        return default
+
+    fields = tuple(
+        field.strip() for field in fields.split(',') if field.strip())
+    if not fields or any(field not in model.FIELDS for field in fields):
+        abort(400, f'Invalid {arg}. Choose from: {", ".join(model.FIELDS)}.')
+
+    return fields
+
+
+def parse_filters(available):
+    """Returns the filters of available (queries.CHEMICAL_FILTERS,
+    queries.INVENTORY_FILTERS) present in the query arguments"""
+    filters = {}
+    for arg, (type, _) in available.items():
+        value = request.args.get(arg)
+        if value is None:
+            continue
+        try:
+            filters[arg] = type(value)
+        except ValueError:
+            abort(400, f'{arg} must be a number.')
+    return filters
+
+
+def parse_sort(available, default):
+    """Returns the ?sort= key, one of available"""
+    sort = request.args.get('sort', default).strip()
+    if sort not in available:
+        abort(400, f'Invalid sort. Choose from: {", ".join(available)}.')
+    return sort
+
+
+def is_ld50(ld50):
+    """Whether ld50 is a positive number"""
+    return not isinstance(ld50, bool) and isinstance(ld50, (int, float)) \
+        and ld50 > 0
+
+
+def parse_chemical_records(records):
+    """Validates a list of {name, smiles, ld50} records"""
+    if not isinstance(records, list) or not records:
+        abort(422, 'A non-empty list of chemicals is required.')
+
+    for index, record in enumerate(records):
+        if not isinstance(record, dict) or \
+                not all(key in record for key in ('name', 'smiles', 'ld50')):
+            abort(422, f'Chemical {index} needs name, smiles and ld50.')
+
+        if not is_ld50(record['ld50']):
+            abort(422, f'Chemical {index} needs a positive ld50.')
+
+    if len({record['smiles'] for record in records}) != len(records):
+        abort(422, 'Each smiles may appear only once.')
+
+    return [{key: record[key] for key in ('name', 'smiles', 'ld50')}
+            for record in records]
+
+
+def parse_ids(body, key):
+    """Validates a non-empty list of integer ids under key"""
+    ids = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not ids or any(
+            isinstance(id, bool) or not isinstance(id, int) for id in ids):
+        abort(422, f'A non-empty list of integer {key} is required.')
+    return ids
+
+
+def parse_ld50_changes(body):
+    """Validates a {chemical id: ld50} mapping under 'ld50'"""
+    changes = body.get('ld50') if isinstance(body, dict) else None
+    if not isinstance(changes, dict) or not changes:
+        abort(422, 'A non-empty {chemical id: ld50} mapping is required.')
+
+    parsed = {}
+    for id, ld50 in changes.items():
+        if not str(id).isdigit():
+            abort(422, f'Chemical id {id} must be an integer.')
+        if not is_ld50(ld50):
+            abort(422, f'Chemical {id} needs a positive ld50.')
+        parsed[int(id)] = ld50
+    return parsed
+
+
+def check_if_match(version, if_match=None):
+    """Aborts with 412 unless an If-Match header, if sent, names version;
+    pass if_match, the request's, outside the request's thread"""
+    if if_match is None:
+        if_match = request.if_match
+    if if_match and not if_match.star_tag and \
+            not if_match.contains_weak(str(version)):
+        abort(412, 'Resource was modified. Fetch it again and retry.')
+
+
+def with_etag(response, version):
+    """Tags a response with the weak ETag of a resource version"""
+    response.set_etag(str(version), weak=True)
+    return response
+
+
+def get_chemicals_or_400(chemical_ids, session=None):
+    """Chemicals for chemical_ids, in order, fetched in one query"""
+    chemicals = {
+        chemical.id: chemical
+        for chemical in queries.get_chemicals(
+            set(chemical_ids), session=session)}
+    if any(id not in chemicals for id in chemical_ids):
+        abort(400)
+
+    return [chemicals[id] for id in chemical_ids]
+
+
+def select_fields(data, fields):
+    """Projects a serialized (e.g. cached) resource onto fields"""
+    return {field: data[field] for field in fields}
+
+
+def parse_number(arg, type, default, minimum, maximum):
+    """Returns a numeric query argument within [minimum, maximum]"""
+    try:
+        value = type(request.args.get(arg, default))
+    except ValueError:
+        abort(400, f'{arg} must be a number.')
+    if not minimum <= value <= maximum:
+        abort(400, f'{arg} must be between {minimum} and {maximum}.')
+    return value
+
+
+def ranked_chemicals(matches, fields):
+    """Serializes [(chemical id, similarity)] matches from the cache"""
+    found = chemical_cache.get_many([id for id, _ in matches])
+    return [
+        dict(select_fields(found[id], fields), similarity=round(score, 4))
+        for id, score in matches if id in found]
+
+
+def retry_after_header(error):
+    """Retry-After header of a shed (429 / 503) request, if it has one"""
+    retry_after = getattr(error, 'retry_after', None)
+    return {'Retry-After': str(retry_after)} if retry_after else {}
+
+
+def export_response(name, build_export, export_format):
+    """Streams a columnar export as an attachment"""
+    if not export.available(export_format):
+        abort(501, f'{export_format} export requires pyarrow.')
+
+    statement, schema = build_export()
+    return Response(
+        stream_with_context(
+            export.stream(statement, schema, export_format)),
+        mimetype=export.MIMETYPES[export_format],
+        headers={
+            'Content-Disposition':
+                f'attachment; filename={name}.{export_format}'
+        })
+
+
+def parse_expand(allowed):
+    """Returns the set of relationships listed in ?expand="""
+    expand = request.args.get('expand')
+    if expand is None:
+        return set()
+
+    expand = {name.strip() for name in expand.split(',') if name.strip()}
+    if not expand <= set(allowed):
+        abort(400, f'Invalid expand. Choose from: {", ".join(allowed)}.')
+
+    return expand
+
 
 # -----------------
 # APP SETUP
@@ -16,7 +217,28 @@ from auth.auth import AuthError, requires_auth
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    # Under eventlet / gevent workers, before the first connection
+    green = patch_psycopg()
+    app.config.setdefault(
+        'SQLALCHEMY_ENGINE_OPTIONS', pool_options(database_path, green))
     setup_db(app)
+    jobs = JobRunner(
+        app,
+        max_workers=int(os.getenv('JOB_WORKERS', 2)),
+        max_pending=int(os.getenv('JOB_QUEUE_SIZE', 100)),
+        lease=int(os.getenv('JOB_LEASE_SECONDS', 600)))
+    jobs.recover()
+    # Single-row writes commit in batches when GROUP_COMMIT_WINDOW_MS > 0
+    window = float(os.getenv('GROUP_COMMIT_WINDOW_MS', 0)) / 1000
+    if (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('sqlite'):
+        window = 0
+    group_commit = GroupCommitter(
+        app,
+        window=window,
+        max_batch=int(os.getenv('GROUP_COMMIT_MAX_BATCH', 64)),
+        timeout=float(os.getenv('GROUP_COMMIT_TIMEOUT_MS', 5000)) / 1000)
 
     # Create clean database
     # db_drop_and_create_all()
@@ -28,6 +250,16 @@ def create_app(test_config=None):
         }
     })
 
+    # GETs read from the read snapshot while it is fresh enough
+    @app.before_request
+    def route_reads():
+        if request.method in ('GET', 'HEAD'):
+            begin_read()
+
+    @app.teardown_request
+    def close_read_session(error):
+        end_read()
+
     @app.after_request
     def after_request(response):
         response.headers.add(
@@ -38,8 +270,19 @@ def create_app(test_config=None):
             'Access-Control-Allow-Methods',
             'GET,PUT,POST,DELETE,OPTIONS'
         )
+        if g.get('snapshot_age') is not None:
+            response.headers['X-Snapshot-Age'] = str(int(g.snapshot_age))
         return response
 
+    # Registered after the read snapshot hooks, so a profile is taken
+    # while the snapshot session is still open. PROFILE_SAMPLE_RATE is the
+    # share of requests profiled; an X-Profile header with get:profiles
+    # rights profiles any request
+    profiler = RequestProfiler(
+        app,
+        sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+        frames=int(os.getenv('PROFILE_TRACEBACK_FRAMES', 1)))
+
     # -------------------
     # ROUTES
     # -------------------
@@ -50,17 +293,56 @@ def create_app(test_config=None):
             "success": True,
         })
 
+    @app.route('/metrics')
+    def metrics():
+        return jsonify({
+            "success": True,
+            "chemical_cache": chemical_cache.stats(),
+            "single_flight": flights.stats(),
+            "admission": admission.stats(),
+            "group_commit": group_commit.stats(),
+            "similarity_index": similarity_index.stats(),
+            "name_index": name_index.stats(),
+            "hazard_engine": hazard_engine.stats(),
+            "snapshot": snapshot.stats(),
+            "profiler": profiler.stats(),
+        })
+
+    @app.route('/admin/profiles')
+    @requires_auth('get:profiles')
+    def retrieve_profiles(permission):
+        return jsonify({
+            "success": True,
+            **profiler.report(),
+        })
+
+    @app.route('/admin/profiles/<int:profile_id>')
+    @requires_auth('get:profiles')
+    def retrieve_profile(permission, profile_id):
+        profile = profiler.get(profile_id)
+        if profile is None:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "profile": profile,
+        })
+
     # -------------------
     # CHEMICALS
     # -------------------
 
     @app.route('/chemicals', methods=['GET'])
     @requires_auth("get:chemicals")
+    @coalesce
+    @admit(weight=8, limit=4)
     def retrieve_chemicals(permission):
+        fields = parse_fields(Chemical, default=Chemical.FORMAT_FIELDS)
+        filters = parse_filters(queries.CHEMICAL_FILTERS)
 
         try:
-            chemicals = Chemical.query.order_by(Chemical.id).all()
-            chemicals = [chemical.format() for chemical in chemicals]
+            chemicals = queries.all_chemicals(fields, filters)
+            chemicals = [chemical.format(fields) for chemical in chemicals]
 
             if chemicals is None:
                 abort(404)
@@ -73,8 +355,46 @@ def create_app(test_config=None):
         except BaseException:
             abort(400)
 
+    @app.route('/chemicals/similar', methods=['GET'])
+    @requires_auth("get:chemicals")
+    @coalesce
+    @admit(weight=2)
+    def retrieve_similar_chemicals(permission):
+        smiles = request.args.get('smiles', '').strip()
+        if not smiles:
+            abort(400, 'smiles is required.')
+
+        k = parse_number('k', int, 10, 1, similarity.MAX_RESULTS)
+        min_sim = parse_number('min_sim', float, 0, 0, 1)
+        fields = parse_fields(Chemical, default=Chemical.FORMAT_FIELDS)
+        matches = similarity_index.search(smiles, k, min_sim)
+
+        return jsonify({
+            'success': True,
+            'chemicals': ranked_chemicals(matches, fields)
+        })
+
+    @app.route('/chemicals/search', methods=['GET'])
+    @requires_auth("get:chemicals")
+    @coalesce
+    @admit(weight=2)
+    def search_chemicals(permission):
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(400, 'q is required.')
+
+        k = parse_number('k', int, 10, 1, search.MAX_RESULTS)
+        fields = parse_fields(Chemical, default=Chemical.FORMAT_FIELDS)
+        matches = search_names(q, k)
+
+        return jsonify({
+            'success': True,
+            'chemicals': ranked_chemicals(matches, fields)
+        })
+
     @app.route('/chemicals', methods=['POST'])
     @requires_auth('post:chemicals')
+    @admit()
     def create_chemical(permission):
         body = request.get_json()
 
@@ -85,38 +405,127 @@ def create_app(test_config=None):
         smiles = body.get('smiles', None)
         ld50 = body.get('ld50', None)
 
-        try:
+        def write(session):
             chemical = Chemical(name=name, smiles=smiles, ld50=ld50)
-            chemical.insert()
+            session.add(chemical)
+            session.flush()
+            return chemical.format()
+
+        try:
+            chemical = group_commit.run(write)
 
             return jsonify({
                 'success': True,
-                'chemical': chemical.format()
+                'chemical': chemical
             })
 
+        except HTTPException:
+            raise
+
+        except BaseException:
+            abort(422)
+
+    def may_update_chemicals(payload):
+        """Whether an upsert may overwrite existing chemicals, which takes
+        patch:chemicals on top of post:chemicals"""
+        return 'patch:chemicals' in payload['permissions']
+
+    def refuse_conflicts(results):
+        """Rolls back an upsert that would have overwritten chemicals
+        without the permission to"""
+        if any(result['status'] == 'conflict' for result in results):
+            db.session.rollback()
+            abort(403, 'Updating existing chemicals requires '
+                       'patch:chemicals.')
+
+    @app.route('/chemicals/by-smiles/<path:smiles>', methods=['PUT'])
+    @requires_auth('post:chemicals')
+    @admit()
+    def upsert_chemical(permission, smiles):
+        body = request.get_json()
+
+        if 'name' not in body or 'ld50' not in body:
+            abort(422)
+
+        record, = parse_chemical_records([{
+            'name': body['name'],
+            'smiles': smiles,
+            'ld50': body['ld50']
+        }])
+
+        try:
+            result, = upsert_chemicals(
+                [record], update=may_update_chemicals(permission))
+            if result['status'] != 'conflict':
+                db.session.commit()
+
         except BaseException:
+            db.session.rollback()
             abort(422)
 
+        refuse_conflicts([result])
+
+        return jsonify({
+            'success': True,
+            'status': result['status'],
+            'chemical': {'id': result['id'], **record}
+        }), 201 if result['status'] == 'created' else 200
+
+    @app.route('/chemicals/by-smiles', methods=['PUT'])
+    @requires_auth('post:chemicals')
+    @admit(weight=8, limit=4)
+    def upsert_chemicals_bulk(permission):
+        body = request.get_json()
+
+        if 'chemicals' not in body:
+            abort(422)
+
+        records = parse_chemical_records(body['chemicals'])
+
+        try:
+            results = upsert_chemicals(
+                records, update=may_update_chemicals(permission))
+            if all(result['status'] != 'conflict' for result in results):
+                db.session.commit()
+
+        except BaseException:
+            db.session.rollback()
+            abort(422)
+
+        refuse_conflicts(results)
+
+        return jsonify({
+            'success': True,
+            'chemicals': results
+        })
+
     @app.route('/chemicals/<int:chemical_id>', methods=['GET'])
     @requires_auth('get:chemicals')
+    @coalesce
+    @admit()
     def retrieve_chemical(permission, chemical_id):
 
-        chemical = Chemical.query.get_or_404(chemical_id)
+        fields = parse_fields(Chemical, default=Chemical.FORMAT_FULL_FIELDS)
+        chemical = chemical_cache.get(chemical_id)
+        if chemical is None:
+            abort(404)
 
-        return jsonify({
+        return with_etag(jsonify({
             'success': True,
-            'chemical': chemical.format_full()
-        })
+            'chemical': select_fields(chemical, fields)
+        }), chemical['version'])
 
     @app.route('/chemicals/<int:chemical_id>', methods=['PATCH'])
     @requires_auth('patch:chemicals')
+    @admit()
     def patch_chemical(permission, chemical_id):
 
-        chemical = Chemical.query.filter(
-            Chemical.id == chemical_id).one_or_none()
+        chemical = queries.get_chemical(chemical_id)
         if chemical is None:
             abort(404)
 
+        check_if_match(chemical.version)
+
         body = request.get_json()
 
         if 'name' in body:
@@ -126,49 +535,74 @@ def create_app(test_config=None):
             chemical.smiles = body['smiles']
 
         if 'ld50' in body:
+            if not is_ld50(body['ld50']):
+                abort(422, 'ld50 must be a positive number.')
             chemical.ld50 = body['ld50']
 
         try:
             chemical.update()
 
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
                 'chemical': chemical.format()
-            })
+            }), chemical.version)
+
+        except StaleDataError:
+            db.session.rollback()
+            abort(412, 'Resource was modified. Fetch it again and retry.')
 
         except BaseException:
             abort(422)
 
     @app.route('/chemicals/<int:chemical_id>', methods=['DELETE'])
     @requires_auth('delete:chemicals')
+    @admit()
     def delete_chemical(permission, chemical_id):
 
-        chemical = Chemical.query.filter(
-            Chemical.id == chemical_id).one_or_none()
-        if chemical is None:
-            abort(404)
-
         try:
-            chemical.delete()
-
-            return jsonify({
-                'success': True,
-                'deleted chemical id': chemical_id
-            })
+            deleted = delete_chemicals([chemical_id])
+            db.session.commit()
 
         except BaseException:
+            db.session.rollback()
             abort(422)
 
+        if not deleted:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted chemical id': chemical_id
+        })
+
     # ---------------------
     # INVENTORIES
     # ---------------------
 
     @app.route('/inventories', methods=['GET'])
     @requires_auth('get:inventories')
+    @coalesce
+    @admit(weight=8, limit=4)
     def retrieve_inventories(permission):
+        fields = parse_fields(Inventory, default=Inventory.FORMAT_FIELDS)
+        expand = parse_expand(['chemicals'])
+        if 'chemicals' in expand:
+            chemical_fields = parse_fields(
+                Chemical, 'chemical_fields', Chemical.FORMAT_FIELDS)
+        filters = parse_filters(queries.INVENTORY_FILTERS)
+        sort = parse_sort(queries.INVENTORY_SORTS, 'id')
+
         try:
-            inventories = Inventory.query.order_by(Inventory.id).all()
-            inventories = [inventory.format() for inventory in inventories]
+            if 'chemicals' in expand:
+                inventories = queries.all_inventories(
+                    fields, chemical_fields, filters, sort)
+                inventories = [inventory.format_full(fields, chemical_fields)
+                               for inventory in inventories]
+            else:
+                inventories = queries.all_inventories(
+                    fields, filters=filters, sort=sort)
+                inventories = [inventory.format(fields)
+                               for inventory in inventories]
 
             if inventories is None:
                 abort(404)
@@ -183,6 +617,7 @@ def create_app(test_config=None):
 
     @app.route('/inventories', methods=['POST'])
     @requires_auth('post:inventories')
+    @admit(weight=2)
     def create_inventory(permission):
         body = request.get_json()
 
@@ -190,100 +625,321 @@ def create_app(test_config=None):
             abort(422)
 
         location = body.get('location', None)
-        chemical_ids = body.get('chemicals')
-        chemicals = []
-        for id in chemical_ids:
-            chemical = Chemical.query.filter(Chemical.id == id).one_or_none()
-            if chemical is None:
-                abort(400)
-            chemicals.append(chemical)
+        chemical_ids = body.get('chemicals', [])
 
-        try:
+        def write(session):
+            chemicals = get_chemicals_or_400(chemical_ids, session)
             inventory = Inventory(location=location, chemicals=chemicals)
-            inventory.insert()
+            session.add(inventory)
+            session.flush()
+            return inventory.format_full()
+
+        try:
+            inventory = group_commit.run(write)
 
             return jsonify({
                 'success': True,
-                'inventory': inventory.format_full()
+                'inventory': inventory
             })
 
+        except HTTPException:
+            raise
+
         except BaseException:
             abort(400)
 
     @app.route('/inventories/<int:inventory_id>', methods=['GET'])
     @requires_auth('get:inventories')
+    @coalesce
+    @admit()
     def retrieve_inventory(permission, inventory_id):
 
-        inventory = Inventory.query.get_or_404(inventory_id)
+        fields = parse_fields(Inventory, default=Inventory.FORMAT_FIELDS)
+        chemical_fields = parse_fields(
+            Chemical, 'chemical_fields', Chemical.FORMAT_FIELDS)
+        inventory = queries.get_inventory(inventory_id, fields + ('version',))
+        if inventory is None:
+            abort(404)
+        version = inventory.version
 
-        # inventory_chemicals = inventory.chemicals
+        # Members are served from the chemical cache
+        chemical_ids = queries.inventory_chemical_ids(inventory_id)
+        chemicals = chemical_cache.get_many(chemical_ids)
+        inventory = inventory.format(fields)
+        inventory['chemicals'] = [
+            select_fields(chemicals[id], chemical_fields)
+            for id in chemical_ids if id in chemicals]
 
-        return jsonify({
+        return with_etag(jsonify({
             'success': True,
-            'inventory': inventory.format_full()
-        })
+            'inventory': inventory
+        }), version)
 
     @app.route('/inventories/<int:inventory_id>', methods=['PATCH'])
     @requires_auth('patch:inventories')
+    @admit(weight=2)
     def patch_inventory(permission, inventory_id):
 
-        inventory = Inventory.query.filter(
-            Inventory.id == inventory_id).one_or_none()
-        if inventory is None:
-            abort(404)
-
         body = request.get_json()
+        if_match = request.if_match
+
+        def write(session):
+            inventory = queries.get_inventory(inventory_id, session=session)
+            if inventory is None:
+                abort(404)
+
+            check_if_match(inventory.version, if_match)
+
+            if 'location' in body:
+                inventory.location = body['location']
+
+            # Membership lives in the association table; touching the row
+            # makes membership edits bump (and check) the version too
+            if 'chemical_ids_to_add' in body or \
+                    'chemical_ids_to_remove' in body:
+                inventory.updated_on = datetime.now()
+
+            if 'chemical_ids_to_add' in body:
+                chemical_ids_to_add = body['chemical_ids_to_add']
+                for chemical in get_chemicals_or_400(
+                        chemical_ids_to_add, session):
+                    inventory.chemicals.append(chemical)
+
+            if 'chemical_ids_to_remove' in body:
+                chemical_ids_to_remove = body['chemical_ids_to_remove']
+                for chemical in get_chemicals_or_400(
+                        chemical_ids_to_remove, session):
+                    inventory.chemicals.remove(chemical)
+
+            session.flush()
+            return inventory.format_full(), inventory.version
 
-        if 'location' in body:
-            inventory.location = body['location']
-
-        if 'chemical_ids_to_add' in body:
-            chemical_ids_to_add = body['chemical_ids_to_add']
-            for id in chemical_ids_to_add:
-                chemical = Chemical.query.filter(
-                    Chemical.id == id).one_or_none()
-                if chemical is None:
-                    abort(400)
-                inventory.chemicals.append(chemical)
-
-        if 'chemical_ids_to_remove' in body:
-            chemical_ids_to_remove = body['chemical_ids_to_remove']
-            for id in chemical_ids_to_remove:
-                chemical = Chemical.query.filter(
-                    Chemical.id == id).one_or_none()
-                if chemical is None:
-                    abort(400)
-                inventory.chemicals.remove(chemical)
         try:
-            inventory.update()
+            inventory, version = group_commit.run(write)
 
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
-                'inventory': inventory.format_full()
-            })
+                'inventory': inventory
+            }), version)
+
+        except StaleDataError:
+            abort(412, 'Resource was modified. Fetch it again and retry.')
+
+        except HTTPException:
+            raise
 
         except BaseException:
             abort(400)
 
     @app.route('/inventories/<int:inventory_id>', methods=['DELETE'])
     @requires_auth('delete:inventories')
+    @admit(weight=2)
     def delete_inventory(permission, inventory_id):
-        inventory = Inventory.query.filter(
-            Inventory.id == inventory_id).one_or_none()
-        if inventory is None:
-            abort(404)
 
         try:
-            inventory.delete()
+            deleted, _ = delete_inventories([inventory_id])
+            db.session.commit()
 
-            return jsonify({
-                'success': True,
-                'deleted inventory id': inventory.id
-            })
+        except BaseException:
+            db.session.rollback()
+            abort(400)
+
+        if not deleted:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted inventory id': inventory_id
+        })
+
+    @app.route('/inventories', methods=['DELETE'])
+    @requires_auth('delete:inventories')
+    @admit(weight=8, limit=4)
+    def delete_inventories_bulk(permission):
+        inventory_ids = parse_ids(request.get_json(), 'inventory_ids')
+
+        try:
+            deleted, chemical_ids = delete_inventories(inventory_ids)
+            missing = set(inventory_ids) - set(deleted)
+            if missing:
+                db.session.rollback()
+            else:
+                db.session.commit()
 
         except BaseException:
+            db.session.rollback()
             abort(400)
 
+        # All or nothing: one unknown id deletes none
+        if missing:
+            abort(404, f'Inventories not found: {sorted(missing)}.')
+
+        return jsonify({
+            'success': True,
+            'deleted inventory ids': sorted(deleted),
+            'deleted chemical ids': sorted(chemical_ids)
+        })
+
+    # ---------------------
+    # ANALYTICS
+    # ---------------------
+
+    @app.route('/analytics/hazards', methods=['GET'])
+    @requires_auth('get:inventories')
+    @coalesce
+    @admit(weight=2)
+    def retrieve_hazards(permission):
+        min_hazard = parse_number('min_hazard', float, 0, 0, float('inf'))
+        limit = parse_number('limit', int, 100, 1, hazards.MAX_RESULTS)
+        matches, summary = hazard_engine.hazards(min_hazard)
+
+        return jsonify({
+            'success': True,
+            'inventories': [
+                {'id': id, 'hazard': hazard, 'chemicals': members}
+                for id, hazard, members in matches[:limit]],
+            'total': len(matches),
+            'summary': summary
+        })
+
+    @app.route('/analytics/hazards/what-if', methods=['POST'])
+    @requires_auth('get:inventories')
+    @admit(weight=2)
+    def what_if_hazards(permission):
+        changes = parse_ld50_changes(request.get_json())
+
+        try:
+            results = hazard_engine.what_if(changes)
+        except KeyError as error:
+            abort(400, f'Chemicals not found: {error.args[0]}.')
+
+        return jsonify({
+            'success': True,
+            'inventories': [
+                {'id': id, 'hazard': hazard, 'what_if_hazard': what_if}
+                for id, hazard, what_if in results]
+        })
+
+    # -----------------------
+    # JOBS
+    # -----------------------
+
+    def check_job_permission(job_type, payload):
+        try:
+            check_permissions(JOB_TYPES[job_type]['permission'], payload)
+        except AuthError as authError:
+            abort(authError.status_code, authError.error['description'])
+
+    def submit_job(job):
+        try:
+            jobs.submit(job.id)
+        except JobQueueFull:
+            job.status = 'failed'
+            job.error = 'Job queue is full.'
+            job.update()
+            abort(503, 'Job queue is full. Try again later.')
+
+    @app.route('/jobs', methods=['POST'])
+    @requires_auth('post:jobs')
+    @admit()
+    def create_job(permission):
+        body = request.get_json()
+
+        if 'type' not in body or body['type'] not in JOB_TYPES:
+            abort(422, f'type must be one of: {", ".join(JOB_TYPES)}.')
+
+        params = body.get('params', {})
+        if not isinstance(params, dict):
+            abort(422)
+
+        check_job_permission(body['type'], permission)
+
+        job = Job(type=body['type'], params=params)
+        job.insert()
+        submit_job(job)
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        }), 202
+
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    @requires_auth('get:jobs')
+    @admit()
+    def retrieve_job(permission, job_id):
+
+        job = Job.query.get_or_404(job_id)
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        })
+
+    @app.route('/jobs/<int:job_id>', methods=['DELETE'])
+    @requires_auth('delete:jobs')
+    @admit()
+    def cancel_job(permission, job_id):
+
+        job = Job.query.get_or_404(job_id)
+        check_job_permission(job.type, permission)
+
+        if job.status not in ACTIVE_STATUSES:
+            abort(409, f'Job is already {job.status}.')
+
+        job.cancel_requested = True
+        # No worker is left to see the request
+        if jobs.is_stale(job):
+            job.status = 'cancelled'
+        job.update()
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        }), 202
+
+    @app.route('/jobs/<int:job_id>/resume', methods=['POST'])
+    @requires_auth('post:jobs')
+    @admit()
+    def resume_job(permission, job_id):
+
+        job = Job.query.get_or_404(job_id)
+        check_job_permission(job.type, permission)
+
+        if job.status not in RESUMABLE_STATUSES and not jobs.is_stale(job):
+            abort(409, f'Only {" or ".join(RESUMABLE_STATUSES)} or stale '
+                       'jobs resume.')
+
+        job.status = 'pending'
+        job.cancel_requested = False
+        job.error = None
+        job.update()
+        submit_job(job)
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        }), 202
+
+    # -----------------------
+    # EXPORTS
+    # -----------------------
+
+    @app.route('/export/chemicals.<any(arrow, parquet):export_format>',
+               methods=['GET'])
+    @requires_auth('get:chemicals')
+    @admit(weight=16, limit=2)
+    def export_chemicals(permission, export_format):
+        return export_response(
+            'chemicals', export.chemicals_export, export_format)
+
+    @app.route('/export/memberships.<any(arrow, parquet):export_format>',
+               methods=['GET'])
+    @requires_auth('get:inventories')
+    @admit(weight=16, limit=2)
+    def export_memberships(permission, export_format):
+        return export_response(
+            'memberships', export.memberships_export, export_format)
+
     # -----------------------
     # ERROR HANDLERS
     # -----------------------
@@ -320,6 +976,22 @@ def create_app(test_config=None):
             "message": error.description
         }), error.code
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code
+
     @app.errorhandler(422)
     def unprocessable_request(error):
         return jsonify({
@@ -328,6 +1000,14 @@ def create_app(test_config=None):
             "message": error.description
         }), error.code
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code, retry_after_header(error)
+
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({
@@ -336,6 +1016,22 @@ def create_app(test_config=None):
             "message": error.description
         }), error.code
 
+    @app.errorhandler(501)
+    def not_implemented(error):
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": error.code,
+            "message": error.description
+        }), error.code, retry_after_header(error)
+
     return app
 
 
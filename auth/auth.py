@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 from types import resolve_bases
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
@@ -10,6 +12,21 @@ AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = os.getenv('ALGORITHMS')
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+# The issuer's signing keys are fetched once per process; a token naming
+# an unknown kid (keys were rotated) triggers a refetch, at most this often
+JWKS_REFRESH_SECONDS = 300
+
+JWKS_URL = os.getenv(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# Seconds a key set fetch may take. Requests needing keys that cannot be
+# fetched fail with 503 rather than wait, and for this long after a failed
+# fetch no other is tried.
+JWKS_TIMEOUT = float(os.getenv('JWKS_TIMEOUT', 5))
+
+jwks_cache = {}
+jwks_lock = threading.Lock()
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -67,9 +84,51 @@ def check_permissions(permission, payload):
     return True
 
 
+def load_jwks(jwks):
+    """Installs the key set tokens are verified against"""
+    jwks_cache['jwks'] = jwks
+    jwks_cache['fetched_at'] = time.monotonic()
+
+
+def _needs_fetch(kid):
+    jwks = jwks_cache.get('jwks')
+    return jwks is None or (
+        kid is not None
+        and all(key['kid'] != kid for key in jwks['keys'])
+        and time.monotonic() - jwks_cache['fetched_at']
+        > JWKS_REFRESH_SECONDS)
+
+
+def fetch_jwks():
+    """Fetches the issuer's key set; the socket yields under green workers"""
+    with urlopen(JWKS_URL, timeout=JWKS_TIMEOUT) as response:
+        load_jwks(json.loads(response.read()))
+
+
+def get_jwks(kid=None):
+    """Cached JSON Web Key Set, refetched if it doesn't hold kid"""
+    if _needs_fetch(kid):
+        # One fetch at a time: requests arriving meanwhile get its result
+        with jwks_lock:
+            failed_at = jwks_cache.get('failed_at')
+            recently_failed = failed_at is not None and \
+                time.monotonic() - failed_at < JWKS_TIMEOUT
+            if _needs_fetch(kid) and not recently_failed:
+                try:
+                    fetch_jwks()
+                    jwks_cache.pop('failed_at', None)
+                except (OSError, ValueError):
+                    jwks_cache['failed_at'] = time.monotonic()
+
+    if 'jwks' not in jwks_cache:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys. Try again later.'
+        }, 503)
+    return jwks_cache['jwks']
+
+
 def verify_decode_jwt(token):
-    json_url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(json_url.read())
     unverified_header = jwt.get_unverified_header(token)
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -77,6 +136,8 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    jwks = get_jwks(unverified_header['kid'])
+    rsa_key = {}
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -0,0 +1,126 @@
+"""Contention benchmark: optimistic version checks vs row locks.
+
+Concurrent writers each edit inventories in a loop. An edit reads the row,
+spends --think-ms "handling the request", then writes it back:
+
+- optimistic: plain read, versioned UPDATE, retry on StaleDataError
+- pessimistic: SELECT ... FOR UPDATE, so the lock is held while thinking
+
+Run against a scratch database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.contention
+
+On a local PostgreSQL 16, two runs of each configuration (20 edits per
+writer, 5 ms think time):
+
+    --writers 16 --inventories 4
+      pessimistic  245-282 edits/s  mean 47-54 ms  p99 166-198 ms
+      optimistic   203-210 edits/s  mean 64-65 ms  p99 198-225 ms
+                   280-312 retries
+    --writers 16 --inventories 64
+      pessimistic  285-298 edits/s  mean 45-46 ms  p99  84-100 ms
+      optimistic   286-295 edits/s  mean 45 ms     p99 100-103 ms
+                   30-33 retries
+    --writers 8 --inventories 1
+      pessimistic  121-127 edits/s  mean 59-63 ms  p99 154-174 ms
+      optimistic   158-276 edits/s  mean 25-42 ms  p99  79-229 ms
+                   69-255 retries
+
+Version checks match row locks when writers rarely collide, and win when a
+few writers share one hot row: nobody sleeps holding a lock. Under heavy
+contention on a handful of rows they lose 15-25% to retries.
+"""
+import argparse
+import random
+import threading
+import time
+from sqlalchemy.orm.exc import StaleDataError
+from app import app
+from database.models import db, db_drop_and_create_all, Inventory
+
+
+def optimistic_edit(inventory_id, think, n):
+    retries = 0
+    while True:
+        inventory = Inventory.query.get(inventory_id)
+        time.sleep(think)
+        inventory.location = f'{inventory.location.split("#")[0]}#{n}'
+        try:
+            db.session.commit()
+            return retries
+        except StaleDataError:
+            db.session.rollback()
+            retries += 1
+
+
+def pessimistic_edit(inventory_id, think, n):
+    inventory = Inventory.query.filter(
+        Inventory.id == inventory_id).with_for_update().one()
+    time.sleep(think)
+    inventory.location = f'{inventory.location.split("#")[0]}#{n}'
+    db.session.commit()
+    return 0
+
+
+def run(edit, writers, edits, inventories, think):
+    latencies = []
+    retries = []
+    lock = threading.Lock()
+
+    def writer(index):
+        rows = random.Random(index)
+        with app.app_context():
+            for n in range(edits):
+                inventory_id = rows.randint(1, inventories)
+                start = time.perf_counter()
+                retried = edit(inventory_id, think, n)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    retries.append(retried)
+            db.session.remove()
+
+    threads = [threading.Thread(target=writer, args=(index,))
+               for index in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'edits/s': len(latencies) / elapsed,
+        'mean ms': 1000 * sum(latencies) / len(latencies),
+        'p99 ms': 1000 * latencies[int(len(latencies) * 0.99) - 1],
+        'retries': sum(retries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--edits', type=int, default=20)
+    parser.add_argument('--inventories', type=int, default=4,
+                        help='rows the writers contend on')
+    parser.add_argument('--think-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        for n in range(args.inventories - 1):
+            Inventory(location=f'site {n}', chemicals=[]).insert()
+
+    print(f'{args.writers} writers x {args.edits} edits on '
+          f'{args.inventories} inventories, {args.think_ms} ms think time')
+    for name, edit in (('optimistic', optimistic_edit),
+                       ('pessimistic', pessimistic_edit)):
+        result = run(edit, args.writers, args.edits, args.inventories,
+                     args.think_ms / 1000)
+        print(f'{name:12}' + '  '.join(
+            f'{key} {value:9.1f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark: single-row inserts per second, one commit each vs group commit.
+
+Runs --threads threads, each inserting --rows chemicals one at a time
+through server.groupcommit.GroupCommitter, the path of POST /chemicals:
+first with no window (every insert commits alone), then with each
+--windows value in ms (concurrent inserts share a commit).
+
+Run against a scratch PostgreSQL database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.groupcommit
+"""
+import argparse
+import itertools
+import threading
+import time
+from app import app
+from database.models import db, db_drop_and_create_all, Chemical
+from server.groupcommit import GroupCommitter
+
+names = itertools.count()
+
+
+def insert(session):
+    n = next(names)
+    chemical = Chemical(name=f'chemical {n}', smiles=f'C{n}', ld50=1.0)
+    session.add(chemical)
+    session.flush()
+    return chemical.format()
+
+
+def run(committer, threads, rows):
+    def client():
+        with app.app_context():
+            for _ in range(rows):
+                committer.run(insert)
+            db.session.remove()
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * rows / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--windows', default='2,5')
+    args = parser.parse_args()
+
+    if not (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith(
+            'postgres'):
+        raise SystemExit('Needs a PostgreSQL DATABASE_URL.')
+
+    with app.app_context():
+        db_drop_and_create_all()
+
+    print(f'{args.threads} threads x {args.rows} single-row inserts')
+    print(f'{"window (ms)":>12} {"rows/s":>10} {"rows/commit":>12}')
+    for window in [0] + [float(ms) for ms in args.windows.split(',')]:
+        committer = GroupCommitter(app, window=window / 1000)
+        rate = run(committer, args.threads, args.rows)
+        per_commit = committer.stats()['writes_per_batch'] or 1
+        print(f'{window:12g} {rate:10.0f} {per_commit:12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark: hazard analytics, SQL vs the in-memory hazard engine.
+
+Fills --chemicals chemicals and --inventories inventories of --members
+random members each, then times, in the database and with
+database.hazards.hazard_engine:
+
+  - every inventory's mean hazard (GROUP BY over the association table)
+  - a what-if: every affected inventory's mean hazard with one chemical's
+    ld50 revised (UPDATE, recompute the holders, read, roll back)
+
+Run against a scratch database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.hazards
+"""
+import argparse
+import random
+import time
+from sqlalchemy import func, select
+from app import app
+from database.models import db, db_drop_and_create_all, Chemical, Inventory, association_table
+from database.hazards import hazard_engine
+
+
+def fill(chemicals, inventories, members, chunk_size=10000):
+    rows = random.Random(0)
+    for start in range(0, chemicals, chunk_size):
+        db.session.execute(Chemical.__table__.insert(), [{
+            'name': f'chemical {n}',
+            'smiles': f'C{n}',
+            'ld50': ld50,
+            'hazard': Chemical.hazard_for(ld50),
+        } for n in range(start, min(start + chunk_size, chemicals))
+            for ld50 in [rows.uniform(1, 500)]])
+    db.session.execute(Inventory.__table__.insert(), [
+        {'location': f'site {n}'} for n in range(inventories)])
+    db.session.commit()
+
+    first_chemical = db.session.query(func.min(Chemical.id)).scalar()
+    inventory_ids = [id for id, in db.session.query(Inventory.id)]
+    pairs = [{'inventory_id': inventory_id, 'chemical_id': first_chemical + n}
+             for inventory_id in inventory_ids
+             for n in rows.sample(range(chemicals), members)]
+    for start in range(0, len(pairs), chunk_size):
+        db.session.execute(
+            association_table.insert(), pairs[start:start + chunk_size])
+    db.session.commit()
+
+
+def timed(f, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        f()
+    return 1000 * (time.perf_counter() - start) / iterations
+
+
+def sql_means():
+    return db.session.execute(select([
+        association_table.c.inventory_id, func.avg(Chemical.hazard)]).where(
+        association_table.c.chemical_id == Chemical.id).group_by(
+        association_table.c.inventory_id)).fetchall()
+
+
+def sql_what_if(chemical_id, ld50):
+    holders = select([association_table.c.inventory_id]).where(
+        association_table.c.chemical_id == chemical_id)
+    db.session.execute(Chemical.__table__.update().where(
+        Chemical.id == chemical_id).values(
+        ld50=ld50, hazard=Chemical.hazard_for(ld50)))
+    Inventory.refresh_average_hazard(Inventory.id.in_(holders))
+    rows = db.session.execute(select([
+        Inventory.id, Inventory.average_hazard]).where(
+        Inventory.id.in_(holders))).fetchall()
+    db.session.rollback()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chemicals', type=int, default=100000)
+    parser.add_argument('--inventories', type=int, default=2000)
+    parser.add_argument('--members', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        fill(args.chemicals, args.inventories, args.members)
+
+        start = time.perf_counter()
+        hazard_engine.sync(db.session)
+        print(f'engine load {time.perf_counter() - start:.2f} s')
+
+        chemical_id = db.session.query(func.max(Chemical.id)).scalar()
+        print(f'{args.inventories} inventories x {args.members} members, '
+              f'{args.chemicals} chemicals; ms per call')
+        print(f'{"":16} {"sql":>10} {"engine":>10}')
+        print(f'{"all means":16} '
+              f'{timed(sql_means, args.iterations):10.2f} '
+              f'{timed(hazard_engine.hazards, args.iterations):10.2f}')
+        print(f'{"what-if":16} '
+              f'{timed(lambda: sql_what_if(chemical_id, 1.0), args.iterations):10.2f} '
+              f'{timed(lambda: hazard_engine.what_if({chemical_id: 1.0}), args.iterations):10.2f}')
+
+
+if __name__ == '__main__':
+    main()
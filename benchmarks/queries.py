@@ -0,0 +1,94 @@
+"""Microbenchmark: ad-hoc ORM queries vs the baked query repository.
+
+Times the primary-key and membership lookups the handlers run on every
+request, built ad hoc (compiled to SQL on each call) and through
+database.queries (compiled once). CPU time per call is what the baked
+queries save; the database round trip is the same for both.
+
+Run against a scratch database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.queries
+"""
+import argparse
+import time
+from app import app
+from database import queries
+from database.models import db, db_drop_and_create_all, Chemical, Inventory
+from database.models import association_table
+
+
+def adhoc_get_chemical():
+    return Chemical.query.filter(Chemical.id == 1).one_or_none()
+
+
+def baked_get_chemical():
+    return queries.get_chemical(1)
+
+
+def adhoc_get_inventory():
+    return Inventory.query.filter(Inventory.id == 1).one_or_none()
+
+
+def baked_get_inventory():
+    return queries.get_inventory(1)
+
+
+def adhoc_chemical_ids():
+    return [chemical_id for chemical_id, in db.session.query(
+        association_table.c.chemical_id).filter(
+        association_table.c.inventory_id == 1).order_by(
+        association_table.c.chemical_id)]
+
+
+def baked_chemical_ids():
+    return queries.inventory_chemical_ids(1)
+
+
+def adhoc_all_chemicals():
+    return Chemical.query.order_by(Chemical.id).all()
+
+
+def baked_all_chemicals():
+    return queries.all_chemicals()
+
+
+CASES = (
+    ('get chemical', adhoc_get_chemical, baked_get_chemical),
+    ('get inventory', adhoc_get_inventory, baked_get_inventory),
+    ('member ids', adhoc_chemical_ids, baked_chemical_ids),
+    ('all chemicals', adhoc_all_chemicals, baked_all_chemicals),
+)
+
+
+def measure(f, iterations):
+    # Every call starts from an empty identity map, as a request would
+    cpu = 0.0
+    for _ in range(iterations):
+        db.session.expunge_all()
+        start = time.process_time()
+        f()
+        cpu += time.process_time() - start
+    return 1e6 * cpu / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        for _, adhoc, baked in CASES:
+            adhoc()
+            baked()
+
+        print(f'CPU us per call over {args.iterations} calls')
+        for name, adhoc, baked in CASES:
+            adhoc_us = measure(adhoc, args.iterations)
+            baked_us = measure(baked, args.iterations)
+            print(f'{name:14} ad hoc {adhoc_us:8.1f}  baked {baked_us:8.1f}'
+                  f'  saved {adhoc_us - baked_us:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
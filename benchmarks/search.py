@@ -0,0 +1,71 @@
+"""Benchmark: fuzzy name search latency.
+
+Fills chemicals with synthetic names and times GET /chemicals/search's
+lookup, database.search.search_names: pg_trgm on PostgreSQL with the
+extension, the in-process trigram index otherwise.
+
+Run against a scratch database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.search
+"""
+import argparse
+import random
+import time
+from app import app
+from database.models import db, db_drop_and_create_all, Chemical
+from database.search import name_index, search_names, has_pg_trgm
+
+FRAGMENTS = (
+    'methyl', 'ethyl', 'propyl', 'butyl', 'chloro', 'bromo', 'fluoro',
+    'hydroxy', 'amino', 'nitro', 'benz', 'phen', 'acet', 'ol', 'one', 'ane',
+    'ene', 'yne', 'ic acid', 'amide', 'ate', 'ide', 'cyclo', 'iso', 'tert',
+    'di', 'tri', 'tetra', 'oxy', 'carb')
+
+QUERIES = ('acetome', 'ethr', 'methylbenzoate', 'chlorophenol', 'tert butyl')
+
+
+def insert_names(count, chunk_size=10000):
+    rows = random.Random(0)
+    for start in range(0, count, chunk_size):
+        db.session.execute(Chemical.__table__.insert(), [{
+            'name': ''.join(rows.choice(FRAGMENTS)
+                            for _ in range(rows.randint(2, 5))) + f' {n}',
+            'smiles': f'C{n}',
+            'ld50': 1.0,
+            'hazard': 2.0,
+        } for n in range(start, min(start + chunk_size, count))])
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        insert_names(args.names)
+
+        if db.engine.dialect.name == 'postgresql' and \
+                has_pg_trgm(db.session):
+            backend = 'pg_trgm'
+        else:
+            backend = 'in-process index'
+            start = time.perf_counter()
+            name_index.sync(db.session)
+            print(f'index load {time.perf_counter() - start:.1f} s')
+
+        print(f'{backend}, {args.names} names, ms per search '
+              f'over {args.iterations} searches')
+        for q in QUERIES:
+            search_names(q)
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                matches = search_names(q)
+            elapsed = (time.perf_counter() - start) / args.iterations
+            print(f'{q:16} {1000 * elapsed:8.1f}  {len(matches)} matches')
+
+
+if __name__ == '__main__':
+    main()
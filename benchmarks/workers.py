@@ -0,0 +1,195 @@
+"""Benchmark: concurrent requests per gunicorn worker, sync vs green.
+
+Starts one gunicorn worker per worker class and locks the inventories
+table, so every GET /inventories/{id} waits in the database. It then sends
+--clients such requests at once and, while they wait, counts how many
+reached the database and times a request that needs no database.
+
+A sync worker gets one request to the database and cannot answer anything
+else until the lock goes. A green worker (with the psycopg2 wait callback)
+gets them all there, up to its pool, and keeps serving. Tokens are signed
+by a key generated here and served from a local JWKS endpoint.
+
+Run against a scratch PostgreSQL database, it is recreated:
+
+    DATABASE_URL=postgresql://... python -m benchmarks.workers
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwk, jwt
+from sqlalchemy import create_engine, text
+
+KEY_ID = 'benchmark-key'
+AUDIENCE = 'chemical'
+DOMAIN = 'benchmark.test'
+
+
+def serve_jwks(public_key):
+    """Serves the key set on a local port; returns its URL"""
+    body = json.dumps({'keys': [dict(
+        jwk.construct(public_key.save_pkcs1(), 'RS256').to_dict(),
+        kid=KEY_ID,
+        use='sig')]}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/jwks.json'
+
+
+def mint_token(private_key):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': f'https://{DOMAIN}/',
+        'sub': 'benchmark',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + 3600,
+        'permissions': ['get:inventories'],
+    }, private_key.save_pkcs1().decode(), algorithm='RS256',
+        headers={'kid': KEY_ID})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get(url, token=None, timeout=60):
+    request = urllib.request.Request(url)
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+    except OSError:
+        return None
+
+
+def start_worker(worker_class, port, env):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        env=dict(env, WORKER_CLASS=worker_class, WEB_CONCURRENCY='1'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while get(f'http://127.0.0.1:{port}/', timeout=1) != 200:
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise SystemExit(f'gunicorn -k {worker_class} did not start.')
+        time.sleep(0.2)
+    return process
+
+
+def run(worker_class, engine, env, token, clients, hold):
+    port = free_port()
+    process = start_worker(worker_class, port, env)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        statuses = []
+        with engine.connect() as locker:
+            transaction = locker.begin()
+            locker.execute(text(
+                'LOCK TABLE inventories IN ACCESS EXCLUSIVE MODE'))
+            pid = locker.execute(text('SELECT pg_backend_pid()')).scalar()
+
+            # Distinct query strings, so requests are not coalesced
+            threads = [threading.Thread(target=lambda n=n: statuses.append(
+                get(f'{base}/inventories/1?n={n}', token)))
+                for n in range(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+
+            time.sleep(hold / 2)
+            probe_start = time.perf_counter()
+            probe = threading.Thread(target=get, args=(f'{base}/',))
+            probe.start()
+            probe.join(hold / 2)
+            probe_blocked = probe.is_alive()
+            probe_ms = 1000 * (time.perf_counter() - probe_start)
+            time.sleep(max(0, hold - (time.perf_counter() - start)))
+
+            waiting = locker.execute(text(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE wait_event_type = 'Lock' AND pid != :pid"),
+                pid=pid).scalar()
+            transaction.commit()
+
+        for thread in threads:
+            thread.join()
+        probe.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+    ok = sum(status == 200 for status in statuses)
+    probe = f'>{probe_ms:.0f}' if probe_blocked else f'{probe_ms:.0f}'
+    print(f'{worker_class:10} {waiting:10} {probe:>12} {ok:>4}/{clients:<4} '
+          f'{elapsed:8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker-classes', default='sync,eventlet,gevent')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--hold', type=float, default=2.0,
+                        help='Seconds the inventories table stays locked')
+    args = parser.parse_args()
+
+    database_url = os.environ['DATABASE_URL']
+    if not database_url.startswith('postgres'):
+        raise SystemExit('Needs a PostgreSQL DATABASE_URL.')
+
+    public_key, private_key = rsa.newkeys(2048)
+    env = dict(
+        os.environ,
+        AUTH0_DOMAIN=DOMAIN,
+        ALGORITHMS='RS256',
+        API_AUDIENCE=AUDIENCE,
+        JWKS_URL=serve_jwks(public_key),
+        # Measure the worker, not admission control
+        ADMISSION_CAPACITY=str(10 * args.clients),
+        DB_POOL_SIZE=str(args.clients))
+    os.environ.update(env)
+
+    from app import app
+    from database.models import db_drop_and_create_all
+    with app.app_context():
+        db_drop_and_create_all()
+    engine = create_engine(database_url)
+    token = mint_token(private_key)
+
+    print(f'{args.clients} concurrent GET /inventories/1, table locked '
+          f'{args.hold} s')
+    print(f'{"worker":10} {"in the db":>10} {"GET / (ms)":>12} {"ok":>9} '
+          f'{"total (s)":>8}')
+    for worker_class in args.worker_classes.split(','):
+        run(worker_class, engine, env, token, args.clients, args.hold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from flask import g
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import Column, String, Integer, DDL, event, select
+from sqlalchemy.exc import SQLAlchemyError
+from database.models import db, Chemical
+from database import queries
+
+CACHE_NAME = 'chemicals'
+
+# The cache's generation is split by chemical id % CACHE_BUCKETS, so a write
+# invalidates only its buckets' entries in other workers
+CACHE_BUCKETS = 64
+BUCKET_NAMES = tuple(f'{CACHE_NAME}/{bucket}' for bucket in range(CACHE_BUCKETS))
+BUCKETS = {name: bucket for bucket, name in enumerate(BUCKET_NAMES)}
+
+# One row per worker-local structure (or cache bucket), bumped after every
+# write to it commits, so that workers can tell their copy may be stale.
+cache_generations = db.Table(
+    'cache_generations',
+    Column('name', String, primary_key=True),
+    Column('value', Integer, nullable=False))
+
+event.listen(cache_generations, 'after_create', DDL(
+    "INSERT INTO cache_generations (name, value) VALUES " +
+    ', '.join(f"('{name}', 0)" for name in BUCKET_NAMES)))
+
+logger = logging.getLogger(__name__)
+
+
+def read_generations(session, names):
+    """{name: generation} of the names"""
+    return dict(session.execute(select([
+        cache_generations.c.name, cache_generations.c.value]).where(
+        cache_generations.c.name.in_(names))).fetchall())
+
+
+def bump_generations(connection, names):
+    """Bumps the generations of names; returns {name: new generation}.
+
+    Their rows are locked in name order, so concurrent bumps of
+    overlapping names cannot deadlock.
+    """
+    names = sorted(names)
+    locked = select([cache_generations.c.name]).where(
+        cache_generations.c.name.in_(names)).order_by(
+        cache_generations.c.name).with_for_update()
+    connection.execute(cache_generations.update().where(
+        cache_generations.c.name.in_(locked)).values(
+        value=cache_generations.c.value + 1))
+    return read_generations(connection, names)
+
+
+def advanced_generation(generation, committed):
+    """The generation a worker-local structure at generation reaches with
+    a commit that bumped it once to committed, or None if another worker
+    bumped it meanwhile or the bump failed (the structure must reload)"""
+    if generation is not None and committed is not None and \
+            generation + 1 == committed:
+        return committed
+    return None
+
+
+# -------------------
+# PENDING CHANGES
+# -------------------
+
+# Key -> (factory of an empty record, apply(record, generations) on commit)
+_TRACKED = {}
+
+
+def track_changes(key, new, apply):
+    """Registers a worker-local structure kept in step with writes.
+
+    Writes are recorded in a session's transaction under key, in a record
+    made by new() plus the generation names to 'bumps'. When the session
+    commits, the generations are bumped and apply(record, {name: new
+    generation}) runs; the record is dropped when it rolls back.
+    """
+    _TRACKED[key] = (new, apply)
+
+
+def pending_changes(session, key):
+    """The record of key's writes in the session's transaction"""
+    records = session.info.setdefault('pending_changes', {})
+    if key not in records:
+        new, _ = _TRACKED[key]
+        records[key] = dict(new(), bumps=set())
+    return records[key]
+
+
+def bump_pending(session, pending, *names):
+    """Marks generations to bump for other workers once the session
+    commits"""
+    pending['bumps'].update(names)
+
+
+def _bump_committed(session, names):
+    """Bumps names in a short transaction of its own, after the writer's
+    committed: cache_generations rows are locked only that long instead of
+    for the whole write. Until it commits, other workers may still serve
+    what the write replaced."""
+    try:
+        with session.get_bind().connect() as connection:
+            with connection.begin():
+                return bump_generations(connection, names)
+    except SQLAlchemyError:
+        # The write is committed; only other workers' copies lag behind
+        logger.exception('Could not bump generations %s', sorted(names))
+        return {}
+
+
+def _committed(session):
+    """Whether the transaction committing makes its writes visible: the
+    outermost one, or for a session working inside an external transaction
+    (info['external_transaction'], as tests do) the SAVEPOINT below it"""
+    transaction = session.transaction
+    if not transaction.nested:
+        return True
+    return session.info.get('external_transaction', False) and \
+        transaction.parent.parent is None
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _after_commit(session):
+    if not _committed(session):
+        return
+    records = session.info.pop('pending_changes', {})
+    names = set().union(*(pending['bumps'] for pending in records.values()))
+    generations = _bump_committed(session, names) if names else {}
+    for key, pending in records.items():
+        _, apply = _TRACKED[key]
+        apply(pending, generations)
+
+
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # A rolled back outermost transaction discards its writes. SAVEPOINT
+    # rollbacks keep them: at worst that over-invalidates.
+    if transaction.parent is None:
+        session.info.pop('pending_changes', None)
+
+
+class ChemicalCache:
+    """Bounded LRU of serialized chemicals, shared by a worker's requests.
+
+    Entries hold every field of Chemical.FIELDS. Local writes invalidate
+    their ids on commit; writes from other workers are caught by comparing
+    the generations of the cache's buckets once per request, dropping the
+    entries of the buckets that moved.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bucket -> generation the entries are current with
+        self.generations = {}
+        # Incremented on every invalidation so in-flight loads that raced
+        # a write are not stored
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def sync(self):
+        """Drops the buckets another worker changed chemicals in.
+
+        Runs at most once per request.
+        """
+        if g.get('chemical_cache_synced'):
+            return
+        g.chemical_cache_synced = True
+
+        generations = {
+            BUCKETS[name]: generation for name, generation
+            in read_generations(db.session, BUCKET_NAMES).items()}
+        with self.lock:
+            moved = {bucket for bucket, generation in generations.items()
+                     if self.generations.get(bucket) != generation}
+            if moved:
+                self._drop_buckets(moved)
+                self.generations.update(generations)
+
+    def _drop_buckets(self, buckets):
+        stale = [id for id in self.entries if id % CACHE_BUCKETS in buckets]
+        for chemical_id in stale:
+            del self.entries[chemical_id]
+        self.invalidations += len(stale)
+        self.epoch += 1
+
+    def get_many(self, chemical_ids):
+        """Returns {id: serialized chemical} for the ids that exist"""
+        if g.get('snapshot_session') is not None:
+            # Snapshot rows may predate writes the cache has seen: read
+            # them straight through
+            fields = tuple(Chemical.FIELDS)
+            return {chemical.id: chemical.format_full(fields) for chemical
+                    in queries.get_chemicals(chemical_ids, fields)}
+
+        self.sync()
+
+        found = {}
+        with self.lock:
+            epoch = self.epoch
+            for chemical_id in chemical_ids:
+                data = self.entries.get(chemical_id)
+                if data is not None:
+                    self.entries.move_to_end(chemical_id)
+                    found[chemical_id] = data
+            self.hits += len(found)
+            missing = [id for id in chemical_ids if id not in found]
+            self.misses += len(missing)
+
+        if missing:
+            fields = tuple(Chemical.FIELDS)
+            chemicals = queries.get_chemicals(missing, fields)
+            loaded = {chemical.id: chemical.format_full(fields)
+                      for chemical in chemicals}
+            found.update(loaded)
+            self.put(loaded, epoch)
+
+        return found
+
+    def get(self, chemical_id):
+        return self.get_many([chemical_id]).get(chemical_id)
+
+    def put(self, loaded, epoch):
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.entries.update(loaded)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, chemical_ids=None, bumped=None):
+        """Drops chemical_ids, or everything when chemical_ids is None.
+
+        bumped maps the buckets a local commit bumped to their new
+        generation; the others keep theirs.
+        """
+        with self.lock:
+            if chemical_ids is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            else:
+                for chemical_id in chemical_ids:
+                    if self.entries.pop(chemical_id, None) is not None:
+                        self.invalidations += 1
+            self.epoch += 1
+            if bumped is None:
+                self.generations.clear()
+                return
+            for bucket, generation in bumped.items():
+                self.generations[bucket] = advanced_generation(
+                    self.generations.get(bucket), generation)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+chemical_cache = ChemicalCache(int(os.getenv('CHEMICAL_CACHE_SIZE', 10000)))
+
+
+# -------------------
+# INVALIDATION
+# -------------------
+
+
+def mark_chemicals_changed(session, chemical_ids=None):
+    """Records a chemical write the ORM cannot see (e.g. core statements).
+
+    When the session commits, the local entries are dropped and the
+    generations of their buckets bumped. None means every chemical.
+    """
+    pending = pending_changes(session, CACHE_NAME)
+    if chemical_ids is None:
+        pending['clear'] = True
+        bump_pending(session, pending, *BUCKET_NAMES)
+    else:
+        pending['ids'].update(chemical_ids)
+        bump_pending(session, pending, *{
+            BUCKET_NAMES[id % CACHE_BUCKETS] for id in chemical_ids})
+
+
+def _apply(pending, generations):
+    chemical_cache.invalidate(
+        None if pending['clear'] else pending['ids'],
+        {BUCKETS[name]: generations.get(name)
+         for name in pending['bumps']})
+
+
+track_changes(CACHE_NAME, lambda: {'ids': set(), 'clear': False}, _apply)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    # New rows cannot be cached anywhere yet, so only changes count
+    chemical_ids = [
+        obj.id for obj in session.dirty | session.deleted
+        if isinstance(obj, Chemical)]
+    if chemical_ids:
+        mark_chemicals_changed(session, chemical_ids)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+def _after_bulk_update(update_context):
+    if update_context.mapper is Chemical.__mapper__:
+        mark_chemicals_changed(update_context.session)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_delete')
+def _after_bulk_delete(delete_context):
+    if delete_context.mapper is Chemical.__mapper__:
+        mark_chemicals_changed(delete_context.session)
@@ -0,0 +1,83 @@
+from datetime import datetime
+from sqlalchemy import select, and_
+from database.models import db, Chemical, Inventory, association_table
+from database.cache import mark_chemicals_changed
+from database.indexes import INDEXES, mark_index_changed
+from database.hazards import mark_memberships_changed
+
+chemicals = Chemical.__table__
+inventories = Inventory.__table__
+
+# Set-based deletes: a fixed number of DELETE ... WHERE statements however
+# many rows go, where the ORM would load every chemical in an inventory and
+# delete it, and its association rows, one by one.
+
+
+def _delete_chemicals(session, member_ids, chemical_ids, inventory_ids=()):
+    """Deletes the chemicals in member_ids (a list or subquery of ids), and
+    their memberships outside inventory_ids, which the caller deletes"""
+    held = association_table.c.chemical_id.in_(member_ids)
+    if inventory_ids:
+        held = and_(held, ~association_table.c.inventory_id.in_(inventory_ids))
+
+    # Inventories losing members, found while the association rows exist
+    holders = [id for id, in session.execute(
+        select([association_table.c.inventory_id]).where(held).distinct())]
+    if holders:
+        session.execute(association_table.delete().where(held))
+
+    session.execute(chemicals.delete().where(chemicals.c.id.in_(member_ids)))
+
+    # Losing a member is a membership edit: it bumps the version too
+    if holders:
+        Inventory.refresh_average_hazard(
+            Inventory.id.in_(holders), session,
+            version=Inventory.version + 1,
+            updated_on=datetime.now())
+
+    mark_chemicals_changed(session, chemical_ids)
+    for name in INDEXES:
+        mark_index_changed(session, name, dict.fromkeys(chemical_ids))
+
+
+def delete_chemicals(chemical_ids, session=None):
+    """Deletes chemicals by id; returns the ids that existed.
+
+    Inventories holding them lose them and get average_hazard recomputed
+    in the same transaction. The caller commits.
+    """
+    session = session or db.session
+    chemical_ids = [id for id, in session.execute(
+        select([chemicals.c.id]).where(chemicals.c.id.in_(chemical_ids)))]
+    if chemical_ids:
+        _delete_chemicals(session, chemical_ids, chemical_ids)
+    return chemical_ids
+
+
+def delete_inventories(inventory_ids, session=None):
+    """Deletes inventories by id with their member chemicals; returns
+    (inventory ids that existed, chemical ids deleted).
+
+    Member chemicals are selected by subquery, so the statements do not
+    grow with the inventories. Their rows in the deleted inventories go by
+    ON DELETE CASCADE where foreign keys are enforced, and by an explicit
+    DELETE otherwise. The caller commits.
+    """
+    session = session or db.session
+    inventory_ids = [id for id, in session.execute(
+        select([inventories.c.id]).where(inventories.c.id.in_(inventory_ids)))]
+    if not inventory_ids:
+        return [], []
+
+    members = select([association_table.c.chemical_id]).where(
+        association_table.c.inventory_id.in_(inventory_ids))
+    chemical_ids = [id for id, in session.execute(members.distinct())]
+    if chemical_ids:
+        _delete_chemicals(session, members, chemical_ids, inventory_ids)
+
+    session.execute(association_table.delete().where(
+        association_table.c.inventory_id.in_(inventory_ids)))
+    session.execute(inventories.delete().where(
+        inventories.c.id.in_(inventory_ids)))
+    mark_memberships_changed(session, dict.fromkeys(inventory_ids))
+    return inventory_ids, chemical_ids
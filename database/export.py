@@ -0,0 +1,118 @@
+import io
+from flask import g
+from sqlalchemy import select
+from database.models import db, Chemical, association_table
+
+# pyarrow is optional; without it the export routes answer 501
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+CHUNK_SIZE = 50000
+
+MIMETYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def available(export_format):
+    """Whether the installed pyarrow can write export_format"""
+    if export_format == 'parquet':
+        return pq is not None
+    return pa is not None
+
+
+def chemicals_export():
+    """Statement and arrow schema for the chemicals table"""
+    statement = select([
+        Chemical.id,
+        Chemical.name,
+        Chemical.smiles,
+        Chemical.ld50,
+        Chemical.hazard,
+        Chemical.created_on,
+        Chemical.updated_on,
+    ]).order_by(Chemical.id)
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('name', pa.string()),
+        ('smiles', pa.string()),
+        ('ld50', pa.float64()),
+        ('hazard', pa.float64()),
+        ('created_on', pa.timestamp('us')),
+        ('updated_on', pa.timestamp('us')),
+    ])
+    return statement, schema
+
+
+def memberships_export():
+    """Statement and arrow schema for the inventory/chemical association"""
+    statement = select([
+        association_table.c.inventory_id,
+        association_table.c.chemical_id,
+    ]).order_by(
+        association_table.c.inventory_id,
+        association_table.c.chemical_id)
+    schema = pa.schema([
+        ('inventory_id', pa.int64()),
+        ('chemical_id', pa.int64()),
+    ])
+    return statement, schema
+
+
+def iter_record_batches(statement, schema, chunk_size=CHUNK_SIZE):
+    """Yields record batches built from a server-side cursor, chunk by chunk"""
+    # From the read snapshot when it serves the request
+    snapshot_session = g.get('snapshot_session')
+    if snapshot_session is not None:
+        connection = snapshot_session.get_bind().connect()
+    else:
+        connection = db.engine.connect()
+    try:
+        result = connection.execution_options(
+            stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = zip(*rows)
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type)
+                 for column, field in zip(columns, schema)],
+                schema=schema)
+    finally:
+        connection.close()
+
+
+def _drain(sink):
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def stream(statement, schema, export_format, chunk_size=CHUNK_SIZE):
+    """Yields the encoded export as it is written, one chunk at a time"""
+    sink = io.BytesIO()
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    try:
+        for batch in iter_record_batches(statement, schema, chunk_size):
+            writer.write_batch(batch)
+            data = _drain(sink)
+            if data:
+                yield data
+    finally:
+        writer.close()
+
+    yield _drain(sink)
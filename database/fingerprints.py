@@ -0,0 +1,23 @@
+import zlib
+
+# Fixed-width structural fingerprint of a SMILES string: every substring
+# of NGRAM_SIZES characters (with start/end markers) is hashed to one of
+# FINGERPRINT_BITS bits. A rough stand-in for a chemistry toolkit's
+# substructure fingerprint, but deterministic and dependency free.
+FINGERPRINT_BITS = 1024
+FINGERPRINT_BYTES = FINGERPRINT_BITS // 8
+NGRAM_SIZES = (1, 2, 3, 4)
+
+
+def fingerprint(smiles):
+    """Packed fingerprint bits of smiles (FINGERPRINT_BYTES), or None"""
+    if not smiles:
+        return None
+
+    bits = bytearray(FINGERPRINT_BYTES)
+    text = f'^{smiles}$'.encode()
+    for size in NGRAM_SIZES:
+        for start in range(len(text) - size + 1):
+            bit = zlib.crc32(text[start:start + size]) % FINGERPRINT_BITS
+            bits[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bits)
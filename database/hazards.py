@@ -0,0 +1,305 @@
+import numpy as np
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import DDL, event, inspect, select
+from database.models import db, Chemical, Inventory, association_table
+from database.cache import cache_generations, advanced_generation, track_changes, pending_changes, bump_pending
+from database.indexes import ChemicalIndex
+
+# Generation of the association table, bumped by every membership write
+MEMBERSHIPS = 'memberships'
+
+event.listen(cache_generations, 'after_create', DDL(
+    f"INSERT INTO cache_generations (name, value) VALUES ('{MEMBERSHIPS}', 0)"))
+
+# Most inventories one hazards query returns
+MAX_RESULTS = 10000
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def _csr(inventory_ids, pair_inventories, pair_chemicals):
+    """(indptr, indices) of the inventories x chemical ids membership
+    matrix; inventory_ids is sorted and holds every pair's inventory"""
+    order = np.lexsort((pair_chemicals, pair_inventories))
+    indptr = np.zeros(len(inventory_ids) + 1, dtype=np.int64)
+    indptr[1:] = np.searchsorted(
+        pair_inventories[order], inventory_ids, side='right')
+    return indptr, pair_chemicals[order]
+
+
+class HazardEngine(ChemicalIndex):
+    """Hazards of every chemical and the membership of every inventory in
+    NumPy arrays, answering aggregates over all inventories at once.
+
+    The stored hazard column, the one average_hazard is computed from,
+    lives in an array indexed by chemical id (NaN where there is no
+    chemical), kept in sync as a ChemicalIndex. Memberships are a CSR
+    matrix, one row per inventory id and its member chemical ids in
+    indices; a row's mean hazard is the mean of hazard[indices] over it.
+    Membership writes are recorded per inventory on commit and folded into
+    the matrix on the next query; other workers' writes bump the
+    'memberships' generation, which reloads it.
+    """
+
+    column = Chemical.__table__.c.hazard
+    generations = (MEMBERSHIPS,)
+
+    def __init__(self, capacity=1024):
+        self.hazard = np.full(capacity, np.nan)
+        self.count = 0
+        self.inventory_ids = EMPTY
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = EMPTY
+        self.rows = EMPTY
+        self.edits = {}
+        self.removed = set()
+        self.memberships_loaded = False
+        self.memberships_generation = None
+        self.membership_loads = 0
+        self.membership_updates = 0
+        self.queries = 0
+        super().__init__('hazards')
+
+    # Chemicals, under self.lock
+
+    def _reset(self):
+        self.hazard[:] = np.nan
+        self.count = 0
+        self.memberships_loaded = False
+
+    def _set(self, chemical_id, hazard):
+        if chemical_id >= len(self.hazard):
+            grown = np.full(
+                max(2 * len(self.hazard), chemical_id + 1), np.nan)
+            grown[:len(self.hazard)] = self.hazard
+            self.hazard = grown
+        if np.isnan(self.hazard[chemical_id]):
+            self.count += 1
+        self.hazard[chemical_id] = hazard
+        # A reused id must not inherit the memberships of the deleted row
+        if chemical_id in self.removed:
+            self.memberships_loaded = False
+
+    def _remove(self, chemical_id):
+        if chemical_id < len(self.hazard) and \
+                not np.isnan(self.hazard[chemical_id]):
+            self.hazard[chemical_id] = np.nan
+            self.count -= 1
+            self.removed.add(chemical_id)
+
+    def __len__(self):
+        return self.count
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+            self.memberships_loaded = False
+
+    # Memberships
+
+    def _load_memberships(self, inventory_ids, pairs):
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        self.inventory_ids = np.array(inventory_ids, dtype=np.int64)
+        self.indptr, self.indices = _csr(
+            self.inventory_ids, pairs[:, 0], pairs[:, 1])
+        self.rows = np.repeat(
+            np.arange(len(self.inventory_ids)), np.diff(self.indptr))
+        self.edits.clear()
+        self.removed.clear()
+
+    def _fold(self):
+        """Folds recorded membership edits and deleted chemicals into the
+        matrix, with vectorized operations over its stored entries"""
+        if not self.edits and not self.removed:
+            return
+
+        pair_inventories = self.inventory_ids[self.rows]
+        pair_chemicals = self.indices
+        keep = ~np.isin(pair_inventories, list(self.edits))
+        pair_inventories = pair_inventories[keep]
+        pair_chemicals = pair_chemicals[keep]
+
+        deleted = [id for id, members in self.edits.items() if members is None]
+        edited = {id: members for id, members in self.edits.items()
+                  if members is not None}
+        inventory_ids = np.union1d(
+            self.inventory_ids[~np.isin(self.inventory_ids, deleted)],
+            np.array(list(edited), dtype=np.int64))
+        pair_inventories = np.concatenate([pair_inventories] + [
+            np.full(len(members), id, dtype=np.int64)
+            for id, members in edited.items()])
+        pair_chemicals = np.concatenate(
+            [pair_chemicals] + list(edited.values()))
+
+        keep = ~np.isin(pair_chemicals, list(self.removed))
+        self._load_memberships(inventory_ids, np.column_stack(
+            (pair_inventories[keep], pair_chemicals[keep])))
+
+    def apply_memberships(self, values, generation):
+        """Applies committed membership writes: {inventory id: member
+        chemical ids, or None if deleted}, which bumped the memberships
+        generation to generation"""
+        with self.lock:
+            if not self.memberships_loaded:
+                return
+            for inventory_id, members in values.items():
+                self.edits[inventory_id] = None if members is None \
+                    else np.array(sorted(members), dtype=np.int64)
+            self.membership_updates += len(values)
+
+            self.memberships_generation = advanced_generation(
+                self.memberships_generation, generation)
+            self.memberships_loaded = self.memberships_generation is not None
+
+    def sync(self, session):
+        generation = super().sync(session).get(MEMBERSHIPS)
+        with self.lock:
+            if self.memberships_loaded and \
+                    generation == self.memberships_generation:
+                return
+
+        inventory_ids = [id for id, in session.execute(
+            select([Inventory.id]).order_by(Inventory.id))]
+        pairs = [tuple(row) for row in session.execute(select([
+            association_table.c.inventory_id,
+            association_table.c.chemical_id]))]
+
+        with self.lock:
+            self._load_memberships(inventory_ids, pairs)
+            self.memberships_loaded = True
+            self.memberships_generation = generation
+            self.membership_loads += 1
+
+    # Queries
+
+    def _snapshot(self):
+        """(inventory ids, indptr, row of each entry, chemical id of each
+        entry, hazard by chemical id), consistent with each other"""
+        self.sync(db.session)
+        with self.lock:
+            self._fold()
+            self.queries += 1
+            return self.inventory_ids, self.indptr, self.rows, \
+                self.indices, self.hazard.copy()
+
+    @staticmethod
+    def _means(rows, chemical_ids, hazard, size):
+        """(mean hazard, members) of size rows, from each entry's row and
+        chemical id; NaN for no members"""
+        # Entries of chemicals missing from the array (mid-reload) drop out
+        values = np.full(len(chemical_ids), np.nan)
+        known = chemical_ids < len(hazard)
+        values[known] = hazard[chemical_ids[known]]
+        present = ~np.isnan(values)
+        sums = np.bincount(
+            rows[present], weights=values[present], minlength=size)
+        counts = np.bincount(rows[present], minlength=size)
+        means = np.divide(sums, counts, out=np.full(size, np.nan),
+                          where=counts > 0)
+        return means, counts
+
+    def hazards(self, min_hazard=None):
+        """([(inventory id, mean hazard, members)], most hazardous first,
+        only those at or above min_hazard if given; summary)"""
+        inventory_ids, _, rows, indices, hazard = self._snapshot()
+        means, counts = self._means(rows, indices, hazard, len(inventory_ids))
+
+        matches = np.flatnonzero(counts)
+        summary = {
+            'inventories': len(inventory_ids),
+            'chemicals': int(np.count_nonzero(~np.isnan(hazard))),
+            'memberships': len(indices),
+            'max_hazard': float(means[matches].max())
+            if len(matches) else None,
+            'mean_hazard': float(means[matches].mean())
+            if len(matches) else None,
+        }
+        if min_hazard is not None:
+            matches = matches[means[matches] >= min_hazard]
+        matches = matches[np.lexsort(
+            (inventory_ids[matches], -means[matches]))]
+        return [(int(inventory_ids[row]), float(means[row]), int(counts[row]))
+                for row in matches], summary
+
+    def what_if(self, ld50_changes):
+        """[(inventory id, mean hazard, mean hazard with the chemicals'
+        ld50 revised)] for the inventories holding any of them, by id.
+
+        ld50_changes maps chemical ids to ld50; raises KeyError with the
+        ids that have no chemical.
+        """
+        inventory_ids, indptr, rows, indices, hazard = self._snapshot()
+        missing = [id for id in ld50_changes
+                   if id >= len(hazard) or np.isnan(hazard[id])]
+        if missing:
+            raise KeyError(missing)
+
+        revised = hazard.copy()
+        revised[list(ld50_changes)] = Chemical.hazard_for(
+            np.array(list(ld50_changes.values()), dtype=float))
+
+        # Only the affected rows' entries are read: the slices
+        # indptr[row]:indptr[row + 1], gathered without a Python loop
+        affected = np.unique(rows[np.isin(indices, list(ld50_changes))])
+        starts = indptr[affected]
+        lengths = indptr[affected + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        entries = indices[np.arange(lengths.sum()) + offsets]
+        local_rows = np.repeat(np.arange(len(affected)), lengths)
+
+        means, _ = self._means(local_rows, entries, hazard, len(affected))
+        what_if_means, _ = self._means(
+            local_rows, entries, revised, len(affected))
+        return [(int(inventory_ids[row]), float(mean), float(what_if))
+                for row, mean, what_if in zip(affected, means, what_if_means)]
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats.update(
+                capacity=len(self.hazard),
+                inventories=len(self.inventory_ids),
+                memberships=len(self.indices),
+                pending_edits=len(self.edits),
+                membership_loads=self.membership_loads,
+                membership_updates=self.membership_updates,
+                queries=self.queries)
+        return stats
+
+
+hazard_engine = HazardEngine()
+
+
+# -------------------
+# MEMBERSHIP CHANGES
+# -------------------
+
+
+def mark_memberships_changed(session, values):
+    """Records membership writes: {inventory id: member chemical ids, or
+    None if deleted}. When the session commits, the local engine applies
+    them and the memberships generation is bumped for other workers."""
+    pending = pending_changes(session, MEMBERSHIPS)
+    pending['values'].update(values)
+    bump_pending(session, pending, MEMBERSHIPS)
+
+
+track_changes(
+    MEMBERSHIPS, lambda: {'values': {}},
+    lambda pending, generations: hazard_engine.apply_memberships(
+        pending['values'], generations.get(MEMBERSHIPS)))
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    values = {}
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Inventory):
+            continue
+        if obj in session.deleted:
+            values[obj.id] = None
+        elif obj in session.new or \
+                inspect(obj).attrs.chemicals.history.has_changes():
+            values[obj.id] = [chemical.id for chemical in obj.chemicals]
+    if values:
+        mark_memberships_changed(session, values)
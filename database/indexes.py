@@ -0,0 +1,242 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import DDL, event, func, inspect, select
+from database.models import Chemical
+from database.cache import cache_generations, advanced_generation, track_changes, pending_changes, bump_pending
+
+# Name -> index, every ChemicalIndex registers itself
+INDEXES = {}
+
+# How often sync() counts the indexed rows, a full scan, to catch ids
+# committed out of order
+RECOUNT_SECONDS = 60
+
+
+class ChemicalIndex(ABC):
+    """Base for a worker-local, in-memory index over one chemicals column.
+
+    Loaded on first use. Local writes are applied on commit. Other workers'
+    writes are caught by sync() before each lookup, which reads the
+    generations and the highest chemical id in one query: changed or
+    deleted values bump the index's row in cache_generations once they
+    commit (full reload)
+    and new rows are read past the highest id held. Every RECOUNT_SECONDS a
+    row count that disagrees (ids committed out of order) forces a full
+    reload.
+
+    Subclasses hold the data in _reset, _set, _remove and __len__, and are
+    called with self.lock held.
+    """
+
+    # Indexed Chemical column; rows where it is NULL are left out
+    column = None
+
+    # Generations sync() reads besides the index's own
+    generations = ()
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.max_id = 0
+        self.loaded = False
+        self.generation = None
+        self.counted_at = 0
+        self.loads = 0
+        self.updates = 0
+        INDEXES[name] = self
+
+        event.listen(cache_generations, 'after_create', DDL(
+            f"INSERT INTO cache_generations (name, value) VALUES ('{name}', 0)"))
+        track_changes(
+            name, lambda: {'values': {}, 'clear': False}, self._apply_pending)
+
+    @abstractmethod
+    def _reset(self):
+        """Drops every value"""
+
+    @abstractmethod
+    def _set(self, chemical_id, value):
+        """Adds or replaces the value of chemical_id"""
+
+    @abstractmethod
+    def _remove(self, chemical_id):
+        """Drops the value of chemical_id, if held"""
+
+    @abstractmethod
+    def __len__(self):
+        """Number of values held"""
+
+    def _load(self, session, after_id=None):
+        statement = select([Chemical.id, self.column]).where(
+            self.column.isnot(None))
+        if after_id is not None:
+            statement = statement.where(Chemical.id > after_id)
+        return session.execute(statement).fetchall()
+
+    def _probe(self, session):
+        """({name: generation} of the index and self.generations, highest
+        chemical id), in one round trip"""
+        rows = session.execute(select([
+            cache_generations.c.name,
+            cache_generations.c.value,
+            select([func.max(Chemical.id)]).as_scalar()]).where(
+            cache_generations.c.name.in_((self.name,) + self.generations))
+        ).fetchall()
+        if not rows:
+            return {}, session.execute(
+                select([func.max(Chemical.id)])).scalar() or 0
+        return {name: value for name, value, _ in rows}, rows[0][2] or 0
+
+    def sync(self, session):
+        """Brings the index up to date with the database; returns the
+        generations read"""
+        generations, max_id = self._probe(session)
+        self._catch_up(session, generations.get(self.name), max_id)
+        return generations
+
+    def _catch_up(self, session, generation, max_id):
+        with self.lock:
+            current = self.loaded and generation == self.generation
+            recount = current and \
+                time.monotonic() - self.counted_at >= RECOUNT_SECONDS
+            if current and not recount and max_id <= self.max_id:
+                return
+            after_id = self.max_id if current else None
+
+        rows = self._load(session, after_id)
+        count = None
+        if recount:
+            count = session.execute(select([func.count(self.column)])).scalar()
+
+        with self.lock:
+            if after_id is None:
+                self._reset()
+                self.max_id = 0
+                self.counted_at = time.monotonic()
+                self.loads += 1
+            for chemical_id, value in rows:
+                self._set(chemical_id, value)
+            self.max_id = max(self.max_id, max_id)
+            self.loaded = True
+            self.generation = generation
+            if count is not None:
+                self.counted_at = time.monotonic()
+                self.loaded = len(self) == count
+
+        if not self.loaded:
+            self._catch_up(session, generation, max_id)
+
+    def invalidate(self):
+        """Forces a full reload on the next sync"""
+        with self.lock:
+            self.loaded = False
+
+    def apply(self, values, clear=False, bumped=False, generation=None):
+        """Applies committed writes: {chemical id: value or None}; bumped
+        if the commit bumped the index's generation to generation"""
+        with self.lock:
+            if not self.loaded:
+                return
+            if clear:
+                self.loaded = False
+                return
+
+            for chemical_id, value in values.items():
+                if value is None:
+                    self._remove(chemical_id)
+                else:
+                    self._set(chemical_id, value)
+                    self.max_id = max(self.max_id, chemical_id)
+            self.updates += len(values)
+
+            if bumped:
+                self.generation = advanced_generation(
+                    self.generation, generation)
+                self.loaded = self.generation is not None
+
+    def _apply_pending(self, pending, generations):
+        self.apply(pending['values'], pending['clear'],
+                   self.name in pending['bumps'], generations.get(self.name))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self),
+                'loads': self.loads,
+                'updates': self.updates,
+            }
+
+
+# -------------------
+# INDEX MAINTENANCE
+# -------------------
+
+
+def mark_index_changed(session, name, values=None, created=False):
+    """Records writes to an index's column the ORM cannot see (e.g. core
+    statements).
+
+    values maps chemical ids to the new value, or None if deleted; None
+    means any chemical may have changed. Rows replaced or deleted bump the
+    index's generation for other workers; created rows need not, other
+    workers find them past their highest id.
+    """
+    pending = pending_changes(session, name)
+    if values is None:
+        pending['clear'] = True
+    else:
+        pending['values'].update(values)
+
+    if not created:
+        bump_pending(session, pending, name)
+
+
+def mark_rows_changed(session, rows, created=False):
+    """mark_index_changed for every index whose column is in rows, a
+    {chemical id: {column: value}} mapping"""
+    for index in INDEXES.values():
+        key = index.column.key
+        values = {id: row[key] for id, row in rows.items() if key in row}
+        if values:
+            mark_index_changed(session, index.name, values, created)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    chemicals = [obj for obj in session.new | session.dirty | session.deleted
+                 if isinstance(obj, Chemical)]
+    if not chemicals:
+        return
+
+    for index in INDEXES.values():
+        key = index.column.key
+        created = {
+            obj.id: getattr(obj, key) for obj in chemicals
+            if obj in session.new and getattr(obj, key) is not None}
+        changed = {
+            obj.id: getattr(obj, key) for obj in chemicals
+            if obj in session.dirty
+            and inspect(obj).attrs[key].history.has_changes()}
+        changed.update({
+            obj.id: None for obj in chemicals if obj in session.deleted})
+
+        if created:
+            mark_index_changed(session, index.name, created, created=True)
+        if changed:
+            mark_index_changed(session, index.name, changed)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+def _after_bulk_update(update_context):
+    if update_context.mapper is Chemical.__mapper__:
+        for name in INDEXES:
+            mark_index_changed(update_context.session, name)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_delete')
+def _after_bulk_delete(delete_context):
+    if delete_context.mapper is Chemical.__mapper__:
+        for name in INDEXES:
+            mark_index_changed(delete_context.session, name)
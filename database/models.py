@@ -1,14 +1,16 @@
 from datetime import datetime
 from re import I, L
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import os
-from sqlalchemy import Column, String, Integer, Float, ForeignKey, CheckConstraint, create_engine, Table, tuple_
+from sqlalchemy import Column, String, Integer, Float, Boolean, Text, JSON, LargeBinary, ForeignKey, CheckConstraint, DDL, Index, create_engine, Table, tuple_, select, and_, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.elements import Null
 from sqlalchemy.sql.expression import update
 from sqlalchemy.sql.sqltypes import DateTime
 from sqlalchemy.sql import func
-from sqlalchemy_utils import aggregated
+from sqlalchemy.orm import load_only, selectinload, validates
+from database.fingerprints import fingerprint
+from database.properties import derive
 
 database_path = os.getenv('DATABASE_URL')
 
@@ -45,13 +47,16 @@ association_table = db.Table(
     Column(
         'chemical_id',
         Integer,
-        ForeignKey('chemicals.id'),
+        ForeignKey('chemicals.id', ondelete='CASCADE'),
         primary_key=True),
     Column(
         'inventory_id',
         Integer,
-        ForeignKey('inventories.id'),
-        primary_key=True))
+        ForeignKey('inventories.id', ondelete='CASCADE'),
+        primary_key=True,
+        # The primary key leads with chemical_id; this serves lookups of an
+        # inventory's members
+        index=True))
 
 
 class Chemical(db.Model):
@@ -67,13 +72,59 @@ class Chemical(db.Model):
         DateTime(),
         default=datetime.now,
         onupdate=datetime.now)
+    # Bumped on every UPDATE; a stale version fails the flush (optimistic
+    # locking), exposed to clients as ETag / If-Match
+    version = Column(Integer, nullable=False, server_default='1')
+    # Packed SMILES fingerprint (database/fingerprints.py), kept in step
+    # with smiles for similarity search
+    fingerprint = Column(LargeBinary)
+    # Derived from smiles on write (database/properties.py), NULL if it
+    # cannot be parsed
+    formula = Column(String, index=True)
+    heavy_atoms = Column(Integer, index=True)
+    mol_weight = Column(Float, index=True)
     # inventories = db.relationship("Inventory", secondary = association_table, backref=db.backref('association', lazy=True), cascade="all, delete")
 
+    # Public field name -> mapped attribute, used for ?fields= selection
+    FIELDS = {
+        'id': 'id',
+        'name': 'name',
+        'smiles': 'smiles',
+        'ld50': 'ld50',
+        'hazard': 'hazard',
+        'version': 'version',
+        'formula': 'formula',
+        'heavy_atoms': 'heavy_atoms',
+        'mol_weight': 'mol_weight',
+    }
+    FORMAT_FIELDS = ('id', 'name', 'smiles', 'ld50')
+    FORMAT_FULL_FIELDS = FORMAT_FIELDS + (
+        'hazard', 'formula', 'heavy_atoms', 'mol_weight')
+
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self, name, smiles, ld50):
         self.name = name
         self.smiles = smiles
         self.ld50 = ld50
-        self.hazard = (1 / ld50) / 0.5
+
+    @staticmethod
+    def hazard_for(ld50):
+        return (1 / ld50) / 0.5
+
+    @validates('ld50')
+    def validate_ld50(self, key, ld50):
+        # hazard is stored for the SQL averages; every ld50 write keeps it
+        # in step, as chemical_rows does for core statements
+        self.hazard = self.hazard_for(ld50)
+        return ld50
+
+    @validates('smiles')
+    def validate_smiles(self, key, smiles):
+        self.fingerprint = fingerprint(smiles)
+        for column, value in derive(smiles).items():
+            setattr(self, column, value)
+        return smiles
 
     def insert(self):
         db.session.add(self)
@@ -86,22 +137,16 @@ class Chemical(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'smiles': self.smiles,
-            'ld50': self.ld50,
-        }
+    @classmethod
+    def load_fields(cls, fields):
+        """Loader option restricting the SELECT to the columns behind fields"""
+        return load_only(*[cls.FIELDS[field] for field in fields])
 
-    def format_full(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'smiles': self.smiles,
-            'ld50': self.ld50,
-            'hazard': self.hazard,
-        }
+    def format(self, fields=FORMAT_FIELDS):
+        return {field: getattr(self, self.FIELDS[field]) for field in fields}
+
+    def format_full(self, fields=FORMAT_FULL_FIELDS):
+        return self.format(fields)
 
     def __repr__(self):
         return f"<Chemical {self.name} {self.smiles} {self.ld50} {self.created_on} {self.updated_on}>"
@@ -117,6 +162,7 @@ class Inventory(db.Model):
         DateTime(),
         default=datetime.now,
         onupdate=datetime.now)
+    version = Column(Integer, nullable=False, server_default='1')
     chemicals = db.relationship(
         'Chemical',
         secondary=association_table,
@@ -125,12 +171,35 @@ class Inventory(db.Model):
             lazy=True),
         cascade='all,delete')
 
-    @aggregated('chemicals', Column(Float))
-    def average_hazard(self):
-        return func.avg(Chemical.hazard)
+    # Mean hazard of the member chemicals, recomputed on flush (see
+    # refresh_changed_hazards) by a single correlated UPDATE
+    average_hazard = Column(Float)
 
     CheckConstraint('hazard >= 0', name='hazard_positive')
 
+    # Public field name -> mapped attribute, used for ?fields= selection
+    FIELDS = {
+        'id': 'id',
+        'location': 'location',
+        'hazard': 'average_hazard',
+        'version': 'version',
+    }
+    FORMAT_FIELDS = ('id', 'location', 'hazard')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # GET /inventories filters on location and sorts on average_hazard or
+    # updated_on, ties broken by id: one index per shape, so the filtered
+    # and sorted listing is an index range scan with no sort step
+    __table_args__ = (
+        Index('ix_inventories_location_average_hazard',
+              'location', 'average_hazard', 'id'),
+        Index('ix_inventories_location_updated_on',
+              'location', 'updated_on', 'id'),
+        Index('ix_inventories_average_hazard', 'average_hazard', 'id'),
+        Index('ix_inventories_updated_on', 'updated_on', 'id'),
+    )
+
     def __init__(self, location, chemicals):
         self.location = location
         self.chemicals = chemicals
@@ -146,20 +215,147 @@ class Inventory(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'location': self.location,
-            'hazard': self.average_hazard,
-        }
+    @classmethod
+    def load_fields(cls, fields):
+        """Loader option restricting the SELECT to the columns behind fields"""
+        return load_only(*[cls.FIELDS[field] for field in fields])
+
+    @classmethod
+    def load_chemicals(cls, chemical_fields=Chemical.FORMAT_FIELDS):
+        """Loader option eagerly selecting the member chemicals' columns"""
+        return selectinload(cls.chemicals).load_only(
+            *[Chemical.FIELDS[field] for field in chemical_fields])
+
+    @classmethod
+    def refresh_average_hazard(cls, whereclause, session=None, **values):
+        """Recomputes average_hazard in one UPDATE for matching inventories,
+        setting any other column values alongside"""
+        session = session or db.session
+        average = select([func.avg(Chemical.hazard)]).where(and_(
+            association_table.c.inventory_id == cls.id,
+            association_table.c.chemical_id == Chemical.id)).as_scalar()
+        session.execute(cls.__table__.update().where(
+            whereclause).values(average_hazard=average, **values))
+
+    def format(self, fields=FORMAT_FIELDS):
+        return {field: getattr(self, self.FIELDS[field]) for field in fields}
+
+    def format_full(
+            self,
+            fields=FORMAT_FIELDS,
+            chemical_fields=Chemical.FORMAT_FIELDS):
+        inventory = self.format(fields)
+        inventory['chemicals'] = [
+            chemical.format(chemical_fields) for chemical in self.chemicals]
+        return inventory
+
+    def __repr__(self):
+        return f"<Inventory {self.location} {self.average_hazard} {self.created_on} {self.updated_on}>"
+
+
+# ?location_prefix= is a LIKE 'prefix%', which a PostgreSQL btree only
+# serves under the C collation or with pattern ops
+event.listen(Inventory.__table__, 'after_create', DDL("""
+    CREATE INDEX IF NOT EXISTS ix_inventories_location_pattern
+        ON inventories (location varchar_pattern_ops)
+""").execute_if(dialect='postgresql'))
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
 
-    def format_full(self):
+    id = Column(Integer, primary_key=True)
+    type = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    params = Column(JSON)
+    done = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    checkpoint = Column(JSON)
+    result = Column(JSON)
+    error = Column(Text)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    created_on = Column(DateTime(), nullable=False, default=datetime.now)
+    updated_on = Column(
+        DateTime(),
+        default=datetime.now,
+        onupdate=datetime.now)
+
+    def __init__(self, type, params):
+        self.type = type
+        self.params = params
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def format(self):
         return {
             'id': self.id,
-            'location': self.location,
-            'hazard': self.average_hazard,
-            'chemicals': [chemical.format() for chemical in self.chemicals]
+            'type': self.type,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'cancel_requested': self.cancel_requested,
+            'result': self.result,
+            'error': self.error,
         }
 
     def __repr__(self):
-        return f"<Inventory {self.location} {self.average_hazard} {self.created_on} {self.updated_on}>"
+        return f"<Job {self.type} {self.status} {self.done}/{self.total}>"
+
+
+# -------------------
+# AVERAGE HAZARD
+# -------------------
+
+
+@event.listens_for(SignallingSession, 'before_flush')
+def collect_hazard_changes(session, flush_context, instances):
+    """Notes the inventories whose average_hazard the flush will change.
+
+    Membership changes dirty the inventory; hazard changes and deletes of
+    chemicals are traced to their inventories now, while the association
+    rows still exist.
+    """
+    inventories = [
+        obj for obj in session.new | session.dirty
+        if isinstance(obj, Inventory) and obj not in session.deleted]
+    chemical_ids = [
+        obj.id for obj in session.dirty | session.deleted
+        if isinstance(obj, Chemical) and obj.id is not None and (
+            obj in session.deleted
+            or inspect(obj).attrs.hazard.history.has_changes())]
+
+    inventory_ids = set()
+    if chemical_ids:
+        inventory_ids.update(id for id, in session.execute(
+            select([association_table.c.inventory_id]).where(
+                association_table.c.chemical_id.in_(chemical_ids))))
+
+    session.info.pop('hazard_refresh', None)
+    if inventories or inventory_ids:
+        session.info['hazard_refresh'] = (inventories, inventory_ids)
+
+
+@event.listens_for(SignallingSession, 'after_flush_postexec')
+def refresh_changed_hazards(session, flush_context):
+    pending = session.info.pop('hazard_refresh', None)
+    if pending is None:
+        return
+
+    inventories, inventory_ids = pending
+    inventories = [
+        inventory for inventory in inventories
+        if inspect(inventory).persistent]
+    inventory_ids.update(inventory.id for inventory in inventories)
+    Inventory.refresh_average_hazard(
+        Inventory.id.in_(sorted(inventory_ids)), session)
+    for inventory in inventories:
+        session.expire(inventory, ['average_hazard'])
@@ -0,0 +1,203 @@
+import re
+from collections import Counter
+from sqlalchemy import bindparam, select
+
+# Properties derived from a SMILES string when it is written, so readers
+# never parse SMILES themselves. The parser covers the organic subset,
+# bracket atoms, bonds, branches and ring closures; it ignores
+# stereochemistry and charge and fills implicit hydrogens from the lowest
+# default valence that fits, which is enough for composition and weight.
+
+# Standard atomic weights (IUPAC, abridged)
+ATOMIC_WEIGHTS = {
+    'H': 1.008, 'He': 4.003, 'Li': 6.94, 'Be': 9.012, 'B': 10.81,
+    'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998, 'Ne': 20.18,
+    'Na': 22.99, 'Mg': 24.305, 'Al': 26.982, 'Si': 28.085, 'P': 30.974,
+    'S': 32.06, 'Cl': 35.45, 'Ar': 39.948, 'K': 39.098, 'Ca': 40.078,
+    'Ti': 47.867, 'V': 50.942, 'Cr': 51.996, 'Mn': 54.938, 'Fe': 55.845,
+    'Co': 58.933, 'Ni': 58.693, 'Cu': 63.546, 'Zn': 65.38, 'Ga': 69.723,
+    'Ge': 72.63, 'As': 74.922, 'Se': 78.971, 'Br': 79.904, 'Kr': 83.798,
+    'Rb': 85.468, 'Sr': 87.62, 'Zr': 91.224, 'Mo': 95.95, 'Pd': 106.42,
+    'Ag': 107.868, 'Cd': 112.414, 'Sn': 118.71, 'Sb': 121.76, 'Te': 127.6,
+    'I': 126.904, 'Xe': 131.293, 'Cs': 132.905, 'Ba': 137.327,
+    'W': 183.84, 'Pt': 195.084, 'Au': 196.967, 'Hg': 200.59, 'Pb': 207.2,
+    'Bi': 208.98,
+}
+
+# Default valences of the organic subset, lowest first
+VALENCES = {
+    'B': (3,), 'C': (4,), 'N': (3, 5), 'O': (2,), 'P': (3, 5),
+    'S': (2, 4, 6), 'F': (1,), 'Cl': (1,), 'Br': (1,), 'I': (1,),
+}
+
+# Aromatic atoms that still owe the ring one double bond
+AROMATIC_PI = {'B', 'C', 'N', 'P'}
+
+BOND_ORDERS = {'-': 1, '=': 2, '#': 3, '$': 4, ':': 1, '/': 1, '\\': 1}
+
+TOKEN = re.compile(
+    r'(?P<bracket>\[[^\]]+\])|(?P<atom>Cl|Br|[BCNOPSFI]|[bcnops])'
+    r'|(?P<bond>[-=#$:/\\])|(?P<ring>%\d\d|\d)|(?P<other>[().])')
+
+BRACKET = re.compile(
+    r'\[(?:\d+)?(?P<element>[A-Z][a-z]?|se|as|te|[bcnops])'
+    r'(?:@+|@[A-Z]{2}\d*)?(?:H(?P<hydrogens>\d*))?'
+    r'(?:[+-]+\d*)?(?::\d+)?\]')
+
+PROPERTIES = ('formula', 'heavy_atoms', 'mol_weight')
+
+
+def composition(smiles):
+    """Counter of element symbols in smiles, hydrogens included.
+
+    Raises ValueError if smiles cannot be parsed.
+    """
+    elements = []   # per atom: element symbol
+    hydrogens = []  # per atom: explicit hydrogens, None if implicit
+    aromatic = []
+    bonds = []      # per atom: sum of bond orders
+
+    previous = None
+    bond = None
+    branches = []
+    rings = {}
+
+    position = 0
+    while position < len(smiles):
+        match = TOKEN.match(smiles, position)
+        if match is None:
+            raise ValueError(f'Unexpected {smiles[position]!r} in SMILES.')
+        position = match.end()
+        token = match.group()
+
+        if match.lastgroup in ('bracket', 'atom'):
+            if match.lastgroup == 'bracket':
+                atom = BRACKET.fullmatch(token)
+                if atom is None:
+                    raise ValueError(f'Invalid atom {token} in SMILES.')
+                symbol = atom.group('element')
+                count = atom.group('hydrogens')
+                explicit = 0 if count is None else int(count or 1)
+            else:
+                symbol, explicit = token, None
+
+            element = symbol.capitalize()
+            if element not in ATOMIC_WEIGHTS:
+                raise ValueError(f'Unknown element {symbol} in SMILES.')
+            elements.append(element)
+            hydrogens.append(explicit)
+            aromatic.append(symbol.islower())
+            bonds.append(0)
+
+            current = len(elements) - 1
+            if previous is not None:
+                order = bond or 1
+                bonds[previous] += order
+                bonds[current] += order
+            previous, bond = current, None
+
+        elif match.lastgroup == 'bond':
+            bond = BOND_ORDERS[token]
+
+        elif match.lastgroup == 'ring':
+            if previous is None:
+                raise ValueError('Ring closure without an atom in SMILES.')
+            if token in rings:
+                start, opening_bond = rings.pop(token)
+                order = bond or opening_bond or 1
+                bonds[start] += order
+                bonds[previous] += order
+            else:
+                rings[token] = (previous, bond)
+            bond = None
+
+        elif token == '(':
+            if previous is None:
+                raise ValueError('Branch without an atom in SMILES.')
+            branches.append(previous)
+        elif token == ')':
+            if not branches:
+                raise ValueError('Unbalanced ) in SMILES.')
+            previous = branches.pop()
+        else:
+            previous = None
+
+    if branches or rings or not elements:
+        raise ValueError('Incomplete SMILES.')
+
+    counts = Counter(elements)
+    for atom, element in enumerate(elements):
+        explicit = hydrogens[atom]
+        if explicit is not None:
+            counts['H'] += explicit
+            continue
+
+        used = bonds[atom] + (aromatic[atom] and element in AROMATIC_PI)
+        valence = next(
+            (valence for valence in VALENCES[element] if valence >= used),
+            used)
+        counts['H'] += valence - used
+
+    return +counts
+
+
+def hill_formula(counts):
+    """Formula in Hill order: C, then H, then alphabetical (no C: all
+    alphabetical)"""
+    if 'C' in counts:
+        order = ['C'] + (['H'] if 'H' in counts else []) + sorted(
+            element for element in counts if element not in ('C', 'H'))
+    else:
+        order = sorted(counts)
+    return ''.join(
+        element + (str(counts[element]) if counts[element] > 1 else '')
+        for element in order)
+
+
+def derive(smiles):
+    """{formula, heavy_atoms, mol_weight} of smiles; all None if it cannot
+    be parsed"""
+    try:
+        counts = composition(smiles or '')
+    except ValueError:
+        return dict.fromkeys(PROPERTIES)
+
+    return {
+        'formula': hill_formula(counts),
+        'heavy_atoms': sum(
+            count for element, count in counts.items() if element != 'H'),
+        'mol_weight': round(sum(
+            ATOMIC_WEIGHTS[element] * count
+            for element, count in counts.items()), 3),
+    }
+
+
+def backfill(connection, chemicals, batch_size=1000, missing_only=True):
+    """Derives properties for existing rows in id order, one UPDATE per
+    batch_size rows; returns the number of rows written.
+
+    chemicals is a table with id, smiles and the PROPERTIES columns.
+    """
+    written = 0
+    last_id = 0
+    while True:
+        statement = select([chemicals.c.id, chemicals.c.smiles]).where(
+            chemicals.c.id > last_id)
+        if missing_only:
+            statement = statement.where(chemicals.c.heavy_atoms.is_(None))
+        rows = connection.execute(
+            statement.order_by(chemicals.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return written
+
+        connection.execute(
+            chemicals.update().where(
+                chemicals.c.id == bindparam('chemical_id')).values(
+                {column: bindparam(f'derived_{column}')
+                 for column in PROPERTIES}),
+            [dict({f'derived_{column}': value
+                   for column, value in derive(smiles).items()},
+                  chemical_id=id)
+             for id, smiles in rows])
+        written += len(rows)
+        last_id = rows[-1].id
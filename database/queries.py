@@ -0,0 +1,145 @@
+import re
+from flask import g, has_app_context
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from database.models import db, Chemical, Inventory, association_table
+
+# Hot lookups are baked: each distinct query shape is built and compiled
+# to SQL once per process, later calls only bind parameters.
+bakery = baked.bakery()
+
+
+def read_session():
+    """Session for lookups: the read snapshot's while it serves the current
+    GET (database/snapshot.py), db.session otherwise"""
+    session = g.get('snapshot_session') if has_app_context() else None
+    return session or db.session()
+
+
+def _with_fields(bq, model, fields):
+    # fields go into the cache key; the lambda's code object alone would
+    # not tell different field lists apart
+    if fields is not None:
+        bq.add_criteria(
+            lambda q: q.options(model.load_fields(fields)), fields)
+    return bq
+
+
+def get_chemical(chemical_id, fields=None):
+    bq = bakery(lambda session: session.query(Chemical))
+    bq += lambda q: q.filter(Chemical.id == bindparam('id'))
+    _with_fields(bq, Chemical, fields)
+    return bq(read_session()).params(id=chemical_id).one_or_none()
+
+
+def get_chemicals(chemical_ids, fields=None, session=None):
+    """Chemicals by id in one query, ordered by id; missing ids are skipped"""
+    if not chemical_ids:
+        return []
+
+    bq = bakery(lambda session: session.query(Chemical))
+    bq += lambda q: q.filter(
+        Chemical.id.in_(bindparam('ids', expanding=True))).order_by(
+        Chemical.id)
+    _with_fields(bq, Chemical, fields)
+    return bq(session or read_session()).params(ids=list(chemical_ids)).all()
+
+
+# ?filter= arguments of GET /chemicals: argument type and criterion on
+# the derived, indexed columns
+CHEMICAL_FILTERS = {
+    'formula': (str, lambda q: q.filter(
+        Chemical.formula == bindparam('formula'))),
+    'min_heavy_atoms': (int, lambda q: q.filter(
+        Chemical.heavy_atoms >= bindparam('min_heavy_atoms'))),
+    'max_heavy_atoms': (int, lambda q: q.filter(
+        Chemical.heavy_atoms <= bindparam('max_heavy_atoms'))),
+    'min_mol_weight': (float, lambda q: q.filter(
+        Chemical.mol_weight >= bindparam('min_mol_weight'))),
+    'max_mol_weight': (float, lambda q: q.filter(
+        Chemical.mol_weight <= bindparam('max_mol_weight'))),
+}
+
+
+def all_chemicals(fields=None, filters=None):
+    """Chemicals by id, matching filters ({CHEMICAL_FILTERS name: value})"""
+    filters = filters or {}
+    bq = bakery(lambda session: session.query(Chemical))
+    for name in sorted(filters):
+        bq += CHEMICAL_FILTERS[name][1]
+    bq += lambda q: q.order_by(Chemical.id)
+    _with_fields(bq, Chemical, fields)
+    return bq(read_session()).params(**filters).all()
+
+
+def get_inventory(inventory_id, fields=None, session=None):
+    bq = bakery(lambda session: session.query(Inventory))
+    bq += lambda q: q.filter(Inventory.id == bindparam('id'))
+    _with_fields(bq, Inventory, fields)
+    return bq(session or read_session()).params(
+        id=inventory_id).one_or_none()
+
+
+def like_prefix(prefix):
+    """LIKE pattern matching strings that start with prefix, its wildcards
+    escaped with a backslash"""
+    return re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+
+
+# ?filter= arguments of GET /inventories: argument type and criterion.
+# Served by the (location, ...), average_hazard and, on PostgreSQL,
+# location varchar_pattern_ops indexes (see Inventory)
+INVENTORY_FILTERS = {
+    'location': (str, lambda q: q.filter(
+        Inventory.location == bindparam('location'))),
+    'location_prefix': (like_prefix, lambda q: q.filter(
+        Inventory.location.like(bindparam('location_prefix'), escape='\\'))),
+    'min_hazard': (float, lambda q: q.filter(
+        Inventory.average_hazard >= bindparam('min_hazard'))),
+}
+
+# ?sort= keys of GET /inventories, ties broken by id. NULL (no hazard, an
+# inventory without chemicals) sorts above every value either way round,
+# as a PostgreSQL index scan returns it
+INVENTORY_SORTS = {
+    'id': lambda q: q.order_by(Inventory.id),
+    '-id': lambda q: q.order_by(Inventory.id.desc()),
+    'hazard': lambda q: q.order_by(
+        Inventory.average_hazard.asc().nullslast(), Inventory.id),
+    '-hazard': lambda q: q.order_by(
+        Inventory.average_hazard.desc().nullsfirst(), Inventory.id.desc()),
+    'updated_on': lambda q: q.order_by(
+        Inventory.updated_on.asc().nullslast(), Inventory.id),
+    '-updated_on': lambda q: q.order_by(
+        Inventory.updated_on.desc().nullsfirst(), Inventory.id.desc()),
+}
+
+
+def all_inventories(fields=None, chemical_fields=None, filters=None,
+                    sort='id'):
+    """Inventories matching filters ({INVENTORY_FILTERS name: value}) in
+    INVENTORY_SORTS order.
+
+    Members are selectin-loaded if chemical_fields, and never otherwise:
+    formatting without them does not touch the relationship.
+    """
+    filters = filters or {}
+    bq = bakery(lambda session: session.query(Inventory))
+    for name in sorted(filters):
+        bq += INVENTORY_FILTERS[name][1]
+    bq += INVENTORY_SORTS[sort]
+    _with_fields(bq, Inventory, fields)
+    if chemical_fields is not None:
+        bq.add_criteria(lambda q: q.options(
+            Inventory.load_chemicals(chemical_fields)), chemical_fields)
+    return bq(read_session()).params(**filters).all()
+
+
+def inventory_chemical_ids(inventory_id):
+    bq = bakery(lambda session: session.query(
+        association_table.c.chemical_id))
+    bq += lambda q: q.filter(
+        association_table.c.inventory_id == bindparam('id')).order_by(
+        association_table.c.chemical_id)
+    return [chemical_id for chemical_id, in
+            bq(read_session()).params(id=inventory_id)]
@@ -0,0 +1,184 @@
+import math
+import re
+import numpy as np
+from sqlalchemy import DDL, event, func, text
+from database.models import db, Chemical
+from database.indexes import ChemicalIndex
+
+# Lowest similarity a match needs, pg_trgm's default similarity_threshold
+THRESHOLD = 0.3
+
+# Most matches one search returns
+MAX_RESULTS = 100
+
+NO_ROWS = np.zeros(0, dtype=np.int32)
+
+# On PostgreSQL names are searched through a pg_trgm GIN index. Where the
+# extension cannot be installed the block gives up quietly and searches
+# fall back to the in-process index below.
+event.listen(Chemical.__table__, 'after_create', DDL("""
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_chemicals_name_trgm
+        ON chemicals USING gin (name gin_trgm_ops);
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available, name search runs in-process';
+END
+$$
+""").execute_if(dialect='postgresql'))
+
+
+def trigrams(string):
+    """Trigrams of string as pg_trgm builds them: from each lowercased word
+    padded with two blanks in front and one behind"""
+    grams = set()
+    for word in re.findall(r'[^\W_]+', string.lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex(ChemicalIndex):
+    """Inverted index from trigrams to chemical names, scored like
+    pg_trgm's similarity() (shared trigrams / trigrams in either).
+
+    Names are append-only rows; a posting holds the rows containing a
+    trigram as a NumPy array plus a list of rows appended since the last
+    search. Renamed and deleted names leave dead rows behind until they
+    outnumber the live ones and the index is rebuilt.
+    """
+
+    column = Chemical.__table__.c.name
+
+    def __init__(self, capacity=1024):
+        self.postings = {}
+        self.rows = {}
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.sizes = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.size = 0
+        self.dead = 0
+        self.searches = 0
+        super().__init__('names')
+
+    def _reset(self):
+        self.postings.clear()
+        self.rows.clear()
+        self.alive[:] = False
+        self.size = 0
+        self.dead = 0
+
+    def _set(self, chemical_id, name):
+        self._remove(chemical_id)
+        if self.size == len(self.ids):
+            capacity = 2 * len(self.ids)
+            self.ids = np.resize(self.ids, capacity)
+            self.sizes = np.resize(self.sizes, capacity)
+            self.alive = np.resize(self.alive, capacity)
+
+        grams = trigrams(name)
+        row = self.size
+        self.size += 1
+        self.rows[chemical_id] = row
+        self.ids[row] = chemical_id
+        self.sizes[row] = len(grams)
+        self.alive[row] = True
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = [NO_ROWS, []]
+            posting[1].append(row)
+
+    def _remove(self, chemical_id):
+        row = self.rows.pop(chemical_id, None)
+        if row is not None:
+            self.alive[row] = False
+            self.dead += 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _posting(self, gram):
+        posting = self.postings.get(gram)
+        if posting is None:
+            return NO_ROWS
+        if posting[1]:
+            posting[0] = np.concatenate(
+                [posting[0], np.array(posting[1], dtype=np.int32)])
+            posting[1] = []
+        return posting[0]
+
+    def apply(self, values, clear=False, bumped=False, generation=None):
+        super().apply(values, clear, bumped, generation)
+        with self.lock:
+            if self.dead > max(1024, len(self.rows)):
+                self.loaded = False
+
+    def search(self, q, k=10, threshold=THRESHOLD):
+        """[(chemical id, similarity)] of the k best names, best first"""
+        self.sync(db.session)
+        query = trigrams(q)
+        if not query:
+            return []
+
+        with self.lock:
+            self.searches += 1
+            # Shared trigrams per row: how often it occurs in the postings
+            common = np.bincount(
+                np.concatenate([self._posting(gram) for gram in query]),
+                minlength=self.size)
+            # Below this many shared trigrams a name cannot reach threshold
+            need = max(1, math.ceil(threshold * len(query)))
+            rows = np.flatnonzero(
+                (common >= need) & self.alive[:self.size])
+            common = common[rows]
+            similarity = common / (len(query) + self.sizes[rows] - common)
+            keep = similarity >= threshold
+            ids = self.ids[rows[keep]]
+            similarity = similarity[keep]
+
+        matches = np.arange(len(ids))
+        if len(matches) > k:
+            matches = np.argpartition(-similarity, k - 1)[:k]
+        matches = matches[np.lexsort((ids[matches], -similarity[matches]))]
+        return [(int(ids[i]), float(similarity[i])) for i in matches]
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats.update(
+                trigrams=len(self.postings),
+                dead=self.dead,
+                searches=self.searches)
+        return stats
+
+
+name_index = TrigramIndex()
+
+_pg_trgm = {}
+
+
+def has_pg_trgm(session):
+    """Whether the database has pg_trgm, checked once per process"""
+    if 'installed' not in _pg_trgm:
+        _pg_trgm['installed'] = session.execute(text(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )).scalar() is not None
+    return _pg_trgm['installed']
+
+
+def search_names(q, k=10):
+    """[(chemical id, similarity)] of the k names most like q, best first"""
+    session = db.session
+    if session.get_bind().dialect.name == 'postgresql' and \
+            has_pg_trgm(session):
+        # % matches at pg_trgm.similarity_threshold through the GIN index;
+        # text() escapes it for the driver's paramstyle
+        similarity = func.similarity(Chemical.name, q)
+        return [(chemical_id, float(score)) for chemical_id, score in
+                session.query(Chemical.id, similarity).filter(
+                    text('chemicals.name % :q').bindparams(q=q)).order_by(
+                    similarity.desc(), Chemical.id).limit(k)]
+
+    return name_index.search(q, k)
@@ -0,0 +1,109 @@
+import numpy as np
+from database.fingerprints import FINGERPRINT_BYTES, fingerprint
+from database.models import db, Chemical
+from database.indexes import ChemicalIndex
+
+# Most matches one search returns
+MAX_RESULTS = 100
+
+WORDS = FINGERPRINT_BYTES // 8
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        """Set bits per fingerprint (last axis) of uint64 words"""
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    BYTE_COUNTS = np.array(
+        [bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """Set bits per fingerprint (last axis) of uint64 words"""
+        return BYTE_COUNTS[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def to_words(packed):
+    return np.frombuffer(packed, dtype=np.uint64)
+
+
+class SimilarityIndex(ChemicalIndex):
+    """Fingerprints of every chemical in one NumPy matrix, searched by
+    Tanimoto similarity (shared bits / bits in either)"""
+
+    column = Chemical.__table__.c.fingerprint
+
+    def __init__(self, capacity=1024):
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.words = np.zeros((capacity, WORDS), dtype=np.uint64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.rows = {}
+        self.searches = 0
+        super().__init__('fingerprints')
+
+    def _reset(self):
+        self.rows.clear()
+        self.size = 0
+
+    def _set(self, chemical_id, packed):
+        row = self.rows.get(chemical_id)
+        if row is None:
+            if self.size == len(self.ids):
+                capacity = 2 * len(self.ids)
+                self.ids = np.resize(self.ids, capacity)
+                self.words = np.resize(self.words, (capacity, WORDS))
+                self.counts = np.resize(self.counts, capacity)
+            row = self.size
+            self.size += 1
+            self.rows[chemical_id] = row
+            self.ids[row] = chemical_id
+        self.words[row] = to_words(packed)
+        self.counts[row] = popcount(self.words[row])
+
+    def _remove(self, chemical_id):
+        # The last row fills the gap, keeping rows [0, size) dense
+        row = self.rows.pop(chemical_id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.words[row] = self.words[last]
+            self.counts[row] = self.counts[last]
+            self.rows[int(self.ids[row])] = row
+        self.size = last
+
+    def __len__(self):
+        return self.size
+
+    def search(self, smiles, k=10, min_similarity=0.0):
+        """[(chemical id, similarity)] of the k most similar, best first"""
+        self.sync(db.session)
+        query = to_words(fingerprint(smiles))
+        query_count = popcount(query)
+
+        with self.lock:
+            self.searches += 1
+            ids = self.ids[:self.size].copy()
+            common = popcount(self.words[:self.size] & query)
+            union = self.counts[:self.size] + query_count - common
+
+        similarity = np.divide(
+            common, union, out=np.zeros(len(ids)), where=union > 0)
+        matches = np.flatnonzero(similarity >= min_similarity)
+        if len(matches) > k:
+            matches = matches[
+                np.argpartition(-similarity[matches], k - 1)[:k]]
+        matches = matches[np.lexsort((ids[matches], -similarity[matches]))]
+        return [(int(ids[row]), float(similarity[row])) for row in matches]
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats.update(
+                capacity=len(self.ids),
+                bits=FINGERPRINT_BYTES * 8,
+                searches=self.searches)
+        return stats
+
+
+similarity_index = SimilarityIndex()
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from flask import g
+from sqlalchemy import Table, MetaData, Column, Float, create_engine, event, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
+from database.models import db, Chemical, Inventory, association_table
+
+# Read snapshot: an immutable SQLite copy of the catalogue tables, rebuilt
+# from the primary every few minutes (manage.py snapshot) and swapped in
+# with an atomic rename. Workers memory-map the newest file and serve GETs
+# from it while it is younger than the staleness bound; writes, jobs and
+# GETs past the bound go to the primary.
+
+SNAPSHOT_TABLES = (Chemical.__table__, Inventory.__table__, association_table)
+
+snapshot_info = Table(
+    'snapshot_info', MetaData(),
+    Column('built_at', Float, nullable=False))
+
+CHUNK_SIZE = 10000
+
+# Bytes of the snapshot file each connection memory-maps
+MMAP_SIZE = 1 << 30
+
+
+def build_snapshot(path, connection=None, chunk_size=CHUNK_SIZE):
+    """Copies the catalogue tables to a new SQLite file and renames it to
+    path; returns {table name: rows copied}.
+
+    Reads one consistent view of the primary (REPEATABLE READ on
+    PostgreSQL); pass connection to read inside an open transaction.
+    """
+    partial = f'{path}.{os.getpid()}.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    target = create_engine(f'sqlite:///{partial}')
+
+    @event.listens_for(target, 'connect')
+    def fast_writes(dbapi_connection, connection_record):
+        # A half-written file is thrown away, never recovered
+        dbapi_connection.execute('PRAGMA journal_mode = OFF')
+        dbapi_connection.execute('PRAGMA synchronous = OFF')
+
+    source = connection
+    if source is None:
+        source = db.engine.connect()
+        if source.dialect.name == 'postgresql':
+            source = source.execution_options(
+                isolation_level='REPEATABLE READ')
+    transaction = source.begin() if connection is None else None
+
+    copied = {}
+    try:
+        built_at = time.time()
+        with target.begin() as out:
+            for table in SNAPSHOT_TABLES:
+                out.execute(CreateTable(table))
+                result = source.execution_options(stream_results=True).execute(
+                    table.select().order_by(*table.primary_key))
+                copied[table.name] = 0
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    out.execute(table.insert(), [dict(row) for row in rows])
+                    copied[table.name] += len(rows)
+
+                # Indexed once filled, rather than maintained row by row
+                for index in table.indexes:
+                    index.create(out)
+
+            snapshot_info.create(out)
+            out.execute(snapshot_info.insert(), built_at=built_at)
+            out.execute('ANALYZE')
+    finally:
+        if transaction is not None:
+            transaction.rollback()
+            source.close()
+        target.dispose()
+
+    os.replace(partial, path)
+    return copied
+
+
+class SnapshotReader:
+    """A worker's handle on the newest snapshot file.
+
+    The file is checked at most every check_seconds and reopened when it
+    was replaced; requests already reading the old one finish on it.
+    """
+
+    def __init__(self, path=None, max_age=300, check_seconds=1):
+        self.path = path
+        self.max_age = max_age
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.engine = None
+        self.session_factory = None
+        self.built_at = None
+        self.file_id = None
+        self.checked_at = None
+        self.served = 0
+        self.stale = 0
+        self.missing = 0
+        self.swaps = 0
+
+    def open(self, path):
+        """Serves from the snapshot at path, or from the primary if None"""
+        with self.lock:
+            self.path = path
+            self.checked_at = None
+            self._swap(None)
+
+    def _swap(self, file_id):
+        if self.engine is not None:
+            self.engine.dispose()
+        self.engine = self.session_factory = self.built_at = None
+        self.file_id = file_id
+        if file_id is None:
+            return
+
+        # immutable: the file is replaced, never changed, so SQLite skips
+        # locking and change detection
+        engine = create_engine(
+            f'sqlite:///file:{self.path}?mode=ro&immutable=1&uri=true',
+            poolclass=QueuePool,
+            connect_args={'check_same_thread': False})
+
+        @event.listens_for(engine, 'connect')
+        def memory_map(dbapi_connection, connection_record):
+            dbapi_connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+
+        try:
+            built_at = engine.execute(
+                select([snapshot_info.c.built_at])).scalar()
+        except SQLAlchemyError:
+            # Not a snapshot: serve from the primary until it is replaced
+            engine.dispose()
+            return
+
+        self.engine = engine
+        self.session_factory = sessionmaker(bind=engine)
+        self.built_at = built_at
+        self.swaps += 1
+
+    def current(self):
+        """(session factory, built_at) of the newest snapshot, or
+        (None, None) without one"""
+        with self.lock:
+            now = time.monotonic()
+            if self.checked_at is None or \
+                    now - self.checked_at >= self.check_seconds:
+                self.checked_at = now
+                try:
+                    stat = os.stat(self.path)
+                    file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                except FileNotFoundError:
+                    file_id = None
+                if file_id != self.file_id:
+                    self._swap(file_id)
+            return self.session_factory, self.built_at
+
+    def session(self):
+        """(session, age in seconds) on the snapshot for a read, or
+        (None, None) if there is none or it is older than max_age"""
+        if self.path is None:
+            return None, None
+
+        session_factory, built_at = self.current()
+        age = None if built_at is None else time.time() - built_at
+        with self.lock:
+            if age is None:
+                self.missing += 1
+                return None, None
+            if age > self.max_age:
+                self.stale += 1
+                return None, None
+            self.served += 1
+        return session_factory(), age
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.path is not None,
+                'age': None if self.built_at is None
+                else round(time.time() - self.built_at, 1),
+                'max_age': self.max_age,
+                'served': self.served,
+                'stale': self.stale,
+                'missing': self.missing,
+                'swaps': self.swaps,
+            }
+
+
+snapshot = SnapshotReader(
+    os.getenv('SNAPSHOT_PATH'), float(os.getenv('SNAPSHOT_MAX_AGE', 300)))
+
+
+def begin_read():
+    """Points this GET's lookups at the snapshot if it may serve them"""
+    g.snapshot_session, g.snapshot_age = snapshot.session()
+
+
+def end_read():
+    session = g.pop('snapshot_session', None)
+    if session is not None:
+        session.close()
@@ -0,0 +1,161 @@
+from datetime import datetime
+from sqlalchemy import select, or_, text, bindparam, literal_column
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.sqltypes import DateTime, LargeBinary
+from database.fingerprints import fingerprint
+from database.properties import derive
+from database.models import db, Chemical, Inventory, association_table
+from database.cache import mark_chemicals_changed
+from database.indexes import mark_rows_changed
+
+chemicals = Chemical.__table__
+
+# Columns an upsert may change on an existing row, besides updated_on
+UPDATABLE = ('name', 'ld50', 'hazard')
+
+SQLITE_INSERT = (
+    "INSERT INTO chemicals "
+    "(name, smiles, ld50, hazard, fingerprint, formula, heavy_atoms, "
+    "mol_weight, created_on, updated_on, version) "
+    "VALUES (:name, :smiles, :ld50, :hazard, :fingerprint, :formula, "
+    ":heavy_atoms, :mol_weight, :created_on, :updated_on, 1) ")
+
+SQLITE_BINDPARAMS = (
+    bindparam('fingerprint', type_=LargeBinary()),
+    bindparam('created_on', type_=DateTime()),
+    bindparam('updated_on', type_=DateTime()))
+
+SQLITE_UPSERT = text(
+    SQLITE_INSERT +
+    "ON CONFLICT (smiles) DO UPDATE SET "
+    "name = excluded.name, ld50 = excluded.ld50, hazard = excluded.hazard, "
+    "updated_on = excluded.updated_on, version = chemicals.version + 1 "
+    "WHERE chemicals.name IS NOT excluded.name "
+    "OR chemicals.ld50 IS NOT excluded.ld50"
+).bindparams(*SQLITE_BINDPARAMS)
+
+SQLITE_INSERT_NEW = text(
+    SQLITE_INSERT + "ON CONFLICT (smiles) DO NOTHING"
+).bindparams(*SQLITE_BINDPARAMS)
+
+
+def chemical_rows(records):
+    """Column values for {name, smiles, ld50} records, derived ones included"""
+    now = datetime.now()
+    return [dict({
+        'name': record['name'],
+        'smiles': record['smiles'],
+        'ld50': record['ld50'],
+        'hazard': Chemical.hazard_for(record['ld50']),
+        'fingerprint': fingerprint(record['smiles']),
+        'created_on': now,
+        'updated_on': now,
+        'version': 1,
+    }, **derive(record['smiles'])) for record in records]
+
+
+def _upsert_postgresql(session, rows, update):
+    statement = postgresql.insert(chemicals).values(rows)
+    excluded = statement.excluded
+    if not update:
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[chemicals.c.smiles]).returning(
+            chemicals.c.smiles, chemicals.c.id)
+        return {smiles: (id, 'created')
+                for smiles, id in session.execute(statement)}
+
+    statement = statement.on_conflict_do_update(
+        index_elements=[chemicals.c.smiles],
+        set_=dict(
+            {column: excluded[column]
+             for column in UPDATABLE + ('updated_on',)},
+            version=chemicals.c.version + 1),
+        where=or_(*[chemicals.c[column].is_distinct_from(excluded[column])
+                    for column in UPDATABLE])
+    ).returning(
+        chemicals.c.smiles,
+        chemicals.c.id,
+        literal_column('xmax = 0').label('created'))
+
+    # Rows left alone by the WHERE clause are not returned: unchanged
+    return {smiles: (id, 'created' if created else 'updated')
+            for smiles, id, created in session.execute(statement)}
+
+
+def _upsert_sqlite(session, rows, existing, update):
+    statuses = {}
+    for row in rows:
+        current = existing.get(row['smiles'])
+        if current is None:
+            statuses[row['smiles']] = 'created'
+        elif update and \
+                (current.name, current.ld50) != (row['name'], row['ld50']):
+            statuses[row['smiles']] = 'updated'
+
+    session.execute(SQLITE_UPSERT if update else SQLITE_INSERT_NEW, rows)
+
+    changed = {}
+    for smiles, id in session.execute(
+            select([chemicals.c.smiles, chemicals.c.id]).where(
+                chemicals.c.smiles.in_(list(statuses)))):
+        changed[smiles] = (id, statuses[smiles])
+    return changed
+
+
+def upsert_chemicals(records, session=None, update=True):
+    """Inserts or updates chemicals keyed by SMILES in one statement.
+
+    Returns [{'id', 'smiles', 'status'}] in input order, where status is
+    'created', 'updated' or 'unchanged'. Inventories holding an updated
+    chemical get their average_hazard recomputed in the same transaction.
+    Without update, existing rows are left alone, and those that differ
+    from their record are a 'conflict'. The caller commits.
+    """
+    session = session or db.session
+    rows = chemical_rows(records)
+    existing = {row.smiles: row for row in session.execute(
+        select([chemicals.c.smiles] + [
+            chemicals.c[column] for column in UPDATABLE]).where(
+            chemicals.c.smiles.in_([row['smiles'] for row in rows])))}
+
+    if session.get_bind().dialect.name == 'postgresql':
+        changed = _upsert_postgresql(session, rows, update)
+    else:
+        changed = _upsert_sqlite(session, rows, existing, update)
+
+    # Rows left alone: equal to their record, or without update, a conflict
+    records = {row['smiles']: row for row in rows}
+    unchanged = [smiles for smiles in records if smiles not in changed]
+    if unchanged:
+        for smiles, id, name, ld50 in session.execute(select([
+                chemicals.c.smiles, chemicals.c.id, chemicals.c.name,
+                chemicals.c.ld50]).where(chemicals.c.smiles.in_(unchanged))):
+            same = (name, ld50) == (records[smiles]['name'],
+                                    records[smiles]['ld50'])
+            changed[smiles] = (id, 'unchanged' if same else 'conflict')
+
+    # Indexes see new rows, and the indexed columns that changed
+    created = {changed[row['smiles']][0]: row for row in rows
+               if changed[row['smiles']][1] == 'created'}
+    revised = {changed[row['smiles']][0]: {
+        column: row[column] for column in UPDATABLE
+        if getattr(existing[row['smiles']], column) != row[column]}
+        for row in rows if changed[row['smiles']][1] == 'updated'}
+    if created:
+        mark_rows_changed(session, created, created=True)
+    if revised:
+        mark_rows_changed(session, revised)
+
+    updated_ids = [id for id, status in changed.values()
+                   if status == 'updated']
+    if updated_ids:
+        Inventory.refresh_average_hazard(Inventory.id.in_(
+            select([association_table.c.inventory_id]).where(
+                association_table.c.chemical_id.in_(updated_ids))), session)
+        mark_chemicals_changed(session, updated_ids)
+
+    return [{
+        'id': changed[row['smiles']][0],
+        'smiles': row['smiles'],
+        'status': changed[row['smiles']][1],
+    } for row in rows]
@@ -0,0 +1,29 @@
+# Gunicorn settings, read by `gunicorn app:app` (see Procfile).
+#
+# WORKER_CLASS picks the deployment mode:
+#   sync (default)      one request at a time per worker
+#   eventlet / gevent   cooperative: up to WORKER_CONNECTIONS requests per
+#                       worker, waiting on the database or the key set
+#                       fetch without blocking each other
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+# Gunicorn's own default; size it to the host, and mind that each worker
+# holds its own connection pool (see README)
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('WORKER_TIMEOUT', 30))
+
+# Green workers monkey-patch the standard library before they import the
+# app; preloading would import it, and open its connections, unpatched.
+preload_app = False
+
+
+def post_worker_init(worker):
+    """Fetches the signing keys before the worker takes requests"""
+    from auth import auth
+    try:
+        auth.get_jwks()
+    except auth.AuthError:
+        worker.log.warning('Signing keys unavailable; fetched on demand.')
@@ -0,0 +1,201 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.sql import func
+from database.models import db, Job, Chemical, Inventory
+
+# Registered job handlers: type -> {'handler': f, 'permission': permission}
+JOB_TYPES = {}
+
+ACTIVE_STATUSES = ('pending', 'running')
+RESUMABLE_STATUSES = ('failed', 'cancelled')
+
+IMPORT_CHUNK_SIZE = 500
+ROLLUP_CHUNK_SIZE = 500
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def job_type(name, permission):
+    """Registers a job handler, submittable by holders of permission"""
+    def job_type_decorator(f):
+        JOB_TYPES[name] = {
+            'handler': f,
+            'permission': permission
+        }
+        return f
+    return job_type_decorator
+
+
+class JobContext:
+    """What a handler sees: its own session, its params and its checkpoint"""
+
+    def __init__(self, session, job):
+        self.session = session
+        self.job = job
+        self.params = job.params or {}
+        self.checkpoint = job.checkpoint
+
+    def save(self, done, total=None, checkpoint=None):
+        """Commits pending work together with progress and checkpoint.
+
+        Raises JobCancelled once a cancel was requested, so the job stops
+        at a checkpoint it can be resumed from.
+        """
+        self.job.done = done
+        if total is not None:
+            self.job.total = total
+        self.job.checkpoint = checkpoint
+        self.checkpoint = checkpoint
+        self.session.commit()
+
+        self.session.refresh(self.job, ['cancel_requested'])
+        if self.job.cancel_requested:
+            raise JobCancelled()
+
+
+class JobRunner:
+    """Runs jobs on a bounded thread pool, each with its own session.
+
+    Jobs live only in the pool of the worker that accepted them. A running
+    job commits its progress at every checkpoint, which bumps updated_on;
+    an active job with nothing committed for lease seconds is taken to have
+    lost its worker. recover() fails those at startup, and they can be
+    cancelled or resumed from their checkpoint at any time, so a chunk of
+    work must take well under a lease.
+    """
+
+    def __init__(self, app, max_workers=2, max_pending=100, lease=600):
+        self.app = app
+        self.lease = lease
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='job')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.session_factory = db.create_session({})
+        app.extensions['jobs'] = self
+
+    def is_stale(self, job):
+        """Whether an active job's worker stopped committing progress"""
+        return job.status in ACTIVE_STATUSES and \
+            job.updated_on < datetime.now() - timedelta(seconds=self.lease)
+
+    def recover(self):
+        """Fails the stale active jobs, left behind by a worker that died,
+        so they can be resumed; returns how many"""
+        with self.app.app_context():
+            session = self.session_factory()
+            try:
+                jobs = session.query(Job).filter(
+                    Job.status.in_(ACTIVE_STATUSES),
+                    Job.updated_on < datetime.now() - timedelta(
+                        seconds=self.lease)).with_for_update().all()
+                for job in jobs:
+                    job.status = 'failed'
+                    job.error = 'Interrupted: no progress for ' \
+                        f'{self.lease} seconds.'
+                session.commit()
+                return len(jobs)
+            except (OperationalError, ProgrammingError):
+                # No jobs table yet: nothing to recover
+                session.rollback()
+                return 0
+            finally:
+                session.close()
+
+    def submit(self, job_id):
+        if not self.slots.acquire(blocking=False):
+            raise JobQueueFull()
+
+        future = self.executor.submit(self.run, job_id)
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def run(self, job_id):
+        with self.app.app_context():
+            session = self.session_factory()
+            try:
+                self._run(session, job_id)
+            finally:
+                session.close()
+
+    def _run(self, session, job_id):
+        job = session.query(Job).get(job_id)
+        # Failed as stale while queued; it is resumed explicitly
+        if job.status != 'pending':
+            return
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            session.commit()
+            return
+
+        job.status = 'running'
+        session.commit()
+
+        try:
+            handler = JOB_TYPES[job.type]['handler']
+            job.result = handler(JobContext(session, job))
+            job.status = 'succeeded'
+
+        except JobCancelled:
+            job.status = 'cancelled'
+
+        except Exception as error:
+            session.rollback()
+            job = session.query(Job).get(job_id)
+            job.status = 'failed'
+            job.error = f'{type(error).__name__}: {error}'
+
+        session.commit()
+
+
+# -------------------
+# JOB TYPES
+# -------------------
+
+
+@job_type('import_chemicals', 'post:chemicals')
+def import_chemicals(context):
+    """Inserts params['chemicals'] in chunks, resuming at the next row"""
+    rows = context.params['chemicals']
+    start = context.checkpoint or 0
+
+    for offset in range(start, len(rows), IMPORT_CHUNK_SIZE):
+        chunk = rows[offset:offset + IMPORT_CHUNK_SIZE]
+        context.session.add_all([
+            Chemical(name=row['name'], smiles=row['smiles'], ld50=row['ld50'])
+            for row in chunk])
+        context.save(offset + len(chunk), len(rows), offset + len(chunk))
+
+    return {'imported': len(rows)}
+
+
+@job_type('recompute_hazards', 'patch:inventories')
+def recompute_hazards(context):
+    """Recomputes every inventory's average_hazard, resuming after an id"""
+    session = context.session
+    last_id = context.checkpoint or 0
+    total = session.query(func.count(Inventory.id)).scalar()
+    done = session.query(func.count(Inventory.id)).filter(
+        Inventory.id <= last_id).scalar()
+
+    while True:
+        ids = [id for id, in session.query(Inventory.id).filter(
+            Inventory.id > last_id).order_by(
+            Inventory.id).limit(ROLLUP_CHUNK_SIZE)]
+        if not ids:
+            break
+
+        Inventory.refresh_average_hazard(Inventory.id.in_(ids), session)
+        last_id = ids[-1]
+        done += len(ids)
+        context.save(done, total, last_id)
+
+    return {'inventories': done}
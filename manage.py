@@ -1,13 +1,53 @@
+import os
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from database.models import db
+from database.models import db, Chemical
+from database.cache import BUCKET_NAMES, bump_generations
+from database import properties
+from database.snapshot import build_snapshot
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=1000)
+@manager.option('--all', dest='recompute', action='store_true',
+                help='Recompute every row, not only rows missing them')
+def backfill_properties(batch_size, recompute):
+    """Derives formula, heavy_atoms and mol_weight of existing chemicals"""
+    # Each batch's UPDATE commits on its own, so a long backfill holds no
+    # locks and can be interrupted and rerun
+    with db.engine.connect() as connection:
+        written = properties.backfill(
+            connection, Chemical.__table__, batch_size,
+            missing_only=not recompute)
+    with db.engine.begin() as connection:
+        bump_generations(connection, BUCKET_NAMES)
+    print(f'Derived properties of {written} chemicals.')
+
+
+@manager.option('--path', dest='path', default=os.getenv('SNAPSHOT_PATH'))
+@manager.option('--every', dest='every', type=float, default=None,
+                help='Rebuild every EVERY seconds until interrupted')
+def snapshot(path, every):
+    """Builds the read snapshot GETs are served from (SNAPSHOT_PATH)"""
+    if not path:
+        raise SystemExit('Set SNAPSHOT_PATH or pass --path.')
+
+    while True:
+        start = time.monotonic()
+        copied = build_snapshot(path)
+        print(f'Wrote {path} in {time.monotonic() - start:.1f} s: ' + ', '.join(
+            f'{rows} {table}' for table, rows in copied.items()))
+        if every is None:
+            break
+        time.sleep(max(0, every - (time.monotonic() - start)))
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -0,0 +1,28 @@
+"""add version columns for optimistic locking
+
+Revision ID: 3f9c2a7d1b04
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d1b04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chemicals', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('inventories', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('inventories', 'version')
+    op.drop_column('chemicals', 'version')
@@ -0,0 +1,47 @@
+"""index inventories for filtered and sorted listing
+
+Revision ID: a7c3e5f91d28
+Revises: f3b8d2c6a410
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e5f91d28'
+down_revision = 'f3b8d2c6a410'
+branch_labels = None
+depends_on = None
+
+# GET /inventories' ?location= and ?min_hazard= filters and its ?sort=
+# keys, each with id as the tie-break
+INDEXES = (
+    ('ix_inventories_location_average_hazard',
+     ['location', 'average_hazard', 'id']),
+    ('ix_inventories_location_updated_on', ['location', 'updated_on', 'id']),
+    ('ix_inventories_average_hazard', ['average_hazard', 'id']),
+    ('ix_inventories_updated_on', ['updated_on', 'id']),
+)
+
+
+def upgrade():
+    for name, columns in INDEXES:
+        op.create_index(name, 'inventories', columns)
+
+    # ?location_prefix= is a LIKE 'prefix%'; without the C collation a
+    # PostgreSQL btree serves it only with pattern ops
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_index(
+            'ix_inventories_location_pattern', 'inventories', ['location'],
+            postgresql_ops={'location': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_inventories_location_pattern',
+                      table_name='inventories')
+
+    for name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name='inventories')
@@ -0,0 +1,34 @@
+"""recompute chemical hazards that drifted from ld50
+
+Revision ID: b6d1f0e83c57
+Revises: a7c3e5f91d28
+Create Date: 2026-10-20 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d1f0e83c57'
+down_revision = 'a7c3e5f91d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # PATCH /chemicals/<id> used to change ld50 without hazard; recompute
+    # hazard as Chemical.hazard_for does, then the averages built from it
+    op.execute(
+        "UPDATE chemicals SET hazard = (1.0 / ld50) / 0.5 "
+        "WHERE hazard <> (1.0 / ld50) / 0.5")
+    op.execute(
+        "UPDATE inventories SET average_hazard = ("
+        "SELECT avg(chemicals.hazard) FROM association, chemicals "
+        "WHERE association.inventory_id = inventories.id "
+        "AND association.chemical_id = chemicals.id)")
+
+
+def downgrade():
+    # The drifted values are not worth restoring
+    pass
@@ -0,0 +1,60 @@
+"""add chemical fingerprints for similarity search
+
+Revision ID: b81e5d0c3a27
+Revises: 3f9c2a7d1b04
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database.fingerprints import fingerprint
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81e5d0c3a27'
+down_revision = '3f9c2a7d1b04'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column('chemicals', sa.Column(
+        'fingerprint', sa.LargeBinary(), nullable=True))
+
+    chemicals = sa.table(
+        'chemicals',
+        sa.column('id', sa.Integer),
+        sa.column('smiles', sa.String),
+        sa.column('fingerprint', sa.LargeBinary))
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([chemicals.c.id, chemicals.c.smiles]).where(
+                chemicals.c.id > last_id).order_by(
+                chemicals.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            chemicals.update().where(
+                chemicals.c.id == sa.bindparam('chemical_id')).values(
+                fingerprint=sa.bindparam('packed')),
+            [{'chemical_id': id, 'packed': fingerprint(smiles)}
+             for id, smiles in rows])
+        last_id = rows[-1].id
+
+    # Importing the app creates cache_generations with its rows seeded
+    if 'cache_generations' in sa.inspect(connection).get_table_names():
+        op.execute(
+            "INSERT INTO cache_generations (name, value) "
+            "SELECT 'fingerprints', 0 WHERE NOT EXISTS ("
+            "SELECT 1 FROM cache_generations WHERE name = 'fingerprints')")
+
+
+def downgrade():
+    if 'cache_generations' in sa.inspect(op.get_bind()).get_table_names():
+        op.execute(
+            "DELETE FROM cache_generations WHERE name = 'fingerprints'")
+    op.drop_column('chemicals', 'fingerprint')
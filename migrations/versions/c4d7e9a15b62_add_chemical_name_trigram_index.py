@@ -0,0 +1,47 @@
+"""add trigram index on chemical names for fuzzy search
+
+Revision ID: c4d7e9a15b62
+Revises: b81e5d0c3a27
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d7e9a15b62'
+down_revision = 'b81e5d0c3a27'
+branch_labels = None
+depends_on = None
+
+
+def has_pg_trgm(connection):
+    return connection.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar() is not None
+
+
+def upgrade():
+    connection = op.get_bind()
+    # Without pg_trgm, names are searched by the in-process index
+    if connection.dialect.name == 'postgresql' and has_pg_trgm(connection):
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_chemicals_name_trgm "
+            "ON chemicals USING gin (name gin_trgm_ops)")
+
+    # Importing the app creates cache_generations with its rows seeded
+    if 'cache_generations' in sa.inspect(connection).get_table_names():
+        op.execute(
+            "INSERT INTO cache_generations (name, value) "
+            "SELECT 'names', 0 WHERE NOT EXISTS ("
+            "SELECT 1 FROM cache_generations WHERE name = 'names')")
+
+
+def downgrade():
+    connection = op.get_bind()
+    if 'cache_generations' in sa.inspect(connection).get_table_names():
+        op.execute("DELETE FROM cache_generations WHERE name = 'names'")
+    if connection.dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_chemicals_name_trgm")
@@ -0,0 +1,42 @@
+"""add the jobs table of the background job runner
+
+Revision ID: c9e2a4f6b751
+Revises: b6d1f0e83c57
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e2a4f6b751'
+down_revision = 'b6d1f0e83c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases built with db.create_all() already have it
+    if 'jobs' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('params', sa.JSON(), nullable=True),
+        sa.Column('done', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('checkpoint', sa.JSON(), nullable=True),
+        sa.Column('result', sa.JSON(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+        sa.Column('created_on', sa.DateTime(), nullable=False),
+        sa.Column('updated_on', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('jobs')
@@ -0,0 +1,53 @@
+"""add derived chemical properties: formula, heavy_atoms, mol_weight
+
+Revision ID: d52f8b3e6a19
+Revises: c4d7e9a15b62
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import properties
+
+
+# revision identifiers, used by Alembic.
+revision = 'd52f8b3e6a19'
+down_revision = 'c4d7e9a15b62'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column('chemicals', sa.Column('formula', sa.String(), nullable=True))
+    op.add_column('chemicals', sa.Column(
+        'heavy_atoms', sa.Integer(), nullable=True))
+    op.add_column('chemicals', sa.Column(
+        'mol_weight', sa.Float(), nullable=True))
+
+    chemicals = sa.table(
+        'chemicals',
+        sa.column('id', sa.Integer),
+        sa.column('smiles', sa.String),
+        sa.column('formula', sa.String),
+        sa.column('heavy_atoms', sa.Integer),
+        sa.column('mol_weight', sa.Float))
+    properties.backfill(op.get_bind(), chemicals, BATCH_SIZE)
+
+    # Indexed once filled, rather than maintained through the backfill
+    op.create_index(
+        op.f('ix_chemicals_formula'), 'chemicals', ['formula'])
+    op.create_index(
+        op.f('ix_chemicals_heavy_atoms'), 'chemicals', ['heavy_atoms'])
+    op.create_index(
+        op.f('ix_chemicals_mol_weight'), 'chemicals', ['mol_weight'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_chemicals_mol_weight'), table_name='chemicals')
+    op.drop_index(op.f('ix_chemicals_heavy_atoms'), table_name='chemicals')
+    op.drop_index(op.f('ix_chemicals_formula'), table_name='chemicals')
+    op.drop_column('chemicals', 'mol_weight')
+    op.drop_column('chemicals', 'heavy_atoms')
+    op.drop_column('chemicals', 'formula')
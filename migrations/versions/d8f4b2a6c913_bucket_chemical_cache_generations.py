@@ -0,0 +1,38 @@
+"""split the chemical cache generation into buckets
+
+Revision ID: d8f4b2a6c913
+Revises: c9e2a4f6b751
+Create Date: 2026-10-20 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8f4b2a6c913'
+down_revision = 'c9e2a4f6b751'
+branch_labels = None
+depends_on = None
+
+# database/cache.py's BUCKET_NAMES
+CACHE_BUCKETS = 64
+BUCKET_NAMES = [f'chemicals/{bucket}' for bucket in range(CACHE_BUCKETS)]
+
+
+def upgrade():
+    if 'cache_generations' in sa.inspect(op.get_bind()).get_table_names():
+        op.execute("DELETE FROM cache_generations WHERE name = 'chemicals'")
+        # Importing the app creates cache_generations with its rows seeded
+        for name in BUCKET_NAMES:
+            op.execute(
+                "INSERT INTO cache_generations (name, value) "
+                f"SELECT '{name}', 0 WHERE NOT EXISTS ("
+                f"SELECT 1 FROM cache_generations WHERE name = '{name}')")
+
+
+def downgrade():
+    if 'cache_generations' in sa.inspect(op.get_bind()).get_table_names():
+        op.execute("DELETE FROM cache_generations WHERE name LIKE 'chemicals/%'")
+        op.execute(
+            "INSERT INTO cache_generations (name, value) VALUES ('chemicals', 0)")
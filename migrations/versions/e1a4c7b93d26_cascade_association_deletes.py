@@ -0,0 +1,46 @@
+"""cascade association rows on delete; index association.inventory_id
+
+Revision ID: e1a4c7b93d26
+Revises: d52f8b3e6a19
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1a4c7b93d26'
+down_revision = 'd52f8b3e6a19'
+branch_labels = None
+depends_on = None
+
+# PostgreSQL's names for the foreign keys created by db.create_all()
+FOREIGN_KEYS = (
+    ('association_chemical_id_fkey', 'chemicals', 'chemical_id'),
+    ('association_inventory_id_fkey', 'inventories', 'inventory_id'),
+)
+
+
+def replace_foreign_keys(ondelete):
+    for name, table, column in FOREIGN_KEYS:
+        op.drop_constraint(name, 'association', type_='foreignkey')
+        op.create_foreign_key(
+            name, 'association', table, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    # SQLite does not enforce foreign keys here; deletes clear the
+    # association rows explicitly there
+    if op.get_bind().dialect.name == 'postgresql':
+        replace_foreign_keys('CASCADE')
+
+    op.create_index(
+        op.f('ix_association_inventory_id'), 'association', ['inventory_id'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_association_inventory_id'), table_name='association')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        replace_foreign_keys(None)
@@ -0,0 +1,35 @@
+"""add cache generations of the hazard engine
+
+Revision ID: f3b8d2c6a410
+Revises: e1a4c7b93d26
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2c6a410'
+down_revision = 'e1a4c7b93d26'
+branch_labels = None
+depends_on = None
+
+# ld50 array and membership matrix of database/hazards.py
+GENERATIONS = ('hazards', 'memberships')
+
+
+def upgrade():
+    # Importing the app creates cache_generations with its rows seeded
+    if 'cache_generations' in sa.inspect(op.get_bind()).get_table_names():
+        for name in GENERATIONS:
+            op.execute(
+                "INSERT INTO cache_generations (name, value) "
+                f"SELECT '{name}', 0 WHERE NOT EXISTS ("
+                f"SELECT 1 FROM cache_generations WHERE name = '{name}')")
+
+
+def downgrade():
+    if 'cache_generations' in sa.inspect(op.get_bind()).get_table_names():
+        for name in GENERATIONS:
+            op.execute(f"DELETE FROM cache_generations WHERE name = '{name}'")
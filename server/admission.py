@@ -0,0 +1,165 @@
+import math
+import os
+import threading
+import time
+from functools import wraps
+from flask import request, make_response
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+# Clients whose buckets are kept before idle, full ones are dropped
+MAX_CLIENTS = 10000
+
+
+class AdmissionController:
+    """Refuses work a worker cannot start now, instead of queueing it.
+
+    An admitted request holds its route's weight against the worker's
+    capacity and one of the route's concurrency slots until its response
+    is closed; a request that would exceed either gets 503 at once. Each
+    client (JWT sub) also draws the weight from a token bucket refilled at
+    rate per second up to burst; an empty bucket gets 429. Both carry
+    Retry-After.
+    """
+
+    def __init__(self, capacity=32, rate=20.0, burst=100.0, retry_after=1):
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.active = {}
+        self.buckets = {}
+        self.admitted = 0
+        self.shed = {'capacity': 0, 'route': 0, 'client': 0}
+
+    def _tokens(self, client, now):
+        tokens, updated_at = self.buckets.get(client, (self.burst, now))
+        return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+    def _prune(self, now):
+        # Buckets idle long enough to have refilled are the default anyway
+        idle = self.burst / self.rate if self.rate else math.inf
+        for client, (_, updated_at) in list(self.buckets.items()):
+            if now - updated_at >= idle:
+                del self.buckets[client]
+
+    def acquire(self, route, client, weight, limit=None):
+        """Admits a request or raises TooManyRequests / ServiceUnavailable"""
+        now = time.monotonic()
+        cost = min(weight, self.burst)
+        with self.lock:
+            tokens = self._tokens(client, now)
+            if tokens < cost:
+                self.shed['client'] += 1
+                wait = (cost - tokens) / self.rate if self.rate else 60
+                raise TooManyRequests(
+                    'Request quota exceeded. Try again later.',
+                    retry_after=max(1, math.ceil(wait)))
+
+            if limit is not None and self.active.get(route, 0) >= limit:
+                self.shed['route'] += 1
+                raise ServiceUnavailable(
+                    'Too many requests to this route. Try again later.',
+                    retry_after=self.retry_after)
+
+            if self.in_use + weight > self.capacity:
+                self.shed['capacity'] += 1
+                raise ServiceUnavailable(
+                    'Server is at capacity. Try again later.',
+                    retry_after=self.retry_after)
+
+            if client not in self.buckets and \
+                    len(self.buckets) >= MAX_CLIENTS:
+                self._prune(now)
+            self.buckets[client] = (tokens - cost, now)
+            self.active[route] = self.active.get(route, 0) + 1
+            self.in_use += weight
+            self.admitted += 1
+
+    def release(self, route, weight):
+        with self.lock:
+            self.active[route] -= 1
+            if not self.active[route]:
+                del self.active[route]
+            self.in_use -= weight
+
+    def stats(self):
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'client_rate': self.rate,
+                'client_burst': self.burst,
+                'in_use': self.in_use,
+                'in_flight': sum(self.active.values()),
+                'active': dict(self.active),
+                'clients': len(self.buckets),
+                'admitted': self.admitted,
+                'shed': dict(self.shed),
+            }
+
+
+def per_worker(quota):
+    """Share of a deployment-wide client quota each of the WEB_CONCURRENCY
+    workers enforces. Buckets are per worker and a client's requests are
+    spread over the workers, so each holds quota / workers; with uneven
+    balancing a client gets somewhat less than the quota."""
+    return quota / max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+
+
+admission = AdmissionController(
+    capacity=int(os.getenv('ADMISSION_CAPACITY', 32)),
+    rate=per_worker(float(os.getenv('ADMISSION_CLIENT_RATE', 20))),
+    burst=per_worker(float(os.getenv('ADMISSION_CLIENT_BURST', 100))))
+
+
+def admit(weight=1, limit=None):
+    """Admission control for a route: weight against the worker's
+    capacity and the client's quota, at most limit running at once.
+
+    Goes below requires_auth (clients are JWT subs) and below coalesce, so
+    requests sharing a coalesced call are admitted once. Streamed
+    responses hold their weight until they finish.
+    """
+    def admit_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            route = request.endpoint
+            admission.acquire(route, payload.get('sub'), weight, limit)
+            try:
+                response = make_response(f(payload, *args, **kwargs))
+            except BaseException:
+                admission.release(route, weight)
+                raise
+
+            if response.is_streamed:
+                release = _once(lambda: admission.release(route, weight))
+                response.response = _releasing(response.response, release)
+                response.call_on_close(release)
+            else:
+                admission.release(route, weight)
+            return response
+        return wrapper
+    return admit_decorator
+
+
+def _once(f):
+    lock = threading.Lock()
+    called = []
+
+    def call_once():
+        with lock:
+            if called:
+                return
+            called.append(True)
+        f()
+    return call_once
+
+
+def _releasing(body, release):
+    # A streamed body releases its weight once sent in full, or when the
+    # server closes it early
+    try:
+        yield from body
+    finally:
+        release()
@@ -0,0 +1,92 @@
+import os
+import sys
+from psycopg2 import OperationalError, extensions
+
+# Cooperative workers (gunicorn -k eventlet / -k gevent) monkey-patch the
+# standard library before the app is imported, so sockets, locks and
+# threads yield to other requests. psycopg2 talks to libpq directly and
+# needs a wait callback for the same; without one a slow query stalls
+# every request on the worker.
+
+
+def green_library():
+    """'eventlet' or 'gevent' if it monkey-patched this process, else None"""
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            return 'gevent'
+    return None
+
+
+def _wait(conn, wait_read, wait_write):
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno())
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno())
+        else:
+            raise OperationalError(f'Bad result from poll: {state}')
+
+
+def eventlet_wait_callback(conn, timeout=-1):
+    from eventlet.hubs import trampoline
+    _wait(conn,
+          lambda fileno: trampoline(fileno, read=True),
+          lambda fileno: trampoline(fileno, write=True))
+
+
+def gevent_wait_callback(conn, timeout=None):
+    from gevent.socket import wait_read, wait_write
+    _wait(conn, wait_read, wait_write)
+
+
+WAIT_CALLBACKS = {
+    'eventlet': eventlet_wait_callback,
+    'gevent': gevent_wait_callback,
+}
+
+
+def patch_psycopg():
+    """Makes psycopg2 yield while waiting on the server under a green
+    worker; returns the green library, or None under threads.
+
+    Must run before the first connection: connections opened earlier stay
+    blocking.
+    """
+    library = green_library()
+    if library is not None:
+        extensions.set_wait_callback(WAIT_CALLBACKS[library])
+    return library
+
+
+def pool_options(database_url, green=None):
+    """SQLALCHEMY_ENGINE_OPTIONS sizing the connection pool per worker.
+
+    A sync worker runs one request at a time and a threaded one a handful,
+    so SQLAlchemy's default pool (5 + 10 overflow) fits. A green worker
+    runs up to worker_connections requests at once: the pool, not the
+    worker, bounds database concurrency, with no overflow so workers x
+    DB_POOL_SIZE stays under the server's max_connections, and a short
+    DB_POOL_TIMEOUT so a request waiting for a connection fails fast.
+    """
+    if not database_url or database_url.startswith('sqlite'):
+        return {}
+
+    if green is None:
+        defaults = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30}
+    else:
+        defaults = {'pool_size': 10, 'max_overflow': 0, 'pool_timeout': 5}
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', defaults['pool_size'])),
+        'max_overflow': int(
+            os.getenv('DB_MAX_OVERFLOW', defaults['max_overflow'])),
+        'pool_timeout': float(
+            os.getenv('DB_POOL_TIMEOUT', defaults['pool_timeout'])),
+    }
@@ -0,0 +1,186 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from werkzeug.exceptions import ServiceUnavailable
+from database.models import db
+
+
+class GroupCommitter:
+    """Commits concurrent single-row writes in one transaction.
+
+    A write is a function of a session that makes its changes and returns
+    the response data. With a window, request threads hand their writes to
+    a committer thread, which takes whatever arrives within window seconds
+    of the first (up to max_batch), runs each in its own SAVEPOINT and
+    commits once: one fsync for the batch instead of one per row. A write
+    that raises is rolled back to its savepoint and gets its exception
+    alone. If the commit itself fails, the batch is retried one write per
+    transaction.
+
+    Without a window, writes run and commit on the request's db.session.
+    A request waits up to timeout seconds for its batch. A write the
+    committer has not started by then is withdrawn and commits directly,
+    as without a window; one already running gets 503, since it may still
+    commit.
+    SQLite gets no window: pysqlite's implicit transactions commit at the
+    first savepoint's release.
+    Writes must not touch the request (it is another thread's) nor fail
+    after their last flush: a savepoint rolled back after a flush leaves
+    its cache invalidations behind, which is harmless.
+    """
+
+    def __init__(self, app, window=0.0, max_batch=64, timeout=5.0,
+                 retry_after=1):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.session_factory = db.create_session({})
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self.retried = 0
+        self.largest = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+        app.extensions['group_commit'] = self
+
+    def run(self, write):
+        """Result of write(session) once committed, or its exception"""
+        if not self.window:
+            return self._run_direct(write)
+
+        future = self.submit(write)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if not future.cancel():
+                with self.lock:
+                    self.timeouts += 1
+                raise ServiceUnavailable(
+                    'The write is still committing. '
+                    'Check whether it took effect before retrying.',
+                    retry_after=self.retry_after)
+        with self.lock:
+            self.fallbacks += 1
+        return self._run_direct(write)
+
+    @staticmethod
+    def _run_direct(write):
+        session = db.session()
+        try:
+            result = write(session)
+            session.commit()
+            return result
+        except BaseException:
+            session.rollback()
+            raise
+
+    def submit(self, write):
+        future = Future()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._loop, name='group-commit', daemon=True)
+                self.thread.start()
+        self.queue.put((write, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.app.app_context():
+                    self._commit(batch)
+            except BaseException as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _commit(self, batch):
+        batch = [(write, future) for write, future in batch
+                 if future.set_running_or_notify_cancel()]
+        session = self.session_factory()
+        try:
+            outcomes = []
+            for write, future in batch:
+                try:
+                    with session.begin_nested():
+                        outcomes.append((future, write(session), None))
+                except BaseException as error:
+                    outcomes.append((future, None, error))
+
+            try:
+                session.commit()
+            except BaseException:
+                session.rollback()
+                self._commit_each(session, batch)
+                return
+
+            with self.lock:
+                self.batches += 1
+                self.writes += len(batch)
+                self.failed += sum(error is not None for *_, error in outcomes)
+                self.largest = max(self.largest, len(batch))
+            for future, result, error in outcomes:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+        finally:
+            session.close()
+
+    def _commit_each(self, session, batch):
+        with self.lock:
+            self.retried += len(batch)
+        for write, future in batch:
+            try:
+                result = write(session)
+                session.commit()
+            except BaseException as error:
+                session.rollback()
+                with self.lock:
+                    self.writes += 1
+                    self.failed += 1
+                future.set_exception(error)
+            else:
+                with self.lock:
+                    self.batches += 1
+                    self.writes += 1
+                future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': bool(self.window),
+                'window_ms': self.window * 1000,
+                'batches': self.batches,
+                'writes': self.writes,
+                'writes_per_batch': round(self.writes / self.batches, 2)
+                if self.batches else None,
+                'largest_batch': self.largest,
+                'failed': self.failed,
+                'retried': self.retried,
+                'timeout_ms': self.timeout * 1000,
+                'fallbacks': self.fallbacks,
+                'timeouts': self.timeouts,
+                'queued': self.queue.qsize(),
+            }
@@ -0,0 +1,222 @@
+import cProfile
+import itertools
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+from flask import g, request
+from auth.auth import AuthError, get_token_auth_header, verify_decode_jwt, check_permissions
+from database.models import db
+
+# Permission of GET /admin/profiles and of the X-Profile request header
+PERMISSION = 'get:profiles'
+
+
+class RequestProfiler:
+    """Profiles sampled requests: peak and retained Python allocations
+    (tracemalloc), the sessions' identity-map sizes at teardown (the
+    instances still referenced from somewhere) and a cProfile of the
+    handler thread.
+
+    A request is profiled with probability sample_rate, or when it carries
+    an X-Profile header and a bearer token with the get:profiles
+    permission. Otherwise the only cost is the check in before_request.
+
+    tracemalloc is process-wide, so one request is profiled at a time (a
+    sampled request arriving meanwhile is skipped) and allocations of
+    requests running alongside it are counted too. Tracing starts with the
+    request and stops with it unless something else started it, so
+    retained allocations are those made during the request and still alive
+    at its teardown.
+    """
+
+    def __init__(self, app, sample_rate=0.0, frames=1, top=20, keep=50):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.top = top
+        self.profiles = deque(maxlen=keep)
+        self.routes = {}
+        self.ids = itertools.count(1)
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+        self.profiled = 0
+        self.skipped = 0
+        app.before_request(self._begin)
+        app.teardown_request(self._end)
+        app.extensions['profiler'] = self
+
+    def _requested(self):
+        """Whether the request asks to be profiled with admin rights"""
+        try:
+            check_permissions(
+                PERMISSION, verify_decode_jwt(get_token_auth_header()))
+        except AuthError:
+            return False
+        return True
+
+    def _begin(self):
+        if not self.sample_rate and 'X-Profile' not in request.headers:
+            return
+        if 'X-Profile' in request.headers:
+            if not self._requested():
+                return
+        elif random.random() >= self.sample_rate:
+            return
+
+        if not self.busy.acquire(blocking=False):
+            with self.lock:
+                self.skipped += 1
+            return
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.frames)
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        g.profile = {
+            'started': started,
+            'before': before,
+            'base': tracemalloc.get_traced_memory()[0],
+            'profile': profile,
+            'start': time.perf_counter(),
+        }
+        profile.enable()
+
+    def _end(self, error):
+        state = g.pop('profile', None)
+        if state is None:
+            return
+        try:
+            state['profile'].disable()
+            duration = time.perf_counter() - state['start']
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            if state['started']:
+                tracemalloc.stop()
+            self._record(state, duration, current, peak, after)
+        finally:
+            self.busy.release()
+
+    @staticmethod
+    def _identity_maps():
+        sizes = {}
+        if db.session.registry.has():
+            sizes['session'] = len(db.session().identity_map)
+        snapshot_session = g.get('snapshot_session')
+        if snapshot_session is not None:
+            sizes['snapshot_session'] = len(snapshot_session.identity_map)
+        return sizes
+
+    def _allocators(self, before, after):
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = after.filter_traces(filters).compare_to(
+            before.filter_traces(filters), 'lineno')
+        return [{
+            'location': f'{stat.traceback[0].filename}:'
+                        f'{stat.traceback[0].lineno}',
+            'size': stat.size_diff,
+            'count': stat.count_diff,
+        } for stat in stats[:self.top] if stat.size_diff > 0]
+
+    def _functions(self, profile):
+        stats = pstats.Stats(profile).stats
+        functions = sorted(
+            stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [{
+            'function': f'{filename}:{lineno}({name})',
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        } for (filename, lineno, name), (_, calls, tottime, cumtime, _)
+            in functions[:self.top]]
+
+    def _record(self, state, duration, current, peak, after):
+        route = f'{request.method} ' \
+            f'{request.url_rule.rule if request.url_rule else request.path}'
+        profile = {
+            'id': next(self.ids),
+            'route': route,
+            'path': request.full_path.rstrip('?'),
+            'duration_ms': round(1000 * duration, 3),
+            'peak_bytes': peak - state['base'],
+            'retained_bytes': current - state['base'],
+            'identity_map': self._identity_maps(),
+            'allocators': self._allocators(state['before'], after),
+            'functions': self._functions(state['profile']),
+        }
+        with self.lock:
+            self.profiled += 1
+            self.profiles.append(profile)
+            totals = self.routes.setdefault(route, {
+                'profiled': 0,
+                'peak_bytes_max': 0,
+                'peak_bytes_total': 0,
+                'identity_map_max': 0,
+            })
+            totals['profiled'] += 1
+            totals['peak_bytes_max'] = max(
+                totals['peak_bytes_max'], profile['peak_bytes'])
+            totals['peak_bytes_total'] += profile['peak_bytes']
+            totals['identity_map_max'] = max(
+                [totals['identity_map_max'], *profile['identity_map'].values()])
+
+    # Reports
+
+    def get(self, profile_id):
+        with self.lock:
+            for profile in self.profiles:
+                if profile['id'] == profile_id:
+                    return profile
+        return None
+
+    def top_allocators(self):
+        """Allocation sites by bytes retained, over the kept profiles"""
+        sites = {}
+        with self.lock:
+            for profile in self.profiles:
+                for allocator in profile['allocators']:
+                    site = sites.setdefault(allocator['location'], {
+                        'location': allocator['location'],
+                        'size': 0,
+                        'count': 0,
+                        'profiles': 0,
+                    })
+                    site['size'] += allocator['size']
+                    site['count'] += allocator['count']
+                    site['profiles'] += 1
+        return sorted(
+            sites.values(), key=lambda site: site['size'],
+            reverse=True)[:self.top]
+
+    def report(self):
+        with self.lock:
+            routes = {route: {
+                'profiled': totals['profiled'],
+                'peak_bytes_max': totals['peak_bytes_max'],
+                'peak_bytes_mean': totals['peak_bytes_total']
+                // totals['profiled'],
+                'identity_map_max': totals['identity_map_max'],
+            } for route, totals in self.routes.items()}
+            profiles = [{
+                key: profile[key] for key in (
+                    'id', 'route', 'path', 'duration_ms', 'peak_bytes',
+                    'retained_bytes', 'identity_map')
+            } for profile in self.profiles]
+        return {
+            'routes': routes,
+            'top_allocators': self.top_allocators(),
+            'profiles': profiles,
+        }
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'profiled': self.profiled,
+                'skipped': self.skipped,
+                'kept': len(self.profiles),
+            }
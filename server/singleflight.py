@@ -0,0 +1,105 @@
+import os
+import threading
+from functools import wraps
+from flask import Response, request, make_response, abort
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Shares one computation between concurrent callers of the same key.
+
+    The first caller (the leader) runs the function; callers arriving while
+    it runs wait for its result, or get its exception re-raised.
+    """
+
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+
+    def do(self, key, f):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if leader:
+            try:
+                call.result = f()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        elif not call.done.wait(self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise SingleFlightTimeout()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'timeouts': self.timeouts,
+            }
+
+
+flights = SingleFlight(float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 10)))
+
+
+def coalesce(f):
+    """Coalesces concurrent identical GETs into one call of the route.
+
+    Goes below requires_auth: requests share a response only when they hit
+    the same endpoint with the same arguments and the same permissions.
+    Every request gets its own Response around the one encoded body.
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = (
+            request.endpoint,
+            tuple(sorted(request.view_args.items())),
+            request.query_string,
+            tuple(sorted(payload.get('permissions', []))),
+        )
+
+        def respond():
+            response = make_response(f(payload, *args, **kwargs))
+            return (
+                response.get_data(),
+                response.status_code,
+                list(response.headers))
+
+        try:
+            body, status, headers = flights.do(key, respond)
+        except SingleFlightTimeout:
+            abort(503, 'Timed out waiting for an identical request.')
+
+        return Response(body, status=status, headers=headers)
+    return wrapper
@@ -1,23 +1,184 @@
 import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+from importlib.util import find_spec
+from unittest.mock import patch
+
+# The suite runs offline: against an in-memory SQLite database unless
+# TEST_DATABASE_URL names another (e.g. a local Postgres), and with tokens
+# signed by a key generated here instead of by Auth0. DATABASE_URL is
+# overridden so importing the app never touches a real database.
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL', 'sqlite://')
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ.setdefault('AUTH0_DOMAIN', 'chemical-inventory.test')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'chemical')
+
+import rsa
+from flask import _app_ctx_stack
+from jose import jwk, jwt
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import ServiceUnavailable
+from auth import auth
+from benchmarks import queries as queries_benchmark
+from database import export, queries
+from database.cache import BUCKET_NAMES, chemical_cache, cache_generations
+from database.similarity import similarity_index
+from database.search import name_index
+from database.hazards import hazard_engine
+from database.snapshot import snapshot, build_snapshot
+from server.admission import admission, per_worker
+from server.green import green_library, pool_options
 from app import create_app
-from database.models import setup_db, Chemical, Inventory, db_drop_and_create_all
+from database.models import db, Chemical, Inventory, Job, db_drop_and_create_all
+
+# -------------------
+# TEST TOKENS
+# -------------------
+
+# Test-only signing key; 1024 bits keeps generating it (pure Python) fast
+SIGNING_KEY_ID = 'test-signing-key'
+public_key, private_key = rsa.newkeys(1024)
+auth.load_jwks({'keys': [dict(
+    jwk.construct(public_key.save_pkcs1(), 'RS256').to_dict(),
+    kid=SIGNING_KEY_ID,
+    use='sig')]})
+
+# Permissions of the Auth0 roles the API is deployed with
+ROLES = {
+    'chemist': [
+        'delete:chemicals',
+        'get:chemicals',
+        'get:inventories',
+        'patch:chemicals',
+        'post:chemicals'],
+    'manager': [
+        'delete:inventories',
+        'get:chemicals',
+        'get:inventories',
+        'patch:inventories',
+        'post:inventories'],
+    'admin': [
+        'get:chemicals',
+        'get:inventories',
+        'get:profiles'],
+}
+
+
+def mint_token(permissions, sub='auth0|test', expires_in=3600):
+    """RS256 access token as Auth0 would issue it, signed by the test key"""
+    now = int(time.time())
+    return jwt.encode({
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'sub': sub,
+        'aud': auth.API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions,
+    }, private_key.save_pkcs1().decode(), algorithm='RS256',
+        headers={'kid': SIGNING_KEY_ID})
+
+
+# -------------------
+# TEST DATABASE
+# -------------------
+
+if TEST_DATABASE_URL.startswith('sqlite'):
+    # pysqlite defers BEGIN and so breaks SAVEPOINTs: let SQLAlchemy emit
+    # BEGIN itself. The one in-memory connection is shared by the app's
+    # threads and must keep the test's transaction open when returned to
+    # the pool.
+    TEST_CONFIG = {'SQLALCHEMY_ENGINE_OPTIONS': {
+        'connect_args': {'isolation_level': None, 'check_same_thread': False},
+        'pool_reset_on_return': None,
+    }}
+else:
+    TEST_CONFIG = {}
+
+app = None
+
+
+def setUpModule():
+    """Builds the app and the seeded schema once for the whole suite"""
+    global app
+    app = create_app(TEST_CONFIG)
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'begin', lambda conn: conn.execute('BEGIN'))
+    with app.app_context():
+        db_drop_and_create_all()
+
+
+class SavepointSession(scoped_session):
+    """db.session for a test: sessions share the test's connection and
+    work inside a SAVEPOINT, restarted after every commit or rollback, so
+    the test's outer transaction can undo everything the app committed"""
+
+    def __init__(self, connection):
+        factory = db.create_session({'bind': connection, 'binds': {}})
+
+        @event.listens_for(factory, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction.parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        def create_session():
+            session = factory()
+            # The SAVEPOINT's commits are the ones the app sees
+            session.info['external_transaction'] = True
+            session.begin_nested()
+            return session
+
+        super().__init__(
+            create_session, scopefunc=_app_ctx_stack.__ident_func__)
+
+    def remove(self):
+        # Unfinished work is rolled back, as returning the connection to
+        # the pool would
+        if self.registry.has():
+            self.registry().rollback()
+        super().remove()
 
 
 class ChemicalInventoryTestCase(unittest.TestCase):
     """ Test case class for the chemical inventory API"""
 
     def setUp(self):
-        """ Define variables and setup app"""
+        """ Define variables and open the test's transaction"""
         self.invalid_token = 'gkjalkbnlakdbhaiorhboi'
-        self.chemist_token = os.environ['chemist_token']
-        self.manager_token = os.environ['manager_token']
-        self.app = create_app()
+        self.chemist_token = mint_token(ROLES['chemist'])
+        self.manager_token = mint_token(ROLES['manager'])
+        self.app = app
         self.client = self.app.test_client
-        setup_db(self.app)
-        db_drop_and_create_all()
+
+        with self.app.app_context():
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        self.jobs_session_factory = self.app.extensions['jobs'].session_factory
+        db.session = SavepointSession(self.connection)
+        self.app.extensions['jobs'].session_factory = db.session.session_factory
+        self.group_commit = self.app.extensions['group_commit']
+        self.group_commit_session_factory = self.group_commit.session_factory
+        self.group_commit.session_factory = db.session.session_factory
+        chemical_cache.invalidate()
+        similarity_index.invalidate()
+        name_index.invalidate()
+        hazard_engine.invalidate()
+        # Each test is a new client with a full request quota
+        admission.buckets.clear()
 
         # TEST CHEMICALS
 
@@ -59,15 +220,15 @@ class ChemicalInventoryTestCase(unittest.TestCase):
             "location": ""
         }
 
-        # Binds app to context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
-
     def tearDown(self):
-        """ Executed after each test"""
-        pass
+        """ Rolls back everything the test did"""
+        db.session.remove()
+        db.session = self.session
+        self.app.extensions['jobs'].session_factory = self.jobs_session_factory
+        self.group_commit.session_factory = self.group_commit_session_factory
+        self.group_commit.window = 0
+        self.transaction.rollback()
+        self.connection.close()
 
 # ------------------
 # PERMISSION TESTS
@@ -89,6 +250,35 @@ class ChemicalInventoryTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], "Authorization header is required.")
 
+    def test_fail_401_expired_token(self):
+        """ Test for failure with an expired token"""
+        res = self.client().get('/chemicals', headers={
+            'Authorization': f"Bearer {mint_token(ROLES['chemist'], expires_in=-60)}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], "Token expired.")
+
+    def test_fail_503_signing_keys_unavailable(self):
+        """ Test for failing fast when the signing keys cannot be fetched"""
+        jwks, url = dict(auth.jwks_cache), auth.JWKS_URL
+        auth.jwks_cache.clear()
+        auth.JWKS_URL = 'http://127.0.0.1:9/.well-known/jwks.json'
+        try:
+            res = self.client().get('/chemicals', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+        finally:
+            auth.jwks_cache.clear()
+            auth.jwks_cache.update(jwks)
+            auth.JWKS_URL = url
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+
     def test_fail_403_post_chemicals_with_manager_permissions(self):
         """ Test for failure to post chemicals with manager permissions """
         res = self.client().post('/chemicals', headers={
@@ -158,6 +348,453 @@ class ChemicalInventoryTestCase(unittest.TestCase):
         self.assertIn('chemicals', data)
         self.assertTrue(len(data['chemicals']))
 
+    def test_get_chemical_by_id_is_cached(self):
+        """ Pass test for serving GET /chemicals/<chemical_id> from cache"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/1', headers=headers)
+        hits = chemical_cache.stats()['hits']
+        res = self.client().get('/chemicals/1', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(chemical_cache.stats()['hits'], hits + 1)
+
+    def test_patch_chemical_invalidates_cache(self):
+        """ Pass test for PATCH /chemicals/<chemical_id> invalidating cache"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/1', headers=headers)
+        self.client().patch(
+            '/chemicals/1', headers=headers, json=self.VALID_PATCH_CHEMICAL)
+        res = self.client().get('/chemicals/1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(
+            data['chemical']['ld50'],
+            self.VALID_PATCH_CHEMICAL['ld50'])
+
+    def test_cache_generation_invalidates_other_workers(self):
+        """ Pass test for a write from another worker invalidating cache"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/1', headers=headers)
+
+        # Another worker writes without touching this worker's cache
+        with self.app.app_context():
+            db.session.execute(Chemical.__table__.update().where(
+                Chemical.id == 1).values(ld50=1.0))
+            db.session.execute(cache_generations.update().values(
+                value=cache_generations.c.value + 1))
+            db.session.commit()
+
+        res = self.client().get('/chemicals/1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['chemical']['ld50'], 1.0)
+
+    def test_cache_generation_invalidates_only_changed_buckets(self):
+        """ Pass test for another worker's write dropping only the cached
+        chemicals in its generation bucket"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/1', headers=headers)
+        self.client().get('/chemicals/2', headers=headers)
+
+        with self.app.app_context():
+            db.session.execute(cache_generations.update().where(
+                cache_generations.c.name == BUCKET_NAMES[1]).values(
+                value=cache_generations.c.value + 1))
+            db.session.commit()
+
+        self.client().get('/chemicals/3', headers=headers)
+        self.assertEqual(set(chemical_cache.entries), {2, 3})
+
+    def test_generations_bump_after_commit(self):
+        """ Pass test for a write bumping the generations after its
+        transaction committed, not while holding its locks"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.connection, 'before_cursor_execute', record)
+        try:
+            res = self.client().patch('/chemicals/1', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            }, json=self.VALID_PATCH_CHEMICAL)
+        finally:
+            event.remove(self.connection, 'before_cursor_execute', record)
+
+        self.assertEqual(res.status_code, 200)
+        release = next(i for i, statement in enumerate(statements)
+                       if statement.startswith('RELEASE SAVEPOINT'))
+        bumps = [i for i, statement in enumerate(statements)
+                 if statement.startswith('UPDATE cache_generations')]
+        self.assertEqual(len(bumps), 1)
+        self.assertGreater(bumps[0], release)
+
+    def test_get_chemicals_with_fields(self):
+        """ Pass test for GET /chemicals?fields= """
+        res = self.client().get('/chemicals?fields=id,name,hazard', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(
+            set(data['chemicals'][0]), {'id', 'name', 'hazard'})
+
+    def test_fail_400_get_chemicals_invalid_fields(self):
+        """ Test for failure to GET /chemicals with an unknown field"""
+        for query in ('fields=id,password', 'fields='):
+            res = self.client().get(f'/chemicals?{query}', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+            self.assertTrue(data['message'].startswith('Invalid fields.'))
+
+    def test_get_chemical_derived_properties(self):
+        """ Pass test for properties derived from smiles on write"""
+        res = self.client().get('/chemicals/1', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['chemical']['formula'], 'C2H4O')
+        self.assertEqual(data['chemical']['heavy_atoms'], 3)
+        self.assertAlmostEqual(data['chemical']['mol_weight'], 44.053)
+
+    def test_get_chemicals_filtered_by_properties(self):
+        """ Pass test for GET /chemicals filtered on derived properties"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().put('/chemicals/by-smiles', headers=headers, json={
+            "chemicals": [
+                {"name": "Benzene", "smiles": "c1ccccc1", "ld50": 930}]
+        })
+
+        res = self.client().get(
+            '/chemicals?min_heavy_atoms=4&fields=name,formula',
+            headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            data['chemicals'], [{'name': 'Benzene', 'formula': 'C6H6'}])
+
+        res = self.client().get(
+            '/chemicals?formula=C2H6O&max_mol_weight=50&fields=name',
+            headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['chemicals'], [{'name': 'Ether'}])
+
+    def test_fail_400_get_chemicals_invalid_filter(self):
+        """ Test for failure to GET /chemicals with a non-numeric filter"""
+        for arg in ('min_heavy_atoms', 'min_mol_weight'):
+            res = self.client().get(f'/chemicals?{arg}=many', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+            self.assertEqual(data['message'], f'{arg} must be a number.')
+
+    def test_upsert_chemical_by_smiles(self):
+        """ Pass test for PUT /chemicals/by-smiles/<smiles>"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        statuses = []
+        for body in (
+                {"name": "Ethanol", "ld50": 15.2},
+                {"name": "Ethanol", "ld50": 15.2},
+                {"name": "Ethanol", "ld50": 7.6}):
+            res = self.client().put(
+                '/chemicals/by-smiles/CCO', headers=headers, json=body)
+            statuses.append((res.status_code, json.loads(res.data)['status']))
+
+        self.assertEqual(
+            statuses, [(201, 'created'), (200, 'unchanged'), (200, 'updated')])
+        with self.app.app_context():
+            chemical = Chemical.query.filter(Chemical.smiles == 'CCO').one()
+            self.assertEqual(chemical.hazard, Chemical.hazard_for(7.6))
+
+    def test_bulk_upsert_chemicals_by_smiles(self):
+        """ Pass test for PUT /chemicals/by-smiles"""
+        res = self.client().put('/chemicals/by-smiles', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        }, json={"chemicals": [
+            {"name": "Acetone", "smiles": "CC=O", "ld50": 10.2},
+            {"name": "Ether", "smiles": "COC", "ld50": 20},
+            {"name": "Benzene", "smiles": "c1ccccc1", "ld50": 930},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [chemical['status'] for chemical in data['chemicals']],
+            ['unchanged', 'updated', 'created'])
+        self.assertEqual(data['chemicals'][1]['id'], 2)
+        with self.app.app_context():
+            inventory = Inventory.query.get(1)
+            self.assertAlmostEqual(
+                inventory.average_hazard,
+                (2 / 10.2 + 2 / 20 + 2 / 100) / 3)
+
+    def test_fail_403_upsert_existing_chemical_without_patch_permission(self):
+        """ Test for failure of PUT /chemicals/by-smiles to overwrite
+        chemicals with only post:chemicals"""
+        headers = {
+            "Authorization": f"Bearer {mint_token(['post:chemicals'])}"}
+        created = self.client().put('/chemicals/by-smiles/CCO', headers=headers,
+                                    json={"name": "Ethanol", "ld50": 15.2})
+        unchanged = self.client().put(
+            '/chemicals/by-smiles/CCO', headers=headers,
+            json={"name": "Ethanol", "ld50": 15.2})
+        res = self.client().put('/chemicals/by-smiles/COC', headers=headers,
+                                json={"name": "Ether", "ld50": 1})
+        bulk = self.client().put('/chemicals/by-smiles', headers=headers, json={
+            "chemicals": [
+                {"name": "Benzene", "smiles": "c1ccccc1", "ld50": 930},
+                {"name": "Ether", "smiles": "COC", "ld50": 1},
+            ]})
+
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(json.loads(unchanged.data)['status'], 'unchanged')
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(json.loads(res.data)['success'])
+        self.assertEqual(bulk.status_code, 403)
+        with self.app.app_context():
+            self.assertEqual(Chemical.query.get(2).ld50, 15)
+            self.assertEqual(Chemical.query.filter(
+                Chemical.smiles == 'c1ccccc1').count(), 0)
+
+    def test_fail_422_upsert_chemical_with_taken_name(self):
+        """ Test for failure to upsert a new smiles under a taken name"""
+        res = self.client().put('/chemicals/by-smiles/CCO', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        }, json={"name": "Acetone", "ld50": 15.2})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_get_similar_chemicals(self):
+        """ Pass test for GET /chemicals/similar"""
+        res = self.client().get('/chemicals/similar?smiles=CC=O&k=2', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['chemicals']), 2)
+        self.assertEqual(data['chemicals'][0]['name'], 'Acetone')
+        self.assertEqual(data['chemicals'][0]['similarity'], 1.0)
+        self.assertLess(data['chemicals'][1]['similarity'], 1.0)
+
+    def test_similar_chemicals_follow_writes(self):
+        """ Pass test for the similarity index picking up writes"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/similar?smiles=CC=O', headers=headers)
+        self.client().post(
+            '/chemicals', headers=headers, json=self.VALID_NEW_CHEMICAL)
+        self.client().delete('/chemicals/1', headers=headers)
+        res = self.client().get(
+            '/chemicals/similar?smiles=CC=OOH&min_sim=0.5', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(
+            [chemical['name'] for chemical in data['chemicals']],
+            ['Acetic Acid'])
+
+    def test_fail_400_similar_chemicals_without_smiles(self):
+        """ Test for failure of GET /chemicals/similar without smiles"""
+        res = self.client().get('/chemicals/similar?k=5', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_search_chemicals_by_misspelled_name(self):
+        """ Pass test for GET /chemicals/search"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        acetone = json.loads(self.client().get(
+            '/chemicals/search?q=acetome', headers=headers).data)
+        ether = json.loads(self.client().get(
+            '/chemicals/search?q=ethr', headers=headers).data)
+
+        self.assertTrue(acetone['success'])
+        self.assertEqual(acetone['chemicals'][0]['name'], 'Acetone')
+        self.assertEqual(
+            [chemical['name'] for chemical in ether['chemicals']], ['Ether'])
+
+    def test_search_chemicals_follows_renames(self):
+        """ Pass test for the name index picking up an upserted rename"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/chemicals/search?q=ethr', headers=headers)
+        self.client().put('/chemicals/by-smiles/COC', headers=headers, json={
+            "name": "Dimethyl ether",
+            "ld50": 15
+        })
+        res = self.client().get('/chemicals/search?q=dimethyl', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(
+            [chemical['name'] for chemical in data['chemicals']],
+            ['Dimethyl ether'])
+
+    def test_index_sync_is_one_query(self):
+        """ Pass test for an up to date index checking for other workers'
+        writes with a single query"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            for index in (name_index, hazard_engine):
+                index.sync(db.session)
+                event.listen(self.connection, 'before_cursor_execute', record)
+                try:
+                    statements.clear()
+                    index.sync(db.session)
+                finally:
+                    event.remove(
+                        self.connection, 'before_cursor_execute', record)
+                self.assertEqual(len(statements), 1)
+
+    def test_fail_400_search_chemicals_without_q(self):
+        """ Test for failure of GET /chemicals/search without q"""
+        res = self.client().get('/chemicals/search', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_get_served_from_snapshot(self):
+        """ Pass test for GETs served from the read snapshot"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.db')
+            build_snapshot(path, self.connection)
+            snapshot.open(path)
+            check_seconds, snapshot.check_seconds = snapshot.check_seconds, 0
+            try:
+                self.client().patch(
+                    '/chemicals/1', headers=headers, json={'ld50': 40.1})
+
+                # Reads see the snapshot, not the write after it
+                res = self.client().get('/chemicals/1', headers=headers)
+                data = json.loads(res.data)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(data['chemical']['ld50'], 10.2)
+                self.assertIn('X-Snapshot-Age', res.headers)
+
+                res = self.client().get('/inventories/1', headers=headers)
+                data = json.loads(res.data)
+                self.assertEqual(
+                    data['inventory']['chemicals'][0]['ld50'], 10.2)
+
+                # A rebuilt snapshot is swapped in
+                build_snapshot(path, self.connection)
+                res = self.client().get('/chemicals/1', headers=headers)
+                data = json.loads(res.data)
+                self.assertEqual(data['chemical']['ld50'], 40.1)
+            finally:
+                snapshot.check_seconds = check_seconds
+                snapshot.open(None)
+
+    def test_get_bypasses_stale_snapshot(self):
+        """ Pass test for GETs read from the primary past the staleness bound"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.db')
+            build_snapshot(path, self.connection)
+            snapshot.open(path)
+            max_age, snapshot.max_age = snapshot.max_age, 0
+            stale = snapshot.stats()['stale']
+            try:
+                self.client().patch(
+                    '/chemicals/1', headers=headers, json={'ld50': 40.1})
+                res = self.client().get('/chemicals/1', headers=headers)
+                data = json.loads(res.data)
+
+                self.assertEqual(data['chemical']['ld50'], 40.1)
+                self.assertNotIn('X-Snapshot-Age', res.headers)
+                self.assertEqual(snapshot.stats()['stale'], stale + 1)
+            finally:
+                snapshot.max_age = max_age
+                snapshot.open(None)
+
+    def test_shed_503_over_capacity(self):
+        """ Test for shedding requests once the worker is at capacity"""
+        capacity, admission.capacity = admission.capacity, 0
+        try:
+            res = self.client().get('/chemicals/1', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+        finally:
+            admission.capacity = capacity
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+    def test_shed_503_over_route_limit(self):
+        """ Test for shedding requests past a route's concurrency limit"""
+        for _ in range(4):
+            admission.acquire('retrieve_chemicals', 'auth0|other', 1, 4)
+        try:
+            res = self.client().get('/chemicals', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+            cheap = self.client().get('/chemicals/1', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+        finally:
+            for _ in range(4):
+                admission.release('retrieve_chemicals', 1)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(cheap.status_code, 200)
+
+    def test_shed_429_over_client_quota(self):
+        """ Test for refusing a client that used up its request quota"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        rate, admission.rate = admission.rate, 0.5
+        burst, admission.burst = admission.burst, 8
+        try:
+            first = self.client().get('/chemicals', headers=headers)
+            res = self.client().get('/chemicals', headers=headers)
+            other = self.client().get('/chemicals', headers={
+                "Authorization":
+                    f"Bearer {mint_token(ROLES['chemist'], sub='auth0|other')}"
+            })
+        finally:
+            admission.rate, admission.burst = rate, burst
+        data = json.loads(res.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 15)
+        self.assertEqual(other.status_code, 200)
+
+    def test_client_quota_is_split_across_workers(self):
+        """ Pass test for each worker enforcing its share of a client's
+        quota"""
+        with patch.dict(os.environ):
+            os.environ.pop('WEB_CONCURRENCY', None)
+            self.assertEqual(per_worker(20.0), 20.0)
+            os.environ['WEB_CONCURRENCY'] = '4'
+            self.assertEqual(per_worker(20.0), 5.0)
+            self.assertEqual(per_worker(100.0), 25.0)
+
     def test_get_chemical_by_id(self):
         """ Pass test for GET /chemicals/<chemical_id> """
         res = self.client().get('/chemicals/1', headers={
@@ -220,6 +857,52 @@ class ChemicalInventoryTestCase(unittest.TestCase):
             data['chemical']['ld50'],
             self.VALID_PATCH_CHEMICAL['ld50'])
 
+    def test_patch_chemical_with_if_match(self):
+        """ Pass test for PATCH /chemicals/<chemical_id> with If-Match"""
+        res = self.client().get('/chemicals/1', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        etag = res.headers['ETag']
+
+        res = self.client().patch('/chemicals/1', headers={
+            "Authorization": f"Bearer {self.chemist_token}",
+            "If-Match": etag
+        }, json=self.VALID_PATCH_CHEMICAL)
+
+        self.assertEqual(etag, 'W/"1"')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], 'W/"2"')
+
+    def test_fail_412_patch_chemical_with_stale_if_match(self):
+        """ Test for failure to PATCH a chemical changed since it was read"""
+        headers = {
+            "Authorization": f"Bearer {self.chemist_token}",
+            "If-Match": 'W/"1"'
+        }
+        self.client().patch(
+            '/chemicals/1', headers=headers, json=self.VALID_PATCH_CHEMICAL)
+        res = self.client().patch(
+            '/chemicals/1', headers=headers, json={"ld50": 12.0})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+        with self.app.app_context():
+            self.assertEqual(
+                Chemical.query.get(1).ld50, self.VALID_PATCH_CHEMICAL['ld50'])
+
+    def test_fail_412_concurrent_flush_of_stale_chemical(self):
+        """ Test for a flush of a concurrently updated row failing"""
+        with self.app.app_context():
+            chemical = Chemical.query.get(1)
+            # Another writer bumps the row behind this session's back
+            db.session.connection().execute(Chemical.__table__.update().where(
+                Chemical.id == 1).values(version=Chemical.version + 1))
+
+            chemical.ld50 = 12.0
+            with self.assertRaises(StaleDataError):
+                chemical.update()
+
     def test_fail_404_patch_chemical_with_invalid_id(self):
         """ Test for failure to patch a chemical with invalid id"""
         res = self.client().patch('/chemicals/99', headers={
@@ -271,6 +954,35 @@ class ChemicalInventoryTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertIn('inventories', data)
 
+    def test_get_inventories_expand_chemicals(self):
+        """ Pass test for GET /inventories?expand=chemicals"""
+        res = self.client().get(
+            '/inventories?expand=chemicals&chemical_fields=id', headers={
+                "Authorization": f"Bearer {self.manager_token}"
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(
+            data['inventories'][0]['chemicals'],
+            [{'id': 1}, {'id': 2}, {'id': 3}])
+
+    def test_fail_400_get_inventories_invalid_fields(self):
+        """ Test failure to GET /inventories with an unknown field or
+        expansion, saying which argument was wrong"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        for query, message in (
+                ('fields=id,password', 'Invalid fields.'),
+                ('expand=owners', 'Invalid expand.'),
+                ('expand=chemicals&chemical_fields=password',
+                 'Invalid chemical_fields.')):
+            res = self.client().get(f'/inventories?{query}', headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertTrue(data['message'].startswith(message))
+
     def test_get_inventories_by_id(self):
         """ Pass test for GET /inventories/<inventory_id>"""
         res = self.client().get('/inventories/1', headers={
@@ -334,6 +1046,67 @@ class ChemicalInventoryTestCase(unittest.TestCase):
             data['inventory']['location'],
             self.VALID_PATCH_INVENTORY['location'])
 
+    def test_inventory_hazard_follows_membership(self):
+        """ Pass test for average_hazard following added and removed
+        member chemicals"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        res = self.client().patch('/inventories/1', headers=headers, json={
+            "chemical_ids_to_remove": [1, 2]
+        })
+        self.assertAlmostEqual(
+            json.loads(res.data)['inventory']['hazard'], 1 / 100 / 0.5)
+
+        res = self.client().patch('/inventories/1', headers=headers, json={
+            "chemical_ids_to_add": [2]
+        })
+        self.assertAlmostEqual(
+            json.loads(res.data)['inventory']['hazard'],
+            (1 / 15 + 1 / 100) / 0.5 / 2)
+
+    def test_inventory_hazard_follows_chemical_hazard(self):
+        """ Pass test for average_hazard following a member's hazard"""
+        with self.app.app_context():
+            chemical = Chemical.query.get(1)
+            chemical.hazard = 1.0
+            db.session.commit()
+
+        res = self.client().get('/inventories/1', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        })
+        self.assertAlmostEqual(
+            json.loads(res.data)['inventory']['hazard'],
+            (1.0 + 1 / 15 / 0.5 + 1 / 100 / 0.5) / 3)
+
+    def test_inventory_hazard_follows_chemical_delete(self):
+        """ Pass test for average_hazard dropping a deleted member"""
+        self.client().delete('/chemicals/1', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+
+        res = self.client().get('/inventories/1', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        })
+        self.assertAlmostEqual(
+            json.loads(res.data)['inventory']['hazard'],
+            (1 / 15 + 1 / 100) / 0.5 / 2)
+
+    def test_fail_412_patch_inventory_membership_with_stale_if_match(self):
+        """ Test for failure to PATCH membership of a changed inventory"""
+        headers = {
+            "Authorization": f"Bearer {self.manager_token}",
+            "If-Match": 'W/"1"'
+        }
+        first = self.client().patch('/inventories/1', headers=headers, json={
+            "chemical_ids_to_remove": [1]
+        })
+        second = self.client().patch('/inventories/1', headers=headers, json={
+            "chemical_ids_to_remove": [2]
+        })
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['ETag'], 'W/"2"')
+        self.assertEqual(second.status_code, 412)
+
     def test_fail_404_patch_inventory_with_invalid_id(self):
         """ Test for failure to patch an inventory with invalid id"""
         res = self.client().patch('/inventories/99', headers={
@@ -345,6 +1118,24 @@ class ChemicalInventoryTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertIn('message', data)
 
+    def test_average_hazard_follows_membership(self):
+        """ Pass test for average hazard recomputed on membership changes"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        res = self.client().post('/inventories', headers=headers, json={
+            "location": "Swaziland",
+            "chemicals": [1, 2]
+        })
+        inventory = json.loads(res.data)['inventory']
+        res = self.client().patch(
+            f'/inventories/{inventory["id"]}', headers=headers, json={
+                "chemical_ids_to_remove": [2]
+            })
+        patched = json.loads(res.data)['inventory']
+
+        self.assertAlmostEqual(
+            inventory['hazard'], (1 / 10.2 + 1 / 15) / 0.5 / 2)
+        self.assertAlmostEqual(patched['hazard'], (1 / 10.2) / 0.5)
+
     def test_delete_inventory(self):
         """ Test for DELETE /inventory/<inventory_id>"""
         res = self.client().delete('/inventories/1', headers={
@@ -369,6 +1160,851 @@ class ChemicalInventoryTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertIn('message', data)
 
+    def create_inventory(self, location, chemical_ids):
+        res = self.client().post('/inventories', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        }, json={"location": location, "chemicals": chemical_ids})
+        return json.loads(res.data)['inventory']['id']
+
+    def test_delete_inventories_bulk(self):
+        """ Pass test for DELETE /inventories, members deleted and other
+        inventories refreshed"""
+        res = self.client().put('/chemicals/by-smiles', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        }, json={"chemicals": [{"name": "Methane", "smiles": "C", "ld50": 20}]})
+        methane_id = json.loads(res.data)['chemicals'][0]['id']
+        other_id = self.create_inventory('Mordor', [1, methane_id])
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        version = self.client().get(
+            f'/inventories/{other_id}', headers=headers).get_etag()[0]
+
+        res = self.client().delete(
+            '/inventories', headers=headers, json={"inventory_ids": [1]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted inventory ids'], [1])
+        self.assertEqual(data['deleted chemical ids'], [1, 2, 3])
+
+        res = self.client().get(f'/inventories/{other_id}', headers=headers)
+        other = json.loads(res.data)['inventory']
+        self.assertEqual([c['id'] for c in other['chemicals']], [methane_id])
+        self.assertAlmostEqual(other['hazard'], (1 / 20) / 0.5)
+        self.assertNotEqual(res.get_etag()[0], version)
+
+        res = self.client().get('/chemicals/1', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        self.assertEqual(res.status_code, 404)
+
+    def test_delete_inventory_statements_independent_of_size(self):
+        """ Test for DELETE /inventories/<inventory_id> issuing as many
+        statements for 30 members as for 3"""
+        res = self.client().put('/chemicals/by-smiles', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        }, json={"chemicals": [
+            {"name": f"Alkane {n}", "smiles": "C" * n, "ld50": n}
+            for n in range(2, 32)]})
+        large_id = self.create_inventory(
+            'Gondor', [c['id'] for c in json.loads(res.data)['chemicals']])
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        counts = []
+        event.listen(self.connection, 'before_cursor_execute', count)
+        try:
+            for inventory_id in (1, large_id):
+                statements.clear()
+                res = self.client().delete(
+                    f'/inventories/{inventory_id}', headers={
+                        "Authorization": f"Bearer {self.manager_token}"
+                    })
+                self.assertEqual(res.status_code, 200)
+                counts.append(len(statements))
+        finally:
+            event.remove(self.connection, 'before_cursor_execute', count)
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_fail_404_delete_inventories_bulk_with_invalid_id(self):
+        """ Test for DELETE /inventories deleting nothing if an id is unknown"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        res = self.client().delete(
+            '/inventories', headers=headers, json={"inventory_ids": [1, 99]})
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(json.loads(res.data)['success'])
+        res = self.client().get('/inventories/1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().delete(
+            '/inventories', headers=headers, json={"inventory_ids": []})
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_inventories_filtered_and_sorted(self):
+        """ Pass test for GET /inventories with location filters and sort,
+        members never loaded"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        tirith = self.create_inventory('Gondor/Minas Tirith', [1])
+        osgiliath = self.create_inventory('Gondor/Osgiliath', [1, 2])
+        rohan = self.create_inventory('Gondor_Rohan', [3])
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.connection, 'before_cursor_execute', record)
+        try:
+            res = self.client().get(
+                '/inventories?location_prefix=Gondor/&sort=-hazard'
+                '&fields=id,hazard', headers=headers)
+        finally:
+            event.remove(self.connection, 'before_cursor_execute', record)
+        inventories = json.loads(res.data)['inventories']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            sorted(inventory['id'] for inventory in inventories),
+            [tirith, osgiliath])
+        hazards = [inventory['hazard'] for inventory in inventories]
+        self.assertEqual(hazards, sorted(hazards, reverse=True))
+        self.assertFalse(any('association' in s for s in statements))
+
+        res = self.client().get(
+            '/inventories?location=Gondor/Osgiliath', headers=headers)
+        self.assertEqual(
+            [i['id'] for i in json.loads(res.data)['inventories']],
+            [osgiliath])
+
+        # _ is matched literally, not as LIKE's single-character wildcard
+        res = self.client().get(
+            '/inventories?location_prefix=Gondor_', headers=headers)
+        self.assertEqual(
+            [i['id'] for i in json.loads(res.data)['inventories']], [rohan])
+
+        res = self.client().get(
+            f'/inventories?location_prefix=Gondor&min_hazard={max(hazards)}',
+            headers=headers)
+        self.assertTrue(all(
+            i['hazard'] >= max(hazards)
+            for i in json.loads(res.data)['inventories']))
+
+    def test_fail_400_get_inventories_invalid_sort_or_filter(self):
+        """ Test failure to GET /inventories with an unknown sort key or a
+        non-numeric min_hazard"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        for query, message in (
+                ('sort=location', 'Invalid sort. Choose from: id, -id'),
+                ('min_hazard=high', 'min_hazard must be a number.')):
+            res = self.client().get(f'/inventories?{query}', headers=headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+            self.assertTrue(data['message'].startswith(message))
+
+# --------------------
+# BAKED QUERY TESTS
+# --------------------
+
+    def selected_columns(self, lookup, table):
+        """ Columns of table the SELECTs of lookup() read, and its result;
+        each lookup starts from an empty identity map, as a request does"""
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.session.expunge_all()
+        event.listen(self.connection, 'before_cursor_execute', record)
+        try:
+            result = lookup()
+        finally:
+            event.remove(self.connection, 'before_cursor_execute', record)
+        columns = set()
+        for statement in statements:
+            select_list, *source = re.split(r'\sFROM\s', statement, 1)
+            if source and source[0].split()[0] == table:
+                columns.update(re.findall(
+                    rf'\b{table}\.(\w+)', select_list))
+        return columns, result
+
+    def test_baked_queries_keep_field_lists_apart(self):
+        """ Pass test for baked queries keyed by ?fields= selecting only
+        the requested columns, whichever field list was baked first"""
+        lookups = {
+            'get_chemical': (
+                'chemicals', [('id', 'name'), ('id', 'ld50')],
+                lambda fields: queries.get_chemical(1, fields)),
+            'get_chemicals': (
+                'chemicals', [('name',), ('smiles', 'formula')],
+                lambda fields: queries.get_chemicals([1, 2], fields)),
+            'all_inventories': (
+                'inventories', [('location',), ('hazard',)],
+                lambda fields: queries.all_inventories(fields)),
+        }
+        with self.app.app_context():
+            for name, (table, field_lists, lookup) in lookups.items():
+                for order in (field_lists, field_lists[::-1]):
+                    for fields in order + [None]:
+                        model = Chemical if table == 'chemicals' \
+                            else Inventory
+                        columns, result = self.selected_columns(
+                            lambda: lookup(fields), table)
+                        expected = set(model.__table__.columns.keys()) \
+                            if fields is None else \
+                            {model.FIELDS[field] for field in fields} | {'id'}
+                        self.assertEqual(columns, expected, (name, fields))
+                        rows = result if isinstance(result, list) \
+                            else [result]
+                        self.assertTrue(rows)
+
+    def test_baked_queries_match_unbaked(self):
+        """ Pass test for baked queries returning what the same ORM
+        queries built ad hoc return"""
+        self.create_inventory('Gondor/Osgiliath', [2])
+        self.create_inventory('Gondor/Minas Tirith', [1, 3])
+        self.create_inventory('Mordor', [])
+
+        with self.app.app_context():
+            self.assertEqual(queries.get_chemical(2), Chemical.query.get(2))
+            self.assertIsNone(queries.get_chemical(99))
+            self.assertEqual(
+                queries.get_chemicals([3, 1, 99]),
+                Chemical.query.filter(Chemical.id.in_([1, 3])).order_by(
+                    Chemical.id).all())
+            self.assertEqual(
+                queries.inventory_chemical_ids(1), [1, 2, 3])
+            for name, adhoc, baked in queries_benchmark.CASES:
+                self.assertEqual(baked(), adhoc(), name)
+
+            formula = Chemical.query.get(1).formula
+            chemical_filters = [
+                {}, {'formula': formula}, {'min_heavy_atoms': 3},
+                {'max_heavy_atoms': 3, 'min_mol_weight': 40.0}]
+            for filters in chemical_filters + chemical_filters[::-1]:
+                expected = Chemical.query.order_by(Chemical.id).all()
+                expected = [chemical for chemical in expected if all((
+                    filters.get('formula', chemical.formula)
+                    == chemical.formula,
+                    chemical.heavy_atoms >= filters.get(
+                        'min_heavy_atoms', chemical.heavy_atoms),
+                    chemical.heavy_atoms <= filters.get(
+                        'max_heavy_atoms', chemical.heavy_atoms),
+                    chemical.mol_weight >= filters.get(
+                        'min_mol_weight', chemical.mol_weight)))]
+                self.assertEqual(
+                    queries.all_chemicals(filters=filters), expected, filters)
+
+            inventories = Inventory.query.all()
+            for sort in queries.INVENTORY_SORTS:
+                for filters in (
+                        {}, {'location_prefix': queries.like_prefix('Gondor/')},
+                        {'min_hazard': 0.1}):
+                    column = sort.lstrip('-').replace(
+                        'hazard', 'average_hazard')
+                    matches = [
+                        inventory for inventory in inventories
+                        if inventory.location.startswith(
+                            'Gondor/' if 'location_prefix' in filters else '')
+                        and (inventory.average_hazard or 0) >= filters.get(
+                            'min_hazard', 0)]
+                    expected = sorted(matches, key=lambda inventory: (
+                        getattr(inventory, column) is None,
+                        getattr(inventory, column) or 0, inventory.id),
+                        reverse=sort.startswith('-'))
+                    self.assertEqual(
+                        queries.all_inventories(filters=filters, sort=sort),
+                        expected, (sort, filters))
+
+# --------------------
+# ANALYTICS TESTS
+# --------------------
+
+    def test_hazards_follow_membership_writes(self):
+        """ Pass test for GET /analytics/hazards matching the database's
+        averages after writes, without reloading the memberships"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        self.client().get('/analytics/hazards', headers=headers)
+        loads = hazard_engine.stats()['membership_loads']
+
+        other_id = self.create_inventory('Mordor', [1, 2])
+        self.client().patch('/inventories/1', headers=headers, json={
+            "chemical_ids_to_remove": [1]})
+
+        res = self.client().get('/analytics/hazards', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['summary']['inventories'], 2)
+        self.assertEqual(data['summary']['memberships'], 4)
+        expected = {
+            1: ((1 / 15 + 1 / 100) / 0.5 / 2, 2),
+            other_id: ((1 / 10.2 + 1 / 15) / 0.5 / 2, 2)}
+        for inventory in data['inventories']:
+            hazard, members = expected[inventory['id']]
+            self.assertAlmostEqual(inventory['hazard'], hazard)
+            self.assertEqual(inventory['chemicals'], members)
+        self.assertEqual(
+            [inventory['id'] for inventory in data['inventories']],
+            [other_id, 1])
+        self.assertEqual(hazard_engine.stats()['membership_loads'], loads)
+
+        res = self.client().get(
+            '/analytics/hazards?min_hazard=0.1', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(
+            [inventory['id'] for inventory in data['inventories']],
+            [other_id])
+
+    def test_hazards_follow_ld50_patch(self):
+        """ Pass test for GET /analytics/hazards, GET /inventories/<id> and
+        GET /chemicals/<id> agreeing after an ld50 PATCH"""
+        headers = {"Authorization": f"Bearer {self.chemist_token}"}
+        self.client().get('/analytics/hazards', headers=headers)
+        self.client().get('/chemicals/1', headers=headers)
+
+        res = self.client().patch(
+            '/chemicals/1', headers=headers, json={"ld50": 1})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/chemicals/1', headers=headers)
+        self.assertEqual(
+            json.loads(res.data)['chemical']['hazard'], Chemical.hazard_for(1))
+        res = self.client().get('/inventories/1', headers=headers)
+        hazard = json.loads(res.data)['inventory']['hazard']
+        self.assertAlmostEqual(hazard, (1 / 1 + 1 / 15 + 1 / 100) / 0.5 / 3)
+        res = self.client().get('/analytics/hazards', headers=headers)
+        inventory, = json.loads(res.data)['inventories']
+        self.assertAlmostEqual(inventory['hazard'], hazard)
+
+        res = self.client().patch(
+            '/chemicals/1', headers=headers, json={"ld50": "lethal"})
+        self.assertEqual(res.status_code, 422)
+
+    def test_what_if_hazards(self):
+        """ Pass test for POST /analytics/hazards/what-if leaving the
+        database unchanged"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        res = self.client().post('/analytics/hazards/what-if',
+                                 headers=headers, json={"ld50": {"1": 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['inventories']), 1)
+        inventory = data['inventories'][0]
+        self.assertEqual(inventory['id'], 1)
+        self.assertAlmostEqual(
+            inventory['hazard'], (1 / 10.2 + 1 / 15 + 1 / 100) / 0.5 / 3)
+        self.assertAlmostEqual(
+            inventory['what_if_hazard'], (1 / 1 + 1 / 15 + 1 / 100) / 0.5 / 3)
+
+        res = self.client().get('/inventories/1', headers=headers)
+        self.assertAlmostEqual(
+            json.loads(res.data)['inventory']['hazard'], inventory['hazard'])
+
+    def test_fail_what_if_hazards_with_invalid_changes(self):
+        """ Test for POST /analytics/hazards/what-if with an unknown
+        chemical (400) or an invalid ld50 (422)"""
+        headers = {"Authorization": f"Bearer {self.manager_token}"}
+        res = self.client().post('/analytics/hazards/what-if',
+                                 headers=headers, json={"ld50": {"99": 5}})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post('/analytics/hazards/what-if',
+                                 headers=headers, json={"ld50": {"1": -5}})
+        self.assertEqual(res.status_code, 422)
+
+# --------------------
+# COALESCING TESTS
+# --------------------
+
+    def burst(self, path, size):
+        """ Issues size concurrent GETs of path while inventory SELECTs are
+        slowed down, so all of them overlap the first one's query. Returns
+        the responses and the inventory statements run."""
+        barrier = threading.Barrier(size)
+        statements = []
+        responses = []
+
+        def slow_inventory_select(conn, cursor, statement, *args):
+            if 'FROM inventories' in statement:
+                statements.append(statement)
+                time.sleep(0.3)
+
+        def get():
+            barrier.wait()
+            res = self.client().get(path, headers={
+                "Authorization": f"Bearer {self.manager_token}"
+            })
+            responses.append((res.status_code, res.data))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', slow_inventory_select)
+        try:
+            threads = [threading.Thread(target=get) for _ in range(size)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            event.remove(
+                engine, 'before_cursor_execute', slow_inventory_select)
+
+        return responses, statements
+
+    def test_burst_of_identical_gets_runs_one_query(self):
+        """ Pass test for N concurrent GET /inventories/1 sharing one query"""
+        responses, statements = self.burst('/inventories/1', 8)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(responses), 8)
+        self.assertEqual({status for status, body in responses}, {200})
+        self.assertEqual(len({body for status, body in responses}), 1)
+
+    def test_burst_shares_errors(self):
+        """ Test for concurrent GETs of a missing inventory all failing"""
+        responses, statements = self.burst('/inventories/99', 4)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([status for status, body in responses], [404] * 4)
+
+# --------------------
+# GROUP COMMIT TESTS
+# --------------------
+
+    def concurrently(self, requests):
+        """ Issues (method, path, token, body) requests at once; returns
+        the responses in order"""
+        barrier = threading.Barrier(len(requests))
+        responses = [None] * len(requests)
+
+        def send(n, method, path, token, body):
+            barrier.wait()
+            responses[n] = getattr(self.client(), method)(path, headers={
+                "Authorization": f"Bearer {token}"
+            }, json=body)
+
+        threads = [threading.Thread(target=send, args=(n, *request))
+                   for n, request in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_group_commit_batches_writes_and_isolates_failures(self):
+        """ Test for concurrent POST /chemicals sharing commits, a duplicate
+        failing alone"""
+        self.group_commit.window = 0.05
+        before = self.group_commit.stats()
+        bodies = [{"name": f"Alkane {n}", "smiles": "C" * n, "ld50": n}
+                  for n in range(2, 8)]
+        bodies.append({"name": "Acetone", "smiles": "CCC=O", "ld50": 1})
+        responses = self.concurrently([
+            ('post', '/chemicals', self.chemist_token, body)
+            for body in bodies])
+
+        self.assertEqual(
+            [res.status_code for res in responses], [200] * 6 + [422])
+        stats = self.group_commit.stats()
+        self.assertEqual(stats['writes'] - before['writes'], 7)
+        self.assertEqual(stats['failed'] - before['failed'], 1)
+        self.assertLess(stats['batches'] - before['batches'], 7)
+
+        for res, body in zip(responses[:6], bodies):
+            chemical = json.loads(res.data)['chemical']
+            res = self.client().get(f'/chemicals/{chemical["id"]}', headers={
+                "Authorization": f"Bearer {self.chemist_token}"
+            })
+            self.assertEqual(json.loads(res.data)['chemical']['name'],
+                             body['name'])
+
+    def test_group_commit_inventory_edits(self):
+        """ Test for grouped PATCH /inventories/<id>, an unknown inventory
+        failing alone and a stale If-Match getting 412"""
+        self.group_commit.window = 0.05
+        other_id = self.create_inventory('Mordor', [1])
+        responses = self.concurrently([
+            ('patch', f'/inventories/{other_id}', self.manager_token,
+             {"chemical_ids_to_add": [2]}),
+            ('patch', '/inventories/1', self.manager_token,
+             {"location": "The Shire"}),
+            ('patch', '/inventories/99', self.manager_token,
+             {"location": "Nowhere"}),
+        ])
+
+        self.assertEqual(
+            [res.status_code for res in responses], [200, 200, 404])
+        inventory = json.loads(responses[0].data)['inventory']
+        self.assertEqual(
+            [chemical['id'] for chemical in inventory['chemicals']], [1, 2])
+        self.assertAlmostEqual(
+            inventory['hazard'], (1 / 10.2 + 1 / 15) / 0.5 / 2)
+
+        res = self.client().patch('/inventories/1', headers={
+            "Authorization": f"Bearer {self.manager_token}",
+            "If-Match": 'W/"1"'
+        }, json={"location": "Bree"})
+        self.assertEqual(res.status_code, 412)
+
+    def block_group_commit(self):
+        """ Occupies the committer thread until the returned event is set"""
+        started, release = threading.Event(), threading.Event()
+
+        def write(session):
+            started.set()
+            release.wait(timeout=10)
+
+        self.group_commit.submit(write)
+        started.wait(timeout=10)
+        return release
+
+    def test_group_commit_timeout_falls_back_to_direct_commit(self):
+        """ Test for a write the busy committer has not started committing
+        on its own"""
+        self.group_commit.window = 0.05
+        before = self.group_commit.stats()
+        release = self.block_group_commit()
+        try:
+            with patch.object(self.group_commit, 'timeout', 0.1):
+                res = self.client().post('/inventories', headers={
+                    "Authorization": f"Bearer {self.manager_token}"
+                }, json={"location": "Rivendell", "chemicals": [1]})
+        finally:
+            release.set()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.group_commit.stats()['fallbacks'] -
+                         before['fallbacks'], 1)
+        inventory_id = json.loads(res.data)['inventory']['id']
+        res = self.client().get(f'/inventories/{inventory_id}', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        })
+        self.assertEqual(res.status_code, 200)
+
+    def test_group_commit_timeout_of_running_write(self):
+        """ Fail test for a write still running when the wait expires"""
+        self.group_commit.window = 0.05
+        before = self.group_commit.stats()
+        release = threading.Event()
+
+        def write(session):
+            release.wait(timeout=10)
+
+        try:
+            with patch.object(self.group_commit, 'timeout', 0.3), \
+                    self.app.app_context():
+                with self.assertRaises(ServiceUnavailable):
+                    self.group_commit.run(write)
+        finally:
+            release.set()
+        self.assertEqual(self.group_commit.stats()['timeouts'] -
+                         before['timeouts'], 1)
+
+# --------------------
+# JOB TESTS
+# --------------------
+
+    def run_job(self, job_type, params, checkpoint=None):
+        """ Runs a job to completion on the app's job runner"""
+        with self.app.app_context():
+            job = Job(type=job_type, params=params)
+            job.checkpoint = checkpoint
+            job.insert()
+            job_id = job.id
+
+        self.app.extensions['jobs'].submit(job_id).result(timeout=10)
+
+        with self.app.app_context():
+            return Job.query.get(job_id).format()
+
+    def test_job_import_chemicals(self):
+        """ Pass test for the import_chemicals job"""
+        job = self.run_job('import_chemicals', {'chemicals': [
+            {'name': 'Benzene', 'smiles': 'c1ccccc1', 'ld50': 930},
+            {'name': 'Toluene', 'smiles': 'Cc1ccccc1', 'ld50': 636},
+        ]})
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['done'], 2)
+        with self.app.app_context():
+            self.assertEqual(Chemical.query.count(), 5)
+
+    def test_job_resumes_from_checkpoint(self):
+        """ Pass test for resuming an import after its checkpoint"""
+        job = self.run_job('import_chemicals', {'chemicals': [
+            {'name': 'Acetone', 'smiles': 'CC=O', 'ld50': 10.2},
+            {'name': 'Benzene', 'smiles': 'c1ccccc1', 'ld50': 930},
+        ]}, checkpoint=1)
+
+        self.assertEqual(job['status'], 'succeeded')
+        with self.app.app_context():
+            self.assertEqual(Chemical.query.count(), 4)
+
+    def test_job_failure_is_recorded(self):
+        """ Test for a failing job being marked failed"""
+        job = self.run_job('import_chemicals', {'chemicals': [
+            {'name': 'Acetone', 'smiles': 'CC=O', 'ld50': 10.2},
+        ]})
+
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('IntegrityError', job['error'])
+
+    def test_job_recompute_hazards(self):
+        """ Pass test for the recompute_hazards job"""
+        job = self.run_job('recompute_hazards', {})
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['done'], 1)
+        self.assertEqual(job['result'], {'inventories': 1})
+
+    def insert_job(self, status, stale=False, checkpoint=None):
+        """ Inserts a recompute_hazards job without running it"""
+        with self.app.app_context():
+            job = Job(type='recompute_hazards', params={})
+            job.status = status
+            job.checkpoint = checkpoint
+            if stale:
+                job.updated_on = datetime.now() - timedelta(hours=1)
+            job.insert()
+            return job.id
+
+    def test_cancel_job(self):
+        """ Pass test for DELETE /jobs/<id> requesting cancellation"""
+        job_id = self.insert_job('running')
+        res = self.client().delete(f'/jobs/{job_id}', headers={
+            "Authorization":
+                f"Bearer {mint_token(['delete:jobs', 'patch:inventories'])}"
+        })
+        job = json.loads(res.data)['job']
+
+        self.assertEqual(res.status_code, 202)
+        self.assertTrue(job['cancel_requested'])
+        self.assertEqual(job['status'], 'running')
+
+    def test_cancel_stale_job(self):
+        """ Pass test for DELETE /jobs/<id> cancelling a job whose worker
+        died at once"""
+        job_id = self.insert_job('running', stale=True)
+        res = self.client().delete(f'/jobs/{job_id}', headers={
+            "Authorization":
+                f"Bearer {mint_token(['delete:jobs', 'patch:inventories'])}"
+        })
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(json.loads(res.data)['job']['status'], 'cancelled')
+
+    def test_fail_409_cancel_finished_job(self):
+        """ Test for failure to DELETE a job that already finished"""
+        job_id = self.insert_job('succeeded')
+        res = self.client().delete(f'/jobs/{job_id}', headers={
+            "Authorization":
+                f"Bearer {mint_token(['delete:jobs', 'patch:inventories'])}"
+        })
+
+        self.assertEqual(res.status_code, 409)
+        self.assertFalse(json.loads(res.data)['success'])
+
+    def test_resume_job(self):
+        """ Pass test for POST /jobs/<id>/resume running a failed job again
+        from its checkpoint"""
+        job_id = self.insert_job('failed', checkpoint=0)
+        runner = self.app.extensions['jobs']
+        # Both pool threads wait, so the job runs after the request is done
+        release = threading.Event()
+        blockers = [runner.executor.submit(release.wait) for _ in range(2)]
+        futures = []
+        submit = runner.submit
+        runner.submit = lambda job_id: futures.append(submit(job_id)) \
+            or futures[-1]
+        try:
+            res = self.client().post(f'/jobs/{job_id}/resume', headers={
+                "Authorization":
+                    f"Bearer {mint_token(['post:jobs', 'patch:inventories'])}"
+            })
+        finally:
+            del runner.submit
+            release.set()
+        for future in blockers + futures:
+            future.result(timeout=10)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(json.loads(res.data)['job']['status'], 'pending')
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            self.assertEqual(job.status, 'succeeded')
+            self.assertEqual(job.result, {'inventories': 1})
+
+    def test_fail_409_resume_running_job(self):
+        """ Test for failure to resume a job that is still running"""
+        job_id = self.insert_job('running')
+        res = self.client().post(f'/jobs/{job_id}/resume', headers={
+            "Authorization":
+                f"Bearer {mint_token(['post:jobs', 'patch:inventories'])}"
+        })
+
+        self.assertEqual(res.status_code, 409)
+        self.assertFalse(json.loads(res.data)['success'])
+
+    def test_recover_stale_jobs(self):
+        """ Pass test for failing the jobs left behind by a dead worker"""
+        stale_id = self.insert_job('running', stale=True)
+        running_id = self.insert_job('running')
+
+        self.assertEqual(self.app.extensions['jobs'].recover(), 1)
+        with self.app.app_context():
+            self.assertEqual(Job.query.get(stale_id).status, 'failed')
+            self.assertIn('Interrupted', Job.query.get(stale_id).error)
+            self.assertEqual(Job.query.get(running_id).status, 'running')
+
+    def test_fail_403_post_job_without_job_type_permission(self):
+        """ Test for failure to POST a job the token can't run"""
+        res = self.client().post('/jobs', headers={
+            "Authorization": f"Bearer {mint_token(['post:jobs'])}"
+        }, json={"type": "import_chemicals", "params": {"chemicals": []}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+# --------------------
+# EXPORT TESTS
+# --------------------
+
+    @unittest.skipIf(export.pa is None, 'pyarrow is not installed')
+    def test_export_chemicals_arrow(self):
+        """ Pass test for GET /export/chemicals.arrow"""
+        res = self.client().get('/export/chemicals.arrow', headers={
+            "Authorization": f"Bearer {self.chemist_token}"
+        })
+        table = export.pa.ipc.open_stream(res.data).read_all()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('name').to_pylist()[0], 'Acetone')
+
+    @unittest.skipIf(export.pq is None, 'pyarrow.parquet is not installed')
+    def test_export_memberships_parquet(self):
+        """ Pass test for GET /export/memberships.parquet"""
+        res = self.client().get('/export/memberships.parquet', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        })
+        table = export.pq.read_table(export.pa.BufferReader(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(table.column('chemical_id').to_pylist(), [1, 2, 3])
+
+# --------------------
+# PROFILING TESTS
+# --------------------
+
+    def test_profile_request_with_admin_header(self):
+        """ Pass test for X-Profile and GET /admin/profiles"""
+        headers = {"Authorization": f"Bearer {mint_token(ROLES['admin'])}"}
+        res = self.client().get(
+            '/inventories/1?fields=id', headers={**headers, "X-Profile": "1"})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/admin/profiles', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        profile = data['profiles'][-1]
+        self.assertEqual(profile['route'], 'GET /inventories/<int:inventory_id>')
+        self.assertEqual(profile['path'], '/inventories/1?fields=id')
+        self.assertGreater(profile['peak_bytes'], 0)
+        self.assertIn('session', profile['identity_map'])
+        self.assertIn(profile['route'], data['routes'])
+        self.assertTrue(data['top_allocators'])
+        self.assertFalse(tracemalloc.is_tracing())
+
+        res = self.client().get(
+            f'/admin/profiles/{profile["id"]}', headers=headers)
+        functions = json.loads(res.data)['profile']['functions']
+        self.assertTrue(any(
+            'retrieve_inventory' in function['function']
+            for function in functions))
+
+    def test_profile_only_sampled_or_admin_requests(self):
+        """ Test for requests without admin rights or sampling not being
+        profiled, and GET /admin/profiles needing get:profiles"""
+        profiler = self.app.extensions['profiler']
+        profiled = profiler.stats()['profiled']
+        for token in (self.manager_token, None):
+            headers = {"X-Profile": "1"}
+            if token:
+                headers['Authorization'] = f'Bearer {token}'
+            self.client().get('/inventories/1', headers=headers)
+        self.assertEqual(profiler.stats()['profiled'], profiled)
+
+        profiler.sample_rate = 1.0
+        try:
+            self.client().get('/inventories/1', headers={
+                "Authorization": f"Bearer {self.manager_token}"
+            })
+        finally:
+            profiler.sample_rate = 0.0
+        self.assertEqual(profiler.stats()['profiled'], profiled + 1)
+
+        res = self.client().get('/admin/profiles', headers={
+            "Authorization": f"Bearer {self.manager_token}"
+        })
+        self.assertEqual(res.status_code, 403)
+
+# --------------------
+# WORKER TESTS
+# --------------------
+
+    def test_pool_options(self):
+        """ Pass test for the connection pool sized per worker type"""
+        url = 'postgresql://localhost/chemicals'
+        with patch.dict(os.environ):
+            for name in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT'):
+                os.environ.pop(name, None)
+            self.assertEqual(pool_options('sqlite://'), {})
+            self.assertEqual(pool_options(None, 'gevent'), {})
+            self.assertEqual(pool_options(url), {
+                'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30})
+            self.assertEqual(pool_options(url, 'eventlet'), {
+                'pool_size': 10, 'max_overflow': 0, 'pool_timeout': 5})
+
+            os.environ.update(DB_POOL_SIZE='20', DB_POOL_TIMEOUT='0.5')
+            self.assertEqual(pool_options(url, 'gevent'), {
+                'pool_size': 20, 'max_overflow': 0, 'pool_timeout': 0.5})
+
+    def green_library_after(self, patch_all):
+        """ green_library() in a new interpreter after patch_all"""
+        return subprocess.run([sys.executable, '-c', patch_all + '\n'
+                               'from server.green import green_library\n'
+                               'print(green_library())'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True,
+                              timeout=60).stdout.strip()
+
+    def test_green_library_under_threads(self):
+        """ Pass test for detecting a process that is not monkey-patched"""
+        self.assertIsNone(green_library())
+
+    @unittest.skipIf(find_spec('gevent') is None, 'gevent is not installed')
+    def test_green_library_gevent(self):
+        """ Pass test for detecting a gevent-patched process"""
+        self.assertEqual(self.green_library_after(
+            'from gevent import monkey; monkey.patch_all()'), 'gevent')
+        # Imported but not patched, as a library pulling gevent in would
+        self.assertEqual(self.green_library_after('import gevent'), 'None')
+
+    @unittest.skipIf(find_spec('eventlet') is None, 'eventlet is not installed')
+    def test_green_library_eventlet(self):
+        """ Pass test for detecting an eventlet-patched process"""
+        self.assertEqual(self.green_library_after(
+            'import eventlet; eventlet.monkey_patch()'), 'eventlet')
+
 # -------------
 # END TESTS
 # -------------